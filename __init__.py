@@ -1,8 +1,4 @@
-import logging
-from .app.configs.logs import setup_logging
-
-
-setup_logging()
-
-logger = logging.getLogger(__name__)
-logger.debug("📝 Loggers initialized. 🚀 Program started.")
+'''
+Nothing is done on import: the entry points (run.py, app/daemon, app/bench) call setup_logging() themselves,
+so importing any module stays cheap.
+'''
@@ -0,0 +1 @@
+'''Offline benchmark: local stand-ins of the proxies, proxy lists and vpngate; see __main__.py'''
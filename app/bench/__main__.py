@@ -0,0 +1,125 @@
+'''
+Offline benchmark of the pipeline against local stand-ins (see fakes.py): no spys.me, proxifly or vpngate needed.
+For every size, get_proxies() and get_vpns_from_web() run in a fresh process (see worker.py); the report is
+probes per second, time-to-first-success, peak memory and peak FDs. Linux only: the proxies live on 127.x.y.z.
+Run from the directory containing the package, e.g.
+    python -m vpn.app.bench --sizes 100 1000 10000 --proxy-fail 0.5 --proxy-latency 0.05
+    python -m vpn.app.bench --tor 8 --proxy-latency 0.5   # Tor mode: the fake SOCKS5 port stands for Tor
+    python -m vpn.app.bench --sizes 10000 --shards 4       # probing in 4 processes (see shards.py)
+'''
+
+import argparse, asyncio, json, sys
+from pathlib import Path
+
+from ..configs.file_descriptors import raise_fd_limit
+from ..configs.logs import setup_logging
+from ..configs.metrics import METRICS_DIR
+from ..utils.files import write_atomic
+from .fakes import HOST, Behavior, FakeProxies, FakeWeb, proxy_addresses, proxy_lists, vpngate_body
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# Constants
+SIZES = (100, 1_000, 10_000)
+STAND_IN_FDS = 1 << 16                        # the stand-ins hold ~3 sockets per probe: client, upstream, fake vpngate
+PKG_PARENT = Path(__file__).parents[3]        # the worker is started as `python -m <package>.app.bench.worker`
+REPORT_PATH = METRICS_DIR / "bench.json"
+COLUMNS = ("proxies", "probes", "probes_per_second", "time_to_first_success_seconds",
+           "peak_rss_mb", "peak_open_fds", "peak_in_flight", "peak_concurrency_limit", "lists_seconds")
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog="bench", description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES, help="numbers of proxies, a run per size")
+    parser.add_argument("--goal", type=int, default=None, help="successes to stop at (default: probe every proxy)")
+    parser.add_argument("--max-in-flight", type=int, default=None, help="cap of probes at once (default: adaptive)")
+    parser.add_argument("--tor", type=int, default=None, metavar="CIRCUITS",
+                        help="Tor mode: isolated circuits on the fake SOCKS5 port instead of the lists (one run)")
+    parser.add_argument("--query", default=None, help='probe only the matching proxies, e.g. "elite, country in {DE, NL}"')
+    parser.add_argument("--shards", type=int, default=None, help="probe in so many worker processes (default: in one)")
+    parser.add_argument("--segments", type=int, default=None, metavar="PROXIES",
+                        help="download the vpngate answer in byte ranges via so many proxies instead of probing them all")
+    parser.add_argument("--vpngate-no-ranges", action="store_true", help="the fake vpngate ignores Range")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--servers", type=int, default=10, help="rows in the fake vpngate answer")
+    parser.add_argument("--config-bytes", type=int, default=2_000, help="size of a fake .ovpn config")
+    for name in ("proxy", "vpngate", "lists"):
+        parser.add_argument(f"--{name}-latency", type=float, default=0.0, help="sec")
+        parser.add_argument(f"--{name}-bandwidth", type=float, default=None, help="bytes/sec")
+        parser.add_argument(f"--{name}-fail", type=float, default=0.0, help="share of failures")
+        parser.add_argument(f"--{name}-garbage", type=float, default=0.0, help="share of junk answers")
+        parser.add_argument(f"--{name}-truncated", type=float, default=0.0, help="share of answers cut short")
+    return parser.parse_args(argv)
+
+
+def behavior(args: argparse.Namespace, name: str) -> Behavior:
+    return Behavior(
+        latency=getattr(args, f"{name}_latency"),
+        bandwidth=getattr(args, f"{name}_bandwidth"),
+        fail_rate=getattr(args, f"{name}_fail"),
+        garbage_rate=getattr(args, f"{name}_garbage"),
+        truncated_rate=getattr(args, f"{name}_truncated"),
+    )
+
+
+async def bench(args: argparse.Namespace) -> list[dict]:
+    web = FakeWeb(lists=behavior(args, "lists"), vpngate=behavior(args, "vpngate"), seed=args.seed,
+                  ranges=not args.vpngate_no_ranges)
+    await web.start()
+    web.vpngate = vpngate_body(args.servers, args.config_bytes)
+    proxies = FakeProxies(behavior(args, "proxy"), upstream=("127.0.0.1", web.port), seed=args.seed)
+    await proxies.start()
+
+    reports = []
+    try:
+        for size in [args.tor] if args.tor else args.sizes:
+            web.lists = proxy_lists(proxy_addresses(size), proxies.port)
+            config = {"lists": web.list_urls(), "vpngate": web.api_url(), "goal": args.goal, "max_in_flight": args.max_in_flight,
+                      "tor": [HOST, proxies.port, size] if args.tor else None, "query": args.query,
+                      "shards": args.shards, "segments": args.segments}
+            logger.info(f"⏱️ Bench: {size} {'Tor circuits' if args.tor else 'proxies'}")
+            reports.append({"size": size} | await _run_worker(config))
+    finally:
+        await proxies.stop()
+        await web.stop()
+    return reports
+
+
+async def _run_worker(config: dict) -> dict:
+    # the stand-ins stay in this process (and event loop): the worker's peaks are the pipeline's only
+    proc = await asyncio.create_subprocess_exec(
+        sys.executable, "-m", f"{__package__}.worker", json.dumps(config),
+        stdout=asyncio.subprocess.PIPE, cwd=PKG_PARENT,
+    )
+    stdout, _ = await proc.communicate()
+    if proc.returncode != 0:
+        raise RuntimeError(f"Bench worker failed: returncode={proc.returncode}")
+    return json.loads(stdout.decode().strip().splitlines()[-1])
+
+
+def print_table(reports: list[dict]) -> None:
+    print("\t".join(COLUMNS))
+    for report in reports:
+        print("\t".join(_cell(report.get(col)) for col in COLUMNS))
+
+
+def _cell(value) -> str:
+    if value is None:
+        return "-"
+    return f"{value:.2f}" if isinstance(value, float) else str(value)
+
+
+def main(argv: list[str] | None = None) -> None:
+    args = parse_args(argv)
+    setup_logging()
+    raise_fd_limit(STAND_IN_FDS)
+    reports = asyncio.run(bench(args))
+    print_table(reports)
+    write_atomic(REPORT_PATH, json.dumps({"args": vars(args), "runs": reports}, indent=2))
+    logger.info(f"📊 Bench report → {REPORT_PATH}")
+
+
+if __name__ == "__main__":
+    main()
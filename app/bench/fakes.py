@@ -0,0 +1,318 @@
+'''
+Local stand-ins of the outer world for the benchmark: proxy lists (spys.me, proxifly, TheSpeedX),
+HTTP / SOCKS4 / SOCKS5 proxies and the vpngate API. Each one has a Behavior: latency, bandwidth,
+failure, garbage and truncation rates, so the pipeline could be measured without the network.
+'''
+
+import asyncio, base64, random, re, zlib
+from dataclasses import dataclass
+
+from aiohttp import web
+
+from ..vpn.catalog import SCHEMA, CONFIG_COLUMN
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# Constants
+HOST = "127.0.0.1"
+COUNTRIES = ("US", "DE", "NL", "JP", "FR")  # of the spys.me proxies, to have something to query
+PROXY_NET = 127                # proxies listen on 127.x.y.z: every proxy has its own address, all share one port
+CHUNK_SIZE = 16 * 1024         # bytes per throttled write
+GARBAGE_HTML = b"<html><body>Please log in to use the free Wi-Fi</body></html>"  # a captive portal
+_RANGE = re.compile(r"bytes=(\d+)-(\d+)")
+GARBAGE = b"HTTP/1.1 200 OK\r\nContent-Type: text/html\r\nConnection: close\r\n\r\n" + GARBAGE_HTML
+TRUNCATED = b"HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\nContent-Length: 100000\r\n\r\n*vpn_servers\n#HostName"
+
+
+@dataclass(frozen=True, slots=True)
+class Behavior:
+    latency: float = 0.0            # sec before the answer
+    bandwidth: float | None = None  # bytes/sec of the answer, None: unlimited
+    fail_rate: float = 0.0          # share of the requests (of the proxies) failing
+    garbage_rate: float = 0.0       # share answered with junk instead of the data
+    truncated_rate: float = 0.0     # share whose body stops short of its Content-Length
+
+    def fate(self, rng: random.Random) -> str:
+        '''"fail" | "garbage" | "truncated" | "ok"'''
+        roll = rng.random()
+        if roll < self.fail_rate:
+            return "fail"
+        if roll < self.fail_rate + self.garbage_rate:
+            return "garbage"
+        if roll < self.fail_rate + self.garbage_rate + self.truncated_rate:
+            return "truncated"
+        return "ok"
+
+
+def proxy_addresses(n: int) -> list[str]:
+    '''n loopback addresses 127.1.0.1, 127.1.0.2, ...: Linux routes the whole 127.0.0.0/8 to lo'''
+    addresses = []
+    for i in range(n):
+        block, host = divmod(i, 254)
+        addresses.append(f"{PROXY_NET}.{1 + block // 256}.{block % 256}.{host + 1}")
+    return addresses
+
+
+def proxy_lists(addresses: list[str], port: int) -> dict[str, str]:
+    """
+    Bodies of the fake sources {source name: text} in the formats of PARSERS.
+    The protocols go round-robin: http, socks4, socks5; every other SOCKS proxy is listed by spys.me without
+    its version (see detect.py); proxifly repeats every 5th proxy to exercise the merging.
+    """
+    protocols = ("http", "socks4", "socks5")
+    by_protocol: dict[str, list[str]] = {protocol: [] for protocol in (*protocols, "socks")}
+    for i, address in enumerate(addresses):
+        protocol = protocols[i % len(protocols)]
+        by_protocol["socks" if protocol != "http" and i // len(protocols) % 2 else protocol].append(f"{address}:{port}")
+
+    spysme = ["Proxy list (fake)", "IP address:Port Country-Anonymity(Noa/Anm/Hia)-SSL_support(S)-Google_passed(+)", ""]
+    spysme += [f"{ip_port} {COUNTRIES[i % len(COUNTRIES)]}-{'NAH'[i % 3]}{'-S' if i % 4 == 0 else ''} {'+-'[i % 2]}"
+               for i, ip_port in enumerate(by_protocol["http"])]
+    spysme += ["", "Free proxy list"]
+    spysme_socks = [f"{ip_port} {COUNTRIES[i % len(COUNTRIES)]}-H {'+-'[i % 2]}" for i, ip_port in enumerate(by_protocol["socks"])]
+
+    proxifly = [f"{protocols[i % len(protocols)]}://{address}:{port}" for i, address in enumerate(addresses) if i % 5 == 0]
+
+    return {
+        "spysme_http": "\n".join(spysme),
+        "spysme_socks": "\n".join(spysme_socks),
+        "speedx_socks4": "\n".join(by_protocol["socks4"]),
+        "speedx_socks5": "\n".join(by_protocol["socks5"]),
+        "proxifly": "\n".join(proxifly),
+    }
+
+
+def vpngate_body(n_servers: int, config_bytes: int) -> bytes:
+    '''The vpngate API answer with n_servers rows, see VpngateParser'''
+    columns = list(SCHEMA)
+    lines = ["*vpn_servers", "#" + ",".join(columns)]
+    for i in range(n_servers):
+        ovpn = f"client\ndev tun\nproto udp\nremote {HOST} {1194 + i}\n" + "#" * config_bytes + "\n"
+        row = {
+            "HostName": f"fake{i}", "IP": HOST, "Score": str(100_000 + i), "Ping": str(i % 100),
+            "Speed": str(10_000_000 * (i + 1)), "CountryLong": "Japan", "CountryShort": "JP",
+            "NumVpnSessions": "1", "Uptime": "1000", "TotalUsers": "1", "TotalTraffic": "1",
+            "LogType": "2weeks", "Operator": "bench", "Message": "",
+            CONFIG_COLUMN: base64.b64encode(ovpn.encode()).decode(),
+        }
+        lines.append(",".join(row[col] for col in columns))
+    lines.append("*")
+    return ("\n".join(lines) + "\n").encode()
+
+
+class FakeWeb:
+    """
+    One aiohttp server for the proxy lists (GET /lists/<source name>) and the vpngate API (GET /api/iphone/).
+    Failing requests get 503, garbage ones an HTML page, truncated ones half of the body. Each request rolls its own fate.
+    ranges: a single `Range: bytes=a-b` gets 206 with the part (If-Range is checked against the ETag), else 200.
+    """
+
+    def __init__(self, lists: Behavior, vpngate: Behavior, seed: int = 0, ranges: bool = True) -> None:
+        self.lists_behavior = lists
+        self.vpngate_behavior = vpngate
+        self.ranges = ranges
+        self.lists: dict[str, str] = dict()   # set by the bench per run, see proxy_lists()
+        self.vpngate = vpngate_body(0, 0)      # set by the bench, see vpngate_body()
+        self.port = 0
+        self._rng = random.Random(seed)
+        self._runner: web.AppRunner | None = None
+
+    async def start(self) -> None:
+        app = web.Application()
+        app.router.add_get("/lists/{name}", self._list)
+        app.router.add_get("/api/iphone/", self._api)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, HOST, 0, backlog=4096)
+        await site.start()
+        self.port = self._runner.addresses[0][1]
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    def list_urls(self) -> dict[str, str]:
+        return {name: f"http://{HOST}:{self.port}/lists/{name}" for name in self.lists}
+
+    def api_url(self) -> str:
+        return f"http://{HOST}:{self.port}/api/iphone/"
+
+    async def _list(self, request: web.Request) -> web.StreamResponse:
+        if (body := self.lists.get(request.match_info["name"])) is None:
+            raise web.HTTPNotFound()
+        return await self._answer(request, self.lists_behavior, body.encode())
+
+    async def _api(self, request: web.Request) -> web.StreamResponse:
+        return await self._answer(request, self.vpngate_behavior, self.vpngate)
+
+    async def _answer(self, request: web.Request, behavior: Behavior, body: bytes) -> web.StreamResponse:
+        await asyncio.sleep(behavior.latency)
+        match fate := behavior.fate(self._rng):
+            case "fail":
+                raise web.HTTPServiceUnavailable()
+            case "garbage":
+                return web.Response(body=GARBAGE_HTML, content_type="text/html")
+
+        status, headers = 200, {"Content-Type": "text/plain", "ETag": f'"{zlib.crc32(body):08x}"'}
+        if self.ranges and (match := _RANGE.fullmatch(request.headers.get("Range", ""))) \
+                and request.headers.get("If-Range", headers["ETag"]) == headers["ETag"]:
+            first, last = int(match[1]), min(int(match[2]), len(body) - 1)
+            headers["Content-Range"] = f"bytes {first}-{last}/{len(body)}"
+            status, body = 206, body[first:last + 1]
+        resp = web.StreamResponse(status=status, headers=headers)
+        resp.content_length = len(body)
+        await resp.prepare(request)
+        if fate == "truncated":
+            await resp.write(body[:len(body) // 2])
+            request.transport.close()  # the connection drops in the middle of the body
+            return resp
+        await _throttled_write(resp.write, body, behavior.bandwidth)
+        await resp.write_eof()
+        return resp
+
+
+class FakeProxies:
+    """
+    HTTP (CONNECT and absolute-URI requests), SOCKS4(a) and SOCKS5 proxies on one port of every 127.x.y.z address:
+    the protocol is told by the first byte. The fate of a proxy depends on its address, so it's stable between
+    the requests like for a real proxy: a dead proxy drops the connection, a garbage one answers a captive portal,
+    a truncated one an answer shorter than its Content-Length.
+    The requested target is ignored: every tunnel leads to `upstream` (the fake vpngate), so it isn't an open relay.
+    """
+
+    def __init__(self, behavior: Behavior, upstream: tuple[str, int] | None = None, seed: int = 0) -> None:
+        self.behavior = behavior
+        self.upstream = upstream
+        self.port = 0
+        self._seed = seed
+        self._server: asyncio.Server | None = None
+
+    async def start(self) -> None:
+        # 0.0.0.0: the only way to accept on all 127.x.y.z at once; connections from other hosts are dropped
+        self._server = await asyncio.start_server(self._handle, "0.0.0.0", 0, backlog=4096)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+    def fate(self, address: str) -> str:
+        return self.behavior.fate(random.Random(zlib.crc32(f"{self._seed}:{address}".encode())))
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            if not writer.get_extra_info("peername")[0].startswith(f"{PROXY_NET}."):
+                return
+            if (fate := self.fate(writer.get_extra_info("sockname")[0])) == "fail":
+                return
+
+            await asyncio.sleep(self.behavior.latency)
+            match (first := await reader.readexactly(1)):
+                case b"\x05":
+                    pending = await _socks5_handshake(reader, writer)
+                case b"\x04":
+                    pending = await _socks4_handshake(reader, writer)
+                case _:
+                    pending = await _http_handshake(first, reader, writer)
+
+            if fate == "garbage":
+                writer.write(GARBAGE)
+                await writer.drain()
+                return
+            if fate == "truncated":
+                if not pending:  # a tunnel: the answer comes after the request
+                    await reader.readuntil(b"\r\n\r\n")
+                writer.write(TRUNCATED)
+                await writer.drain()
+                return
+            await self._relay(pending, reader, writer)
+
+        except (OSError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            pass
+        finally:
+            writer.close()
+
+    async def _relay(self, pending: bytes, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        up_reader, up_writer = await asyncio.open_connection(*self.upstream)
+        up_writer.write(pending)
+
+        async def client_to_upstream() -> None:
+            while chunk := await reader.read(CHUNK_SIZE):
+                up_writer.write(chunk)
+                await up_writer.drain()
+
+        async def upstream_to_client() -> None:
+            while chunk := await up_reader.read(CHUNK_SIZE):
+                await _throttled_write(_drained(writer), chunk, self.behavior.bandwidth)
+
+        # done when either side closes: the upstream after the answer or the client after reading it (keep-alive)
+        pipes = {asyncio.create_task(client_to_upstream()), asyncio.create_task(upstream_to_client())}
+        try:
+            await asyncio.wait(pipes, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for pipe in pipes:
+                pipe.cancel()
+            await asyncio.gather(*pipes, return_exceptions=True)
+            up_writer.close()
+
+
+async def _socks5_handshake(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> bytes:
+    n_methods = (await reader.readexactly(1))[0]
+    if 2 in await reader.readexactly(n_methods):    # username/password (RFC 1929): any is accepted, as Tor does
+        writer.write(b"\x05\x02")
+        _, user_len = await reader.readexactly(2)   # VER ULEN
+        await reader.readexactly(user_len)
+        await reader.readexactly((await reader.readexactly(1))[0])
+        writer.write(b"\x01\x00")
+    else:
+        writer.write(b"\x05\x00")                   # no authentication
+    _, _, _, atyp = await reader.readexactly(4)     # VER CMD RSV ATYP
+    match atyp:
+        case 1:
+            await reader.readexactly(4)
+        case 3:
+            await reader.readexactly((await reader.readexactly(1))[0])
+        case 4:
+            await reader.readexactly(16)
+    await reader.readexactly(2)                     # port
+    writer.write(b"\x05\x00\x00\x01" + bytes(6))    # succeeded, bound to 0.0.0.0:0
+    return b""
+
+
+async def _socks4_handshake(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> bytes:
+    _, _, _, ip1, ip2, ip3, ip4 = await reader.readexactly(7)  # CMD PORT IP
+    await reader.readuntil(b"\x00")                 # user id
+    if (ip1, ip2, ip3) == (0, 0, 0) and ip4:        # SOCKS4a: the host name follows
+        await reader.readuntil(b"\x00")
+    writer.write(b"\x00\x5a" + bytes(6))            # request granted
+    return b""
+
+
+async def _http_handshake(first: bytes, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> bytes:
+    '''CONNECT: answer 200 and tunnel; a plain proxy request (GET http://host/path) is forwarded as is'''
+    head = first + await reader.readuntil(b"\r\n\r\n")
+    if head.startswith(b"CONNECT "):
+        writer.write(b"HTTP/1.1 200 Connection established\r\n\r\n")
+        return b""
+    return head
+
+
+def _drained(writer: asyncio.StreamWriter):
+    async def write(chunk: bytes) -> None:
+        writer.write(chunk)
+        await writer.drain()
+    return write
+
+
+async def _throttled_write(write, data: bytes, bandwidth: float | None) -> None:
+    '''write: async callable; spread `data` over len(data) / bandwidth seconds'''
+    if bandwidth is None:
+        await write(data)
+        return
+    for start in range(0, len(data), CHUNK_SIZE):
+        chunk = data[start:start + CHUNK_SIZE]
+        await write(chunk)
+        await asyncio.sleep(len(chunk) / bandwidth)
@@ -0,0 +1,62 @@
+'''
+Cold-start benchmark: `python -X importtime` of the entry modules, each in a fresh interpreter.
+The report is the cumulative import time of every module (min of the runs) and its heaviest imports.
+Run from the directory containing the package, e.g.
+    python -m vpn.app.bench.imports --runs 5
+'''
+
+import argparse, json, re, subprocess, sys
+from pathlib import Path
+
+from ..configs.metrics import METRICS_DIR
+from ..utils.files import write_atomic
+
+
+# Constants
+PKG_PARENT = Path(__file__).parents[3]
+PACKAGE = __package__.split(".")[0]
+MODULES = ("", "run", "app.vpn.connect", "app.vpn.get", "app.proxy.get", "app.daemon.service")
+REPORT_PATH = METRICS_DIR / "imports.json"
+TOP = 5                                     # heaviest imports listed per module
+_LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+
+def import_times(module: str) -> tuple[int, dict[str, int]]:
+    '''µs of `module` and of the outside packages it pulls in (cumulative, nested ones included), see -X importtime'''
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                          capture_output=True, text=True, cwd=PKG_PARENT, check=True)
+    lines = _LINE.findall(proc.stderr)
+    # the lines come in post-order: the subtree of `module` starts after the previous top-level import (startup)
+    start = max((i + 1 for i, (_, _, indent, _) in enumerate(lines[:-1]) if len(indent) == 1), default=0)
+    packages = dict()
+    for _, cumulative, _, name in lines[start:-1]:
+        if "." not in name and name != PACKAGE:
+            packages[name] = max(packages.get(name, 0), int(cumulative))
+    return int(lines[-1][1]), packages
+
+
+def bench(modules: list[str], runs: int) -> list[dict]:
+    reports = []
+    for module in modules:
+        name = f"{PACKAGE}.{module}".rstrip(".")
+        total, packages = min((import_times(name) for _ in range(runs)), key=lambda result: result[0])
+        heaviest = sorted(packages.items(), key=lambda item: item[1], reverse=True)[:TOP]
+        reports.append({"module": name, "ms": total / 1000, "heaviest": {pkg: us / 1000 for pkg, us in heaviest}})
+    return reports
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(prog="imports", description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--modules", nargs="+", default=MODULES, help=f"relative to the package ('' = {PACKAGE} itself)")
+    parser.add_argument("--runs", type=int, default=3, help="fresh interpreters per module, the fastest is kept")
+    args = parser.parse_args(argv)
+
+    reports = bench(args.modules, args.runs)
+    for report in reports:
+        heaviest = ", ".join(f"{mod} {ms:.0f}" for mod, ms in report["heaviest"].items())
+        print(f"{report['module']:<32}{report['ms']:>8.1f} ms\t{heaviest}")
+    write_atomic(REPORT_PATH, json.dumps(reports, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+'''
+One benchmark run in its own process, so the peaks of memory and FDs belong to this run only:
+get_proxies() from the fake lists (or TorCircuits on the fake SOCKS5 port), then get_vpns_from_web() via all
+the proxies (or get_vpns_segmented() via a few of them). Prints the JSON report to stdout.
+Started by the bench (see __main__.py): python -m <package>.app.bench.worker '<json config>'
+'''
+
+import asyncio, json, resource, sys, tempfile
+from pathlib import Path
+
+from ..configs.logs import setup_logging
+from ..configs.metrics import metrics
+from ..proxy.get import get_proxies
+from ..proxy.health import HEALTH_STATE
+from ..proxy.query import ProxyIndex, Query
+from ..proxy.tor import TorCircuits
+from ..utils import files
+from ..utils.source_cache import SourceCache
+from ..vpn.get import get_vpns_from_web
+from ..vpn.segments import get_vpns_segmented
+
+
+async def run(config: dict) -> dict:
+    """
+    config: {"lists": {source name: url}, "vpngate": url, "goal": int | None, "max_in_flight": int | None,
+             "tor": [host, port, circuits] | None, "query": str | None, "shards": int | None, "segments": int | None}
+    goal None: probe every proxy; max_in_flight None: the Governor decides; tor: circuits instead of the lists;
+    query: only the matching proxies are probed (see query.py); shards: probing in worker processes (see shards.py);
+    segments: one ranged download via so many proxies instead of the probing (see segments.py).
+    """
+    with tempfile.TemporaryDirectory(prefix="vpn-bench-") as tmp:
+        # the health and the source cache of the real runs aren't touched, every bench run starts cold
+        files.STATE_DIR = Path(tmp) / "state"
+        files.RESULTS_DIR = Path(tmp) / "results"
+        base_rss = _peak_rss_mb()
+
+        metrics.reset()
+        with metrics.stage("get_proxies"):
+            if config.get("tor"):
+                host, port, n_circuits = config["tor"]
+                probes = await TorCircuits(host, port, n_circuits).fastest(config["vpngate"], n_circuits)
+                n_proxies, proxy_table = n_circuits, None
+            else:
+                proxy_table = await get_proxies(config["lists"], SourceCache(Path(tmp) / "sources"))
+                if config.get("query"):
+                    with metrics.stage("query"):
+                        probes = list(ProxyIndex(proxy_table).probes(Query.parse(config["query"])))
+                else:
+                    probes = list(proxy_table.probes())
+                n_proxies = len(proxy_table)
+        lists_seconds = metrics.stages["get_proxies"]
+        query_seconds = metrics.stages.get("query")
+
+        metrics.reset()
+        try:
+            if config.get("segments"):
+                servers = await get_vpns_segmented(probes, config["segments"], sources={"vpngate": config["vpngate"]},
+                                                   health_state=None if config.get("tor") else HEALTH_STATE) or []
+            else:
+                servers = await get_vpns_from_web(probes,
+                                                  goal=config["goal"] or len(probes),
+                                                  max_in_flight=config["max_in_flight"],
+                                                  sources={"vpngate": config["vpngate"]},
+                                                  health_state=None if config.get("tor") else HEALTH_STATE,
+                                                  table=proxy_table,
+                                                  n_shards=config.get("shards"))
+        except SystemExit:  # no working proxy
+            servers = []
+        metrics.sample_fds()
+        report = metrics.to_dict()
+
+    n_probes = report["histograms"].get("probe_seconds", {}).get("count", 0)
+    fanout_seconds = report["stages_seconds"].get("probe_fanout", 0.0)
+    return {
+        "proxies": n_proxies,
+        "lists_seconds": lists_seconds,
+        "query_seconds": query_seconds,
+        "probes": n_probes,
+        "fanout_seconds": fanout_seconds,
+        "probes_per_second": n_probes / fanout_seconds if fanout_seconds else 0.0,
+        "time_to_first_success_seconds": report["time_to_first_success_seconds"],
+        "outcomes": report["counters"].get("probe_outcomes", {}),
+        "detected": report["counters"].get("protocol_detect", {}),
+        "segmented_seconds": report["stages_seconds"].get("segmented_download"),
+        "segments": report["counters"].get("segments", {}),
+        "servers": len(servers),
+        "peak_in_flight": report["peaks"].get("in_flight", 0),
+        "peak_concurrency_limit": report["peaks"].get("concurrency_limit", 0),
+        "peak_open_fds": report["peaks"].get("open_fds", 0),
+        "base_rss_mb": base_rss,
+        "peak_rss_mb": _peak_rss_mb(),
+    }
+
+
+def _peak_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # KiB on Linux
+
+
+if __name__ == "__main__":
+    setup_logging()
+    print(json.dumps(asyncio.run(run(json.loads(sys.argv[1])))))
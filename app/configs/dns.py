@@ -0,0 +1,183 @@
+'''
+Process-wide DNS cache. Each SOCKS probe gets a connector of its own (see SessionPool), and a connector's DNS
+cache dies with it, so without this the vpngate host is resolved once per probe and the sources once per run.
+  - an answer is kept for its TTL (aiodns gives it; the system resolver doesn't: DEFAULT_TTL), a failure for
+    NEGATIVE_TTL, so a dead mirror name doesn't cost a lookup per probe;
+  - the lookups of one host in flight at once share one query;
+  - an expired answer is served while the lookup fails or takes longer than STALE_TIMEOUT (RFC 8767
+    serve-stale): a slow system resolver doesn't stall the probes;
+  - the entry points (run.py, the daemon, the shard coordinator) prefetch() the source and mirror hosts once at
+    the start and save() the cache into STATE_DIR at the end: the probes themselves never wait for a lookup or
+    write the state. A shard worker gets the coordinator's answers with restore(snapshot()).
+Users: the aiohttp connectors (CachedResolver, see web_sessions.py) and pin() for the proxied requests, whose
+proxy or SOCKS library would resolve the name again. IPv4 only: the proxies are IPv4 too.
+`dns` is the process-wide instance, like `metrics`.
+'''
+
+import asyncio, ipaddress, socket, time
+from dataclasses import astuple, dataclass
+from typing import Iterable, NamedTuple
+from urllib.parse import urlsplit
+
+from ..utils.files import read_state, write_state
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# Constants
+DNS_CACHE = "dns_cache"      # file name in STATE_DIR
+DEFAULT_TTL = 5 * 60         # sec: the system resolver doesn't tell the TTL
+MIN_TTL, MAX_TTL = 30, 24 * 60 * 60
+NEGATIVE_TTL = 60            # sec a failed lookup is remembered
+STALE_MAX_AGE = 24 * 60 * 60  # sec an expired answer may still be served
+STALE_TIMEOUT = 1.0          # sec a lookup may take before the expired answer is served
+LOOKUP_TIMEOUT = 5           # sec
+
+
+@dataclass(slots=True)
+class _Entry:
+    addresses: list[str]     # []: the lookup failed
+    expires: float           # unix time
+
+
+class Pinned(NamedTuple):
+    url: str                 # with the cached IP instead of the host name
+    headers: dict[str, str]  # Host: the name, for the virtual hosts
+    server_hostname: str | None  # the name for TLS: SNI and the certificate check
+
+
+class DnsCache:
+
+    def __init__(self, name: str = DNS_CACHE) -> None:
+        self._name = name
+        self._entries: dict[str, _Entry] | None = None  # loaded on the first use
+        self._lookups: dict[str, asyncio.Task] = dict()
+        self._changed = False
+
+    async def resolve(self, host: str) -> list[str]:
+        '''IPv4 addresses of the host; OSError if it doesn't resolve'''
+        if _is_ip(host):
+            return [host]
+        entry, now = self._get(host), time.time()
+        if entry is not None and now < entry.expires:
+            if not entry.addresses:
+                raise OSError(f"{host} doesn't resolve (cached)")
+            return entry.addresses
+
+        lookup = self._lookups.get(host)
+        if lookup is None:
+            lookup = self._lookups[host] = asyncio.create_task(self._lookup(host))
+            lookup.add_done_callback(lambda _: self._lookups.pop(host, None))
+        stale = entry.addresses if entry is not None and entry.expires + STALE_MAX_AGE > now else []
+        try:  # shielded: a caller that gives up (or gets the stale answer) doesn't cancel the others' lookup
+            addresses = await asyncio.wait_for(asyncio.shield(lookup), STALE_TIMEOUT if stale else None)
+        except asyncio.TimeoutError:
+            addresses = []
+        if addresses:
+            return addresses
+        if stale:
+            logger.debug(f"DNS: the expired answer for {host} is served")
+            return stale
+        raise OSError(f"{host} doesn't resolve")
+
+    def pinned(self, host: str) -> str | None:
+        '''A cached address of the host, even an expired one (it's refreshed in the background); no lookup'''
+        if (entry := self._get(host)) is None or not entry.addresses or time.time() > entry.expires + STALE_MAX_AGE:
+            return None
+        if time.time() >= entry.expires and host not in self._lookups:
+            try:
+                self._lookups[host] = task = asyncio.get_running_loop().create_task(self._lookup(host))
+                task.add_done_callback(lambda _: self._lookups.pop(host, None))
+            except RuntimeError:
+                pass  # no event loop: nobody to refresh it
+        return entry.addresses[0]
+
+    def pin(self, url: str) -> Pinned:
+        """
+        The URL to request via a proxy with the cached address of its host, so the proxy (an HTTP one, or the
+        SOCKS4 client that resolves locally) doesn't look the name up. Unchanged if the host isn't cached.
+        """
+        parts = urlsplit(url)
+        if not parts.hostname or _is_ip(parts.hostname) or (ip := self.pinned(parts.hostname)) is None:
+            return Pinned(url, {}, None)
+        netloc = f"{ip}:{parts.port}" if parts.port else ip
+        return Pinned(parts._replace(netloc=netloc).geturl(), {"Host": parts.netloc},
+                      parts.hostname if parts.scheme == "https" else None)
+
+    async def prefetch(self, urls: Iterable[str]) -> None:
+        '''Resolve the hosts of the URLs (only the expired ones)'''
+        hosts = {host for url in urls if (host := urlsplit(url).hostname) and not _is_ip(host)}
+        start = time.monotonic()
+        results = await asyncio.gather(*(self.resolve(host) for host in hosts), return_exceptions=True)
+        n_failed = sum(isinstance(result, Exception) for result in results)
+        logger.debug(f"DNS: {len(hosts)} hosts prefetched in {(time.monotonic() - start) * 1000:.0f} ms, {n_failed} failed")
+
+    def save(self) -> None:
+        if self._changed and self._entries is not None:
+            write_state(self.snapshot(), self._name)
+            self._changed = False
+
+    def snapshot(self) -> dict[str, tuple]:
+        '''The answers as plain data: for the state file and the shard workers'''
+        self._get("")  # loaded
+        return {host: astuple(entry) for host, entry in self._entries.items()}
+
+    def restore(self, snapshot: dict[str, tuple]) -> None:
+        '''Take the answers of another process instead of reading the state file'''
+        self._entries = {host: _Entry(*fields) for host, fields in snapshot.items()}
+        self._changed = False
+
+    def _get(self, host: str) -> _Entry | None:
+        if self._entries is None:
+            self._entries = dict()
+            for cached_host, fields in read_state(self._name).items():
+                try:
+                    self._entries[cached_host] = _Entry(*fields)
+                except TypeError:
+                    continue  # state of an old format
+        return self._entries.get(host)
+
+    async def _lookup(self, host: str) -> list[str]:
+        '''[] on failure: it's remembered for NEGATIVE_TTL, an old answer is kept to be served stale'''
+        try:
+            addresses, ttl = await asyncio.wait_for(_query(host), LOOKUP_TIMEOUT)
+        except (OSError, asyncio.TimeoutError, ValueError) as e:
+            logger.debug(f"DNS: {host} failed: {e!r}")
+            if (entry := self._get(host)) is not None and entry.addresses:
+                entry.expires = min(entry.expires, time.time())  # stays expired: looked up again next time
+            else:
+                self._entries[host] = _Entry([], time.time() + NEGATIVE_TTL)
+            self._changed = True
+            return []
+        self._entries[host] = _Entry(addresses, time.time() + max(MIN_TTL, min(MAX_TTL, ttl)))
+        self._changed = True
+        return addresses
+
+
+async def _query(host: str) -> tuple[list[str], float]:
+    '''(addresses, TTL): via aiodns if it's installed, the system resolver otherwise'''
+    try:
+        import aiodns
+    except ImportError:
+        infos = await asyncio.get_running_loop().getaddrinfo(host, None, family=socket.AF_INET, type=socket.SOCK_STREAM)
+        return list(dict.fromkeys(info[4][0] for info in infos)), DEFAULT_TTL
+
+    try:
+        answers = await aiodns.DNSResolver().query(host, "A")
+    except aiodns.error.DNSError as e:
+        raise OSError(f"{host}: {e}") from e
+    if not answers:
+        raise OSError(f"{host}: no A records")
+    return [answer.host for answer in answers], min(answer.ttl for answer in answers)
+
+
+def _is_ip(host: str) -> bool:
+    try:
+        ipaddress.ip_address(host)
+        return True
+    except ValueError:
+        return False
+
+
+dns = DnsCache()
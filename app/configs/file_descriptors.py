@@ -1,14 +1,61 @@
-import resource
+import errno, os, resource
+from pathlib import Path
 # fd -- file descriptors
 
-def set_fd_limit(n_proxies: int) -> None:
-    '''n_proxies: number proxies that we try to connect. One proxy is one session (opend descriptor).
-    Set new limit for opened descriptores for current process'''
+import logging
+logger = logging.getLogger(__name__)
+
+
+# Constants
+FD_DIR = Path("/proc/self/fd")  # Linux only, elsewhere the opened FDs aren't counted
+RESERVED_FDS = 64               # kept for the logs, the caches, the event loop, the DNS resolver, ...
+MAX_SOFT_LIMIT = 1 << 20        # the soft limit isn't raised above it even if the hard limit is unlimited
+LOCAL_ERRNOS = {                # errors of this host, not of the proxy: too many probes at once
+    errno.EMFILE,               # the process is out of FDs
+    errno.ENFILE,               # the system is out of FDs
+    errno.ENOBUFS,
+    errno.ENOMEM,
+    errno.EADDRNOTAVAIL,        # out of ephemeral ports
+}
+
+
+def raise_fd_limit(wanted: int) -> int:
+    '''Raise the soft limit up to `wanted` FDs, as far as the hard limit allows. Return the soft limit in effect'''
 
     # RLIMIT_NOFILE is the max number of open file descriptors
     soft_limit, hard_limit = resource.getrlimit(resource.RLIMIT_NOFILE)
-    if hard_limit < n_proxies:
-        NotImplemented  # should be developed
-    elif soft_limit < n_proxies:
-        resource.setrlimit(resource.RLIMIT_NOFILE, (n_proxies, hard_limit))
-        
\ No newline at end of file
+    if soft_limit == resource.RLIM_INFINITY or soft_limit >= wanted:
+        return min(soft_limit, MAX_SOFT_LIMIT) if soft_limit == resource.RLIM_INFINITY else soft_limit
+
+    new_limit = wanted if hard_limit == resource.RLIM_INFINITY else min(wanted, hard_limit)
+    try:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (new_limit, hard_limit))
+    except (ValueError, OSError):  # e.g. above /proc/sys/fs/nr_open
+        logger.warning(f"⚠️ Could not raise the FD limit {soft_limit} → {new_limit}", exc_info=True)
+        return soft_limit
+
+    if new_limit < wanted:
+        logger.info(f"📉 FD hard limit is {hard_limit}: fewer probes at once than asked")
+    return new_limit
+
+
+def open_fds() -> int | None:
+    try:
+        return len(os.listdir(FD_DIR))
+    except OSError:
+        return None
+
+
+def fd_budget(wanted: int, reserve: int = RESERVED_FDS) -> int:
+    '''FDs free for the probes: the limit raised for `wanted` ones minus the opened and reserved ones'''
+    soft_limit = raise_fd_limit(wanted + reserve + (open_fds() or 0))
+    return max(0, soft_limit - reserve - (open_fds() or 0))
+
+
+def is_local_error(e: BaseException) -> bool:
+    '''The host ran out of resources (FDs, ports, buffers): not the proxy's fault. The wrapped errors are checked too'''
+    while e is not None:
+        if getattr(e, "errno", None) in LOCAL_ERRNOS:
+            return True
+        e = e.__cause__ or e.__context__
+    return False
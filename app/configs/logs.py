@@ -1,22 +1,30 @@
-'''setup_logging() is run in root __init__.py to set up logging in all project'''
+'''setup_logging() is run by the entry points (run.py, app/daemon, app/bench) to set up logging in all project'''
 
-import logging
-import tomllib
-from logging.handlers import RotatingFileHandler
+import atexit, logging, queue, tomllib
+from collections import Counter
+from functools import cache
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 from pathlib import Path
+from typing import Callable
+
+from .metrics import metrics
 
 
 # Path(__file__) is vpn/app/configs/
 PKG_ROOT = Path(__file__).parents[2]       # 2 levels up = …/vpn
 CONFIG_PATH = PKG_ROOT / "pyproject.toml"  # …/vpn/pyproject.toml
 
+_listener: QueueListener | None = None     # background thread writing the records in the queue mode
+
 
+@cache  # read once: OutcomeLog is created per probing stage
 def _load_cfg() -> dict[str, str]:
     with CONFIG_PATH.open("rb") as f:
         return tomllib.load(f)["tool"]["logging"]
 
 
 def setup_logging() -> None:
+    global _listener
     logcfg = _load_cfg()
 
     log_file = PKG_ROOT / logcfg["file"]
@@ -43,8 +51,77 @@ def setup_logging() -> None:
     root = logging.getLogger()
     root.handlers.clear()             # remove default stderr handler installed by basicConfig
     root.setLevel(logcfg["level"])
-    root.addHandler(console)
-    root.addHandler(file)
+
+    _stop_listener()                  # setup_logging() is called again
+
+    if logcfg.get("queue", False):
+        # the event loop only puts records to the queue; formatting, writes and rollover run in the listener thread
+        records = queue.SimpleQueue()
+        root.addHandler(_LazyQueueHandler(records))
+        _listener = QueueListener(records, console, file, respect_handler_level=True)
+        _listener.start()
+    else:
+        root.addHandler(console)
+        root.addHandler(file)
+
+    logging.getLogger(__name__).debug("📝 Loggers initialized. 🚀 Program started.")
+
+
+def setup_worker_logging(handler: logging.Handler, level: int) -> None:
+    '''In a worker process (see shards.py): the records go to `handler`, which passes them on to the main process'''
+    root = logging.getLogger()
+    root.handlers.clear()
+    root.setLevel(level)
+    root.addHandler(handler)
+
+
+@atexit.register  # flush the queue on exit
+def _stop_listener() -> None:
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+class _LazyQueueHandler(QueueHandler):
+    '''QueueHandler.prepare() formats the message in the caller thread: not needed for an in-process queue'''
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+class OutcomeLog:
+    """
+    Aggregated logging of the per-proxy outcomes in the probe hot path: thousands of lines per run aren't readable
+    and cost the event loop. Each outcome is logged `sample_first` times and then every `sample_every`-th time,
+    summary() logs the totals. metric: the counter in `metrics` to count the outcomes to.
+    on_outcome: called with every outcome, e.g. Governor.record.
+    """
+
+    def __init__(self, logger: logging.Logger, sample_first: int | None = None, sample_every: int | None = None,
+                 metric: str | None = None, on_outcome: Callable[[str], None] | None = None) -> None:
+        logcfg = _load_cfg()
+        self._logger = logger
+        self._metric = metric
+        self._on_outcome = on_outcome
+        self._sample_first = int(logcfg.get("sample_first", 10) if sample_first is None else sample_first)
+        self._sample_every = int(logcfg.get("sample_every", 100) if sample_every is None else sample_every)
+        self.counts: Counter[str] = Counter()
+
+    def record(self, outcome: str, msg: str, *args) -> None:
+        '''msg, args: lazy %-formatting, done only for the sampled records'''
+        self.counts[outcome] += 1
+        n = self.counts[outcome]
+        if self._metric:
+            metrics.count(self._metric, outcome)
+        if self._on_outcome is not None:
+            self._on_outcome(outcome)
+        if (n <= self._sample_first or n % self._sample_every == 0) and self._logger.isEnabledFor(logging.DEBUG):
+            self._logger.debug(msg + "\t[%s #%d]", *args, outcome, n, stacklevel=2)
+
+    def summary(self, level: int = logging.INFO) -> None:
+        if self.counts:
+            self._logger.log(level, "Outcomes: %s", ", ".join(f"{k}={v}" for k, v in self.counts.most_common()), stacklevel=2)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,155 @@
+'''
+Per-run metrics: stage wall-clock times, probe latency histograms, counters by outcome, peaks of in-flight
+probes and opened file descriptors, time-to-first-success. Dumped as JSON and Prometheus text by run.py.
+`metrics` is the process-wide instance, like the loggers.
+'''
+
+import json, math, time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator
+
+from .file_descriptors import open_fds
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# Constants
+METRICS_DIR = Path(__file__).parents[2] / "tmp" / "metrics"  # …/vpn/tmp/metrics
+PREFIX = "vpn_"                                              # of the Prometheus metric names
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, math.inf)  # sec
+FD_SAMPLE_PERIOD = 0.1                                       # sec: listing /proc/self/fd isn't free
+
+
+class Histogram:
+    """Cumulative buckets as in Prometheus: counts[i] == number of observations <= buckets[i]"""
+
+    def __init__(self, buckets: tuple[float, ...] = LATENCY_BUCKETS) -> None:
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.sum += value
+        self.count += 1
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+    def to_dict(self) -> dict:
+        return {"buckets": {_le(b): c for b, c in zip(self.buckets, self.counts)}, "sum": self.sum, "count": self.count}
+
+
+class Metrics:
+
+    def __init__(self) -> None:
+        self.reset()
+
+    def reset(self) -> None:
+        self.started = time.monotonic()
+        self.stages: dict[str, float] = defaultdict(float)         # stage: seconds (summed if entered many times)
+        self.counters: dict[str, Counter[str]] = defaultdict(Counter)  # name: {label: count}
+        self.histograms: dict[str, Histogram] = defaultdict(Histogram)
+        self.peaks: dict[str, float] = defaultdict(float)
+        self.first_success_at: float | None = None                  # sec since the start
+        self._fds_sampled_at = 0.0
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] += time.perf_counter() - start
+
+    def add_time(self, stage: str, seconds: float) -> None:
+        self.stages[stage] += seconds
+
+    def count(self, name: str, label: str = "", n: int = 1) -> None:
+        self.counters[name][label] += n
+
+    def observe(self, name: str, value: float) -> None:
+        self.histograms[name].observe(value)
+
+    def peak(self, name: str, value: float) -> None:
+        if value > self.peaks[name]:
+            self.peaks[name] = value
+
+    def in_flight(self, n: int) -> None:
+        '''Called by the scheduler after launching probes: peak of probes (~ sockets) in flight and of opened FDs'''
+        self.peak("in_flight", n)
+        if (now := time.monotonic()) - self._fds_sampled_at >= FD_SAMPLE_PERIOD:
+            self._fds_sampled_at = now
+            self.sample_fds()
+
+    def sample_fds(self) -> None:
+        if (n_open := open_fds()) is not None:  # None: not Linux
+            self.peak("open_fds", n_open)
+
+    def merge(self, report: dict) -> None:
+        '''Add to_dict() of a worker process (see shards.py): its counters, and its peaks if they are higher than ours
+        (a peak is a maximum, not a total). Its histograms and stages aren't taken: the coordinator keeps its own.'''
+        for name, labels in report["counters"].items():
+            self.counters[name].update(labels)
+        for name, value in report["peaks"].items():
+            self.peaks[name] = max(self.peaks[name], value)
+
+    def first_success(self) -> None:
+        if self.first_success_at is None:
+            self.first_success_at = time.monotonic() - self.started
+
+    def to_dict(self) -> dict:
+        return {
+            "wall_seconds": time.monotonic() - self.started,
+            "time_to_first_success_seconds": self.first_success_at,
+            "stages_seconds": dict(self.stages),
+            "counters": {name: dict(labels) for name, labels in self.counters.items()},
+            "histograms": {name: hist.to_dict() for name, hist in self.histograms.items()},
+            "peaks": dict(self.peaks),
+        }
+
+    def to_json(self) -> str:
+        return json.dumps(self.to_dict(), indent=2)
+
+    def to_prometheus(self) -> str:
+        lines = [f"{PREFIX}wall_seconds {time.monotonic() - self.started:.6f}"]
+        if self.first_success_at is not None:
+            lines.append(f"{PREFIX}time_to_first_success_seconds {self.first_success_at:.6f}")
+
+        lines.append(f"# TYPE {PREFIX}stage_seconds gauge")
+        lines += [f'{PREFIX}stage_seconds{{stage="{stage}"}} {sec:.6f}' for stage, sec in self.stages.items()]
+
+        for name, labels in self.counters.items():
+            lines.append(f"# TYPE {PREFIX}{name}_total counter")
+            lines += [f'{PREFIX}{name}_total{{label="{label}"}} {n}' for label, n in labels.items()]
+
+        for name, hist in self.histograms.items():
+            lines.append(f"# TYPE {PREFIX}{name} histogram")
+            lines += [f'{PREFIX}{name}_bucket{{le="{_le(b)}"}} {c}' for b, c in zip(hist.buckets, hist.counts)]
+            lines += [f"{PREFIX}{name}_sum {hist.sum:.6f}", f"{PREFIX}{name}_count {hist.count}"]
+
+        for name, value in self.peaks.items():
+            lines.append(f"{PREFIX}peak_{name} {value:g}")
+
+        return "\n".join(lines) + "\n"
+
+    def dump(self, stem: str = "run", metrics_dir: Path = METRICS_DIR) -> Path:
+        '''Write <stem>.json and <stem>.prom; return the path of the JSON'''
+        self.sample_fds()
+        metrics_dir.mkdir(parents=True, exist_ok=True)
+        json_path = metrics_dir / f"{stem}.json"
+        json_path.write_text(self.to_json(), encoding="utf-8")
+        (metrics_dir / f"{stem}.prom").write_text(self.to_prometheus(), encoding="utf-8")
+
+        logger.info(f"📊 Metrics → {json_path}")
+        return json_path
+
+
+def _le(bound: float) -> str:
+    return "+Inf" if bound == math.inf else f"{bound:g}"
+
+
+metrics = Metrics()
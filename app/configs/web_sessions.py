@@ -1,42 +1,107 @@
-import asyncio, aiohttp
-import aiohttp_socks
+import asyncio, aiohttp, socket
+from aiohttp.abc import AbstractResolver, ResolveResult
+from contextlib import asynccontextmanager
+from typing import TYPE_CHECKING, AsyncIterator
+
+from .dns import dns
+
+if TYPE_CHECKING:  # imported by the first SOCKS probe
+    from aiohttp_socks import ProxyConnector
 
 
 # Constants
-TOTAL_LIMIT, PER_HOST_LIMIT = 0, 0
+TOTAL_LIMIT, PER_HOST_LIMIT = 0, 0  # 0 => no limit on connector level: the probe scheduler caps the sockets
 TIMEOUT = aiohttp.ClientTimeout(total=10)
+SHARED_PROTOCOLS = ("http", "https")  # aiohttp makes CONNECT per request => one connector serves all proxies
 
 
 class SessionPool:
-    """One aiohttp.ClientSession per proxy protocol."""
+    """
+    Sessions shared by all probes of one run:
+      - HTTP/HTTPS proxies share one session (one connector), the proxy is passed per request;
+      - aiohttp_socks binds a connector to a single proxy, so each SOCKS probe gets a short-lived session.
+        The pool tracks them to close every socket at once when the run is over (or cancelled).
+    """
 
     def __init__(self) -> None:
         self._sessions: dict[str, aiohttp.ClientSession] = dict()
+        self._socks: set[aiohttp.ClientSession] = set()
 
     async def open(self) -> None:
-        # create connectors (inside pools with sockets)
-        http_conn = aiohttp.TCPConnector(limit=TOTAL_LIMIT, limit_per_host=PER_HOST_LIMIT)  # pool: HTTP / HTTPS
-        sock_conn = aiohttp_socks.ProxyConnector(limit=TOTAL_LIMIT, limit_per_host=PER_HOST_LIMIT, rdns=False)  # try: rdns=True  # pool: SOCKS 4/4a/5
-        # rdns=True => send host names to proxies that support it
-
-        # create sessions: wrap connector + cookies + headers
+        # force_close: each proxy is probed once, keep-alive sockets would only hold file descriptors
+        http_conn = aiohttp.TCPConnector(limit=TOTAL_LIMIT, limit_per_host=PER_HOST_LIMIT, force_close=True,
+                                         resolver=CachedResolver())  # pool: HTTP / HTTPS
         h_sess = aiohttp.ClientSession(connector=http_conn, timeout=TIMEOUT, raise_for_status=True)
-        s_sess = aiohttp.ClientSession(connector=sock_conn, timeout=TIMEOUT, raise_for_status=True)
 
-        self._sessions.update({"http": h_sess, "https": h_sess, 
-                               "socks5": s_sess, "socks5h": s_sess, "socks4a": s_sess, "socks4": s_sess})
+        self._sessions.update({proto: h_sess for proto in SHARED_PROTOCOLS})
 
 
     async def close(self) -> None:
         # Guard to prevent leaks. Must: event_loop exists, runned from async code
-        # await aiohttp.helpers.assert_asyncio_running()
+        sessions = set(self._sessions.values()) | self._socks
+        await asyncio.gather(*(sess.close() for sess in sessions))
+
+        self._sessions.clear()
+        self._socks.clear()
+
 
-        await asyncio.gather(*(sess.close() for sess in set(self._sessions.values())))
+    async def __aenter__(self) -> "SessionPool":
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.close()
 
 
     def get_session(self, protocol: str) -> aiohttp.ClientSession:
         return self._sessions.get(protocol, self._sessions["http"])
-    
 
-session_pool = SessionPool()
-    
\ No newline at end of file
+
+    @asynccontextmanager
+    async def session(self, protocol: str, proxy: str) -> AsyncIterator[tuple[aiohttp.ClientSession, str | None]]:
+        """Yield (session, proxy argument for session.get) to make one request via `proxy`."""
+
+        if protocol in SHARED_PROTOCOLS:
+            yield self._sessions[protocol], proxy
+            return
+
+        connector, proxy_arg = _create_proxy_connector(protocol, proxy)
+        sess = aiohttp.ClientSession(connector=connector, timeout=TIMEOUT, raise_for_status=True)
+        self._socks.add(sess)
+        try:
+            yield sess, proxy_arg
+        finally:
+            self._socks.discard(sess)
+            await sess.close()
+
+
+class CachedResolver(AbstractResolver):
+    '''aiohttp's resolver on top of the process-wide DNS cache (see dns.py): it outlives the connectors'''
+
+    async def resolve(self, host: str, port: int = 0, family: socket.AddressFamily = socket.AF_INET) -> list[ResolveResult]:
+        if family == socket.AF_INET6:
+            raise OSError(f"{host}: IPv4 only")
+        return [ResolveResult(hostname=host, host=ip, port=port, family=socket.AF_INET, proto=0, flags=socket.AI_NUMERICHOST)
+                for ip in await dns.resolve(host)]
+
+    async def close(self) -> None:
+        pass  # the cache is shared
+
+
+def _create_proxy_connector(protocol: str, proxy: str) -> tuple["ProxyConnector | aiohttp.TCPConnector", str | None]:
+    """Return an aiohttp/aiohttp_socks connector and proxy argument based on the proxy protocol."""
+    from aiohttp_socks import ProxyConnector
+
+    if "socks5" == protocol:
+        connector = ProxyConnector.from_url(proxy, rdns=True)
+        proxy_arg = None       # handled by the connector itself
+    elif "socks" in protocol:  # socks5h, socks4, ...:
+        connector = ProxyConnector.from_url(proxy)
+        proxy_arg = None
+    elif "http" in protocol:  # http, https
+        connector = aiohttp.TCPConnector()     # normal TCP; aiohttp does the CONNECT
+        proxy_arg = proxy     # pass to session.get
+    else:
+        raise ValueError(f"Unknown proxy protocol: {protocol!r}")
+
+    return connector, proxy_arg
@@ -0,0 +1 @@
+'''Long-running mode: a hot pool of verified proxies and VPN servers served over a local API, see service.py'''
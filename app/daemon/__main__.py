@@ -0,0 +1,54 @@
+'''
+Run the refresh daemon, e.g. from the directory containing the package:
+    python -m vpn.app.daemon                       # http://127.0.0.1:8765
+    python -m vpn.app.daemon --unix /tmp/vpn.sock
+    python -m vpn.app.daemon --tor 127.0.0.1:9050   # via a local Tor client instead of the public proxies
+    python -m vpn.app.daemon --forward 127.0.0.1:1080   # + a local proxy over the hot proxies
+    python -m vpn.app.daemon --shards 4             # the top-ups probed in 4 processes (see shards.py)
+    curl '127.0.0.1:8765/servers?n=3&country=JP'
+    curl -x socks5h://127.0.0.1:1080 https://example.com
+'''
+
+import argparse, asyncio
+from pathlib import Path
+from urllib.parse import urlsplit
+
+from ..configs.logs import setup_logging
+from ..proxy.forward import ForwardProxy
+from ..proxy.tor import TorCircuits
+from ..vpn.get import vpn_sources
+from .service import HOST, PORT, Daemon, serve
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog="daemon", description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--unix", type=Path, default=None, help="serve on a Unix socket instead of TCP")
+    parser.add_argument("--tor", default=None, metavar="HOST:PORT", help="SOCKS port of a Tor client")
+    parser.add_argument("--forward", default=None, metavar="HOST:PORT",
+                        help="serve HTTP CONNECT + SOCKS5 there, tunnelled via the hot proxies")
+    parser.add_argument("--shards", type=int, default=None, help="probe in so many worker processes (default: in one)")
+    return parser.parse_args(argv)
+
+
+def main(argv: list[str] | None = None) -> None:
+    args = parse_args(argv)
+    setup_logging()
+    tor = forward = None
+    if args.tor is not None:
+        host, port = args.tor.rsplit(":", 1)
+        tor = TorCircuits(host, int(port))
+    if args.forward is not None:
+        host, port = args.forward.rsplit(":", 1)
+        url = urlsplit(next(iter(vpn_sources().values())))  # the hot proxies are verified against it
+        forward = ForwardProxy(host, int(port), check_target=(url.hostname, url.port or (443 if url.scheme == "https" else 80)))
+    daemon = Daemon(tor=tor, forward=forward, n_shards=args.shards)
+    try:
+        asyncio.run(serve(args.host, args.port, args.unix, daemon))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
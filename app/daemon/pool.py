@@ -0,0 +1,100 @@
+'''
+The hot pool of the daemon: verified proxies and reachable VPN servers kept in memory, ranked in advance.
+The refresh tasks replace the rankings as a whole, the API only slices them: a lookup is a list slice.
+'''
+
+import time
+from dataclasses import dataclass
+from typing import Iterable
+
+from ..proxy import health
+from ..proxy.table import Proxy
+from ..vpn.get import Verified
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# Constants
+MAX_PROXIES = 64   # verified proxies kept hot
+MAX_SERVERS = 20   # reachable VPN servers kept hot
+
+
+@dataclass(slots=True)
+class HotProxy:
+    proxy: Proxy
+    latency: float       # sec of the last successful probe
+    verified_at: float   # unix time
+
+    def to_dict(self) -> dict:
+        return {"proxy": health.key(self.proxy), "latency": self.latency, "verified_at": self.verified_at}
+
+
+@dataclass(slots=True)
+class HotServer:
+    host_name: str
+    rtt: float           # sec of the reachability probe, see prefilter()
+    verified_at: float
+    meta: dict           # catalog columns: CountryShort, IP, Score, ...
+    config: str          # decoded .ovpn
+
+    def to_dict(self) -> dict:
+        return {"HostName": self.host_name, **self.meta, "rtt": self.rtt, "verified_at": self.verified_at}
+
+
+class HotPool:
+
+    def __init__(self, max_proxies: int = MAX_PROXIES, max_servers: int = MAX_SERVERS) -> None:
+        self.max_proxies = max_proxies
+        self.max_servers = max_servers
+        self._proxies: dict[str, HotProxy] = dict()   # health.key(proxy): HotProxy
+        self._proxy_ranking: list[HotProxy] = []      # by latency
+        self._servers: dict[str, HotServer] = dict()  # HostName: HotServer
+        self._server_ranking: list[HotServer] = []    # by RTT
+
+    # proxies
+    def put_proxies(self, verified: Iterable[Verified]) -> None:
+        now = time.time()
+        for result in verified:
+            self._proxies[health.key(result.proxy)] = HotProxy(result.proxy, result.latency, now)
+        self._rank_proxies()
+
+    def drop_proxies(self, proxies: Iterable[Proxy]) -> None:
+        for proxy in proxies:
+            self._proxies.pop(health.key(proxy), None)
+        self._rank_proxies()
+
+    def proxies(self) -> list[Proxy]:
+        return [hot.proxy for hot in self._proxy_ranking]
+
+    def has_proxy(self, proxy: Proxy) -> bool:
+        return health.key(proxy) in self._proxies
+
+    def best_proxies(self, n: int = 1, protocol: str | None = None) -> list[HotProxy]:
+        if protocol is None:
+            return self._proxy_ranking[:n]
+        return [hot for hot in self._proxy_ranking if hot.proxy.protocol == protocol][:n]
+
+    def _rank_proxies(self) -> None:
+        ranking = sorted(self._proxies.values(), key=lambda hot: hot.latency)
+        for hot in ranking[self.max_proxies:]:  # the slowest ones don't fit
+            del self._proxies[health.key(hot.proxy)]
+        self._proxy_ranking = ranking[:self.max_proxies]
+
+    # servers
+    def set_servers(self, servers: Iterable[HotServer]) -> None:
+        ranking = sorted(servers, key=lambda hot: hot.rtt)[:self.max_servers]
+        self._servers = {hot.host_name: hot for hot in ranking}
+        self._server_ranking = ranking
+
+    def best_servers(self, n: int = 1, country: str | None = None) -> list[HotServer]:
+        if country is None:
+            return self._server_ranking[:n]
+        country = country.upper()
+        return [hot for hot in self._server_ranking if hot.meta.get("CountryShort") == country][:n]
+
+    def server(self, host_name: str) -> HotServer | None:
+        return self._servers.get(host_name)
+
+    def status(self) -> dict:
+        return {"proxies": len(self._proxy_ranking), "servers": len(self._server_ranking)}
@@ -0,0 +1,278 @@
+'''
+The refresh daemon: instead of paying the whole fetch → parse → probe pipeline per run, it keeps the HotPool
+up to date in the background and serves it over a local HTTP API (TCP on localhost or a Unix socket).
+  - every PROXY_REFRESH sec: the hot proxies are re-verified, the dead ones dropped, the pool topped up from
+    the sources (incremental: the source cache revalidates with ETag / If-Modified-Since);
+    the VPN lists the probes got refresh the catalog once it's older than CATALOG_MAX_AGE;
+  - every SERVER_REFRESH sec and after each catalog update: the servers are re-probed, see prefilter().
+The ServerRanking gets only the diff of each catalog update and every measured RTT: /ranking is a cached slice.
+With `tor` the pool is topped up from the Tor circuits instead of the public lists, the warm circuits are
+reused by the next refreshes (see TorCircuits).
+With `forward` the hot proxies are also the upstreams of a local HTTP CONNECT + SOCKS5 proxy, see forward.py.
+At the start the state of the last run is restored (see warm.py): its catalog is served until the first refresh.
+'''
+
+import asyncio, json, time
+from pathlib import Path
+from typing import Awaitable, Callable, Mapping
+
+import polars as pl
+from aiohttp import web
+
+from ..configs.dns import dns
+from ..configs.metrics import metrics
+from ..proxy.forward import ForwardProxy
+from ..proxy.get import proxy_sources, stream_proxies
+from ..proxy.health import HEALTH_STATE
+from ..proxy.table import ProxyTable
+from ..proxy.tor import TorCircuits
+from ..vpn.catalog import Catalog, CATALOG_MAX_AGE, META_COLUMNS
+from ..vpn.connect import prefilter
+from ..vpn.get import probe_proxies, vpn_sources
+from ..vpn.warm import restore
+from ..vpn.mirrors import merge_servers
+from ..vpn.ranking import ServerRanking
+from ..vpn.shards import probe_sharded
+from .pool import HotPool, HotServer
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# Constants
+PROXY_REFRESH = 5 * 60     # sec between the proxy refreshes
+SERVER_REFRESH = 10 * 60   # sec between the server re-probes
+RETRY_DELAY = 30           # sec before the next try if a refresh failed or found nothing
+HOST, PORT = "127.0.0.1", 8765
+DEFAULT_N = 1              # items per lookup if `?n=` isn't given
+MAX_N = 1000
+
+
+class Daemon:
+
+    def __init__(self, pool: HotPool | None = None, proxy_refresh: float = PROXY_REFRESH,
+                 server_refresh: float = SERVER_REFRESH, catalog_max_age: float = CATALOG_MAX_AGE,
+                 proxy_sources: Mapping[str, str] | None = None, vpn_sources: Mapping[str, str] | None = None,
+                 tor: TorCircuits | None = None, forward: ForwardProxy | None = None,
+                 n_shards: int | None = None) -> None:
+        self.pool = pool or HotPool()
+        self.catalog: Catalog | None = None
+        self.ranking = ServerRanking()
+        self.refreshed_at: dict[str, float] = dict()   # job: unix time of the last successful refresh
+        self._proxy_refresh = proxy_refresh
+        self._server_refresh = server_refresh
+        self._catalog_max_age = catalog_max_age
+        self._proxy_sources = proxy_sources
+        self._vpn_sources = vpn_sources
+        self._tor = tor
+        self._n_shards = n_shards   # the top-ups from the public sources are probed in so many processes (see shards.py)
+        self.forward = forward
+        self._health_state = None if tor is not None else HEALTH_STATE  # the circuits' health isn't kept, see tor.py
+        self._catalog_updated = asyncio.Event()
+        self._warm_proxies: ProxyTable | None = None  # the table of the last run: the first top-up needs no fetch
+
+    async def run(self) -> None:
+        '''Refresh forever (until cancelled)'''
+        state = restore(self._catalog_max_age)  # a stale catalog is served as well until the first refresh
+        self.catalog, self._warm_proxies = state.catalog, state.proxies
+        if self.catalog is not None:
+            self.ranking.apply(self.catalog)
+            self._catalog_updated.set()  # the servers of the last run are served right away
+
+        jobs = [
+            dns.prefetch([*(self._proxy_sources or proxy_sources()).values(), *(self._vpn_sources or vpn_sources()).values()]),
+            _every(self._proxy_refresh, self.refresh_proxies, wake=None),
+            _every(self._server_refresh, self.refresh_servers, wake=self._catalog_updated),
+        ]
+        if self.forward is not None:
+            await self.forward.start()
+        try:
+            await asyncio.gather(*jobs)
+        finally:
+            if self.forward is not None:
+                await self.forward.stop()
+            dns.save()  # the answers looked up along the way, for the next start
+
+    async def refresh_proxies(self) -> bool:
+        # 1. re-verify the hot proxies: the dead ones leave the pool
+        hot = self.pool.proxies()
+        alive = await probe_proxies(hot, goal=len(hot), sources=self._vpn_sources, health_state=self._health_state) if hot else []
+        self.pool.drop_proxies(hot)
+        self.pool.put_proxies(alive)
+
+        # 2. top up from the sources; a new table each time: the proxies that left the lists leave the table
+        fresh = []
+        if (need := self.pool.max_proxies - len(alive)) > 0:
+            if self._tor is not None:
+                url = next(iter((self._vpn_sources or vpn_sources()).values()))
+                table = None  # the circuits aren't detected: they are SOCKS5
+                candidates = [proxy for proxy in await self._tor.fastest(url) if not self.pool.has_proxy(proxy)]
+            elif self._warm_proxies is not None:
+                table, self._warm_proxies = self._warm_proxies, None
+                candidates = [proxy for proxy in table.probes() if not self.pool.has_proxy(proxy)]
+            else:
+                table = ProxyTable()
+                candidates = (proxy async for proxy in stream_proxies(table, self._proxy_sources)
+                              if not self.pool.has_proxy(proxy))
+            if self._n_shards and self._tor is None:
+                fresh = await probe_sharded(candidates, goal=need, n_shards=self._n_shards, sources=self._vpn_sources,
+                                            health_state=self._health_state, table=table)
+            else:
+                fresh = await probe_proxies(candidates, goal=need, sources=self._vpn_sources,
+                                            health_state=self._health_state, table=table)
+            self.pool.put_proxies(fresh)
+
+        if self.forward is not None:
+            self.forward.set_upstreams((hot.proxy, hot.latency) for hot in self.pool.best_proxies(self.pool.max_proxies))
+        self.refreshed_at["proxies"] = time.time()
+        logger.info(f"🔄 Proxies: {len(alive)}/{len(hot)} still alive, {len(fresh)} new; {self.pool.status()}")
+
+        # 3. every verified probe has downloaded the VPN list: a free catalog update
+        if (verified := alive + fresh) and (self.catalog is None or not self.catalog.is_fresh(self._catalog_max_age)):
+            self.catalog = Catalog.from_rows(merge_servers(result.servers for result in verified))
+            await asyncio.to_thread(self.catalog.save)
+            diff = self.ranking.apply(self.catalog)
+            self.refreshed_at["catalog"] = time.time()
+            self._catalog_updated.set()
+            logger.info(f"📦 Catalog updated: {len(self.catalog)} servers, "
+                        f"+{len(diff.added)} -{len(diff.removed)} ~{len(diff.changed)}")
+
+        return bool(verified)
+
+    async def refresh_servers(self) -> bool:
+        if self.catalog is None:
+            return False
+
+        endpoints = self.catalog.endpoints()
+        reachable = await prefilter(endpoints, top=len(endpoints))
+        rtts = {host_name: rtt for rtt, host_name in reachable}
+        for host_name in endpoints:
+            self.ranking.measured(host_name, rtts.get(host_name))
+
+        reachable = reachable[:self.pool.max_servers]
+        hosts = pl.col("HostName").is_in([host_name for _, host_name in reachable])
+        meta = {row["HostName"]: row for row in self.catalog.servers(hosts, columns=META_COLUMNS).iter_rows(named=True)}
+        configs = self.catalog.configs(hosts)  # only the pool's are decoded
+
+        now = time.time()
+        self.pool.set_servers(HotServer(host_name, rtt, now, meta.get(host_name, {}), configs[host_name])
+                              for rtt, host_name in reachable if host_name in configs)
+        self.refreshed_at["servers"] = now
+        logger.info(f"🔄 Servers: {len(rtts)} reachable of {len(endpoints)}")
+        return bool(reachable)
+
+    def status(self) -> dict:
+        return {
+            **self.pool.status(),
+            "catalog_servers": len(self.catalog) if self.catalog is not None else 0,
+            "catalog_age": self.catalog.age() if self.catalog is not None else None,
+            "refreshed_at": self.refreshed_at,
+            "forward": self.forward.status() if self.forward is not None else None,
+        }
+
+
+async def _every(period: float, job: Callable[[], Awaitable[bool]], wake: asyncio.Event | None) -> None:
+    '''Run the job now and every `period` sec (RETRY_DELAY after a failure); `wake` starts it earlier'''
+    while True:
+        if wake is not None:
+            wake.clear()
+        try:
+            with metrics.stage(f"daemon:{job.__name__}"):
+                ok = await job()
+        except Exception:
+            logger.exception(f"❌ Daemon job {job.__name__} failed")
+            ok = False
+
+        delay = period if ok else RETRY_DELAY
+        if wake is None:
+            await asyncio.sleep(delay)
+            continue
+        try:
+            await asyncio.wait_for(wake.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
+
+
+def make_app(daemon: Daemon) -> web.Application:
+    """
+    GET /proxies?n=&protocol=      the best verified proxies
+    GET /servers?n=&country=       the best reachable VPN servers
+    GET /ranking?n=&country=&metric=   the best servers of the catalog: blend (default), score, speed, ping, sessions
+    GET /servers/<HostName>.ovpn   the config of a hot server
+    GET /upstreams                 the upstreams of the forward proxy: latency, error rate, tunnels, ejected
+    GET /status                    sizes of the pool, catalog age, last refreshes
+    GET /metrics                   Prometheus text, see Metrics
+    """
+    pool = daemon.pool
+
+    async def proxies(request: web.Request) -> web.Response:
+        hot = pool.best_proxies(_n(request), request.query.get("protocol"))
+        return _json([item.to_dict() for item in hot])
+
+    async def servers(request: web.Request) -> web.Response:
+        hot = pool.best_servers(_n(request), request.query.get("country"))
+        return _json([item.to_dict() for item in hot])
+
+    async def ranking(request: web.Request) -> web.Response:
+        try:
+            best = daemon.ranking.best(_n(request), request.query.get("country"), request.query.get("metric", "blend"))
+        except ValueError as e:
+            raise web.HTTPBadRequest(text=str(e))
+        return _json([daemon.ranking.row(host_name) for host_name in best])
+
+    async def config(request: web.Request) -> web.Response:
+        if (hot := pool.server(request.match_info["host_name"])) is None:
+            raise web.HTTPNotFound(text="Not a hot server: see /servers")
+        return web.Response(text=hot.config, content_type="application/x-openvpn-profile")
+
+    async def upstreams(request: web.Request) -> web.Response:
+        if daemon.forward is None:
+            raise web.HTTPNotFound(text="No forward proxy: see --forward")
+        return _json(daemon.forward.upstreams())
+
+    async def status(request: web.Request) -> web.Response:
+        return _json(daemon.status())
+
+    async def prometheus(request: web.Request) -> web.Response:
+        return web.Response(text=metrics.to_prometheus(), content_type="text/plain")
+
+    app = web.Application()
+    app.router.add_get("/proxies", proxies)
+    app.router.add_get("/servers", servers)
+    app.router.add_get("/servers/{host_name}.ovpn", config)
+    app.router.add_get("/ranking", ranking)
+    app.router.add_get("/upstreams", upstreams)
+    app.router.add_get("/status", status)
+    app.router.add_get("/metrics", prometheus)
+    return app
+
+
+async def serve(host: str = HOST, port: int = PORT, unix_path: Path | None = None, daemon: Daemon | None = None) -> None:
+    '''Run the daemon and its API until cancelled (Ctrl+C)'''
+    daemon = daemon or Daemon()
+    runner = web.AppRunner(make_app(daemon), access_log=None)
+    await runner.setup()
+
+    if unix_path is not None:
+        unix_path.unlink(missing_ok=True)  # left by a killed daemon
+        site = web.UnixSite(runner, str(unix_path))
+    else:
+        site = web.TCPSite(runner, host, port)
+    await site.start()
+    logger.info(f"🚀 Daemon API on {unix_path or f'http://{host}:{port}'}")
+
+    try:
+        await daemon.run()
+    finally:
+        await runner.cleanup()
+
+
+def _n(request: web.Request) -> int:
+    try:
+        return max(0, min(MAX_N, int(request.query.get("n", DEFAULT_N))))
+    except ValueError:
+        raise web.HTTPBadRequest(text="n must be an integer")
+
+
+def _json(data) -> web.Response:
+    return web.Response(text=json.dumps(data), content_type="application/json")
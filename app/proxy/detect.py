@@ -0,0 +1,179 @@
+'''
+Protocol detection: one TCP connection and one round-trip per proxy tell SOCKS5, SOCKS4 and HTTP apart, so the
+vpngate fetch goes only through proxies of a known protocol. Without it a row of UNKNOWN protocol (the spys.me
+SOCKS list) costs a fetch as SOCKS5 and another one as SOCKS4, and a mislabeled proxy fails its only fetch.
+The probe is the SOCKS5 greeting (05 01 00: one method, no auth) and an empty line; the answer decides:
+    05 00         SOCKS5 (the empty line is read as a bad request only after the answer)
+    05 xx         SOCKS5 that wants a password: not usable
+    00 5a..5d     SOCKS4: it answers the version 5 with a SOCKS4 reply
+    HTTP/         HTTP: the empty line ends a bad request, the proxy answers 400 or so
+    nothing       no verdict (e.g. a SOCKS4 server drops the bad version): the label is kept
+The verdict is cached in the ProxyTable (the protocol column + Flag.DETECTED) and saved with its snapshot.
+'''
+
+import asyncio
+from collections import deque
+from typing import TYPE_CHECKING, AsyncIterable, AsyncIterator, Iterable
+
+from ..configs.metrics import metrics
+from ..utils.scheduler import aiterate
+from .health import key
+from .table import Flag, Protocol, Proxy, ProxyTable
+
+if TYPE_CHECKING:
+    from .health import HealthStore
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# Constants
+PROBE = b"\x05\x01\x00\r\n\r\n"
+ANSWER_BYTES = 5           # len(b"HTTP/"); a SOCKS answer is told by 2 bytes
+DETECT_TIMEOUT = 5         # sec for the connect and as much for the answer: a fetch waits TIMEOUT_GET_RAW_VPN
+DETECT_IN_FLIGHT = 256     # connections at once: they are short, but every one is a file descriptor
+REORDER_HOLD = 0.25        # sec a verdict may wait for the slower ones before it: half the wave delay of race()
+SOCKS4_REPLIES = range(0x5A, 0x5E)
+
+
+async def detect(ip_port: str, timeout: float = DETECT_TIMEOUT) -> Protocol | None:
+    '''The protocol the proxy speaks; UNKNOWN: it connects but gives no verdict; None: dead or not usable'''
+    host, port = ip_port.rsplit(":", 1)
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(host, int(port)), timeout)
+    except (OSError, asyncio.TimeoutError):
+        metrics.count("protocol_detect", "dead")
+        return None
+
+    answer = bytearray()  # a partial answer is kept when the proxy stops talking
+
+    async def read() -> None:  # until the verdict: a SOCKS server waits for the rest of its request
+        while not _told(answer) and (chunk := await reader.read(ANSWER_BYTES - len(answer))):
+            answer.extend(chunk)
+
+    try:
+        writer.write(PROBE)
+        await asyncio.wait_for(read(), timeout)
+    except (OSError, asyncio.TimeoutError):
+        pass
+    finally:
+        writer.close()
+
+    protocol = classify(bytes(answer))
+    metrics.count("protocol_detect", "unusable" if protocol is None else "no_verdict" if not protocol else str(protocol))
+    return protocol
+
+
+def classify(answer: bytes) -> Protocol | None:
+    '''Protocol by the first bytes of the answer to PROBE, see the module doc'''
+    if len(answer) < 2:
+        return Protocol.UNKNOWN
+    if answer[0] == 0x05:
+        return Protocol.SOCKS5 if answer[1] == 0x00 else None
+    if answer[0] == 0x00 and answer[1] in SOCKS4_REPLIES:
+        return Protocol.SOCKS4
+    if answer.startswith(b"HTTP/"[:len(answer)]):
+        return Protocol.HTTP
+    return None  # something else listens there: SSH, a web server, ...
+
+
+def _told(answer: bytes) -> bool:
+    return len(answer) >= ANSWER_BYTES or (len(answer) >= 2 and answer[0] in (0x00, 0x05))
+
+
+async def detect_protocols(proxies: Iterable[Proxy] | AsyncIterable[Proxy], table: ProxyTable,
+                           max_in_flight: int = DETECT_IN_FLIGHT,
+                           timeout: float = DETECT_TIMEOUT,
+                           health: "HealthStore | None" = None,
+                           hold: float = REORDER_HOLD) -> AsyncIterator[Proxy]:
+    """
+    The proxies to probe with their detected protocols, in the input order (the health ranking, the waves of race()):
+    a verdict that is in waits for the slower ones before it, `hold` sec at most. The dead ones are dropped.
+    A row is detected once: the SOCKS4 and SOCKS5 probes of an UNKNOWN row (see ProxyTable.probes) become one.
+    The rows detected before (Flag.DETECTED) and the proxies not from the table pass straight through.
+    health: the history of a relabeled proxy moves to its detected protocol, where the probe records it.
+    """
+    loop = asyncio.get_running_loop()
+    order: deque[asyncio.Future] = deque()  # the verdicts in the input order
+    changed = asyncio.Event()
+    slots = asyncio.Semaphore(max_in_flight)
+    detecting: set[asyncio.Task] = set()
+    ready_at: dict[asyncio.Future, float] = dict()  # the verdicts in `order` that are in: since when
+
+    def settle(verdict: asyncio.Future, proxy: Proxy | None) -> None:
+        verdict.set_result(proxy)
+        ready_at[verdict] = loop.time()
+        changed.set()
+
+    async def detect_row(proxy: Proxy, verdict: asyncio.Future) -> None:
+        try:
+            detected = _verdict(table, proxy, await detect(proxy.ip_port, timeout))
+            if health is not None and detected is not None and detected.protocol != proxy.protocol:
+                health.rekey(key(proxy), key(detected))
+            settle(verdict, detected)
+        except Exception:
+            logger.exception(f"❌ Detecting the protocol of {proxy.ip_port} failed")
+            settle(verdict, None)  # the row is dropped, the stream goes on
+        finally:
+            slots.release()
+
+    async def feed() -> None:
+        seen: set[int] = set()
+        try:
+            async for proxy in aiterate(proxies):
+                if proxy.row is None or table.flags[proxy.row] & Flag.DETECTED:
+                    order.append(verdict := loop.create_future())
+                    settle(verdict, proxy)
+                elif proxy.row not in seen:
+                    seen.add(proxy.row)
+                    order.append(verdict := loop.create_future())
+                    await slots.acquire()
+                    task = asyncio.create_task(detect_row(proxy, verdict))
+                    detecting.add(task)
+                    task.add_done_callback(detecting.discard)
+        except Exception:
+            logger.exception("❌ The proxies to detect failed")
+        await asyncio.gather(*detecting, return_exceptions=True)
+        changed.set()
+
+    feeder = asyncio.create_task(feed())
+    try:
+        while order or not feeder.done():
+            if order and order[0].done():
+                verdict = order.popleft()
+            elif ready_at and (wait := min(ready_at.values()) + hold - loop.time()) <= 0:
+                # held long enough: the ready ones overtake the slower ones, still in the input order
+                verdict = next(verdict for verdict in order if verdict.done())
+                order.remove(verdict)
+            else:
+                changed.clear()
+                try:
+                    await asyncio.wait_for(changed.wait(), wait if ready_at else None)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            del ready_at[verdict]
+            if (proxy := verdict.result()) is not None:
+                yield proxy
+    finally:  # the probing is over (e.g. the goal is met): the detection too
+        for task in (feeder, *detecting):
+            task.cancel()
+        await asyncio.gather(feeder, *detecting, return_exceptions=True)
+
+
+def _verdict(table: ProxyTable, proxy: Proxy, protocol: Protocol | None) -> Proxy | None:
+    '''Cache the detected protocol in the table; the proxy to probe, None if it isn't worth a fetch'''
+    row = proxy.row
+    if protocol is None:
+        return None
+    if not protocol:  # no verdict: the label is kept, and an unlabeled row isn't SOCKS5 (it would have answered)
+        return Proxy(str(Protocol(table.protocol[row]) if table.protocol[row] else Protocol.SOCKS4), proxy.ip_port, row)
+
+    if protocol == Protocol.HTTP and table.protocol[row] == Protocol.HTTPS:
+        protocol = Protocol.HTTPS  # the same CONNECT proxy
+    elif table.protocol[row] and protocol != table.protocol[row]:
+        metrics.count("protocol_detect", "relabeled")
+    table.protocol[row] = protocol
+    table.flags[row] |= Flag.DETECTED
+    return Proxy(str(protocol), proxy.ip_port, row)
+
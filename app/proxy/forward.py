@@ -0,0 +1,436 @@
+'''
+Local forward proxy: HTTP CONNECT and SOCKS5 on one localhost port (told by the first byte), each client connection
+is tunnelled through one of the verified upstream proxies (the daemon's HotPool), so an application gets one stable
+egress instead of a single fragile free proxy.
+  - balancing: the power of two choices by cost = latency EWMA x (open tunnels + 1); the upstreams with a warm
+    connection go first;
+  - warm connections: the WARM_UPSTREAMS cheapest upstreams keep WARM_PER_UPSTREAM connections open with the
+    per-proxy part of the handshake done (TCP; the SOCKS5 greeting and auth), so a client pays only the CONNECT
+    round-trip to its target; a warm connection older than WARM_MAX_AGE is replaced (proxies drop idle sockets),
+    one dropped sooner is retried cold once, not held against the upstream;
+  - self-healing: an upstream whose error rate EWMA passes EJECT_ERROR_RATE, or whose latency EWMA is over
+    EJECT_LATENCY_FACTOR x the median, is ejected for EJECT_TIME (doubled on each ejection in a row); a failed
+    tunnel is retried via another upstream; every HEALTH_INTERVAL sec each upstream, the ejected ones too, opens
+    a tunnel to the check target: a success readmits an ejected upstream once its time is out.
+A refusal by a working upstream (the target is down?) isn't held against it, the failed connects and timeouts are.
+'''
+
+import asyncio, ipaddress, random, statistics, time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Iterable
+
+from ..configs.metrics import metrics
+from . import health
+from .table import Proxy
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# Constants
+HOST, PORT = "127.0.0.1", 1080
+CHECK_TARGET = ("www.vpngate.net", 443)   # the hot proxies are verified against it
+CONNECT_TIMEOUT = 10       # sec for an upstream to open a tunnel
+CONNECT_ATTEMPTS = 3       # upstreams tried per client connection
+WARM_UPSTREAMS = 8         # the cheapest upstreams keep warm connections ...
+WARM_PER_UPSTREAM = 2      # ... so many each
+WARM_MAX_AGE = 15          # sec: free proxies close idle connections, a SOCKS5 one waits for its request
+WARM_CHECK = 5             # sec between the sweeps of the warm connections
+HEALTH_INTERVAL = 30       # sec between the health checks
+HEALTH_IN_FLIGHT = 32      # checks at once
+EWMA_ALPHA = 0.3           # weight of the newest sample
+MIN_SAMPLES = 3            # outcomes before an upstream can be ejected
+EJECT_ERROR_RATE = 0.5
+EJECT_LATENCY_FACTOR = 3.0
+MIN_LATENCY_PEERS = 3      # upstreams in rotation needed to call one of them slow
+EJECT_TIME = 30            # sec, doubled for each ejection in a row ...
+MAX_EJECT_TIME = 15 * 60   # ... up to
+HEAD_LIMIT = 16 * 1024     # bytes of a client's CONNECT request
+CHUNK_SIZE = 64 * 1024
+
+SOCKS5_OK, SOCKS5_FAILURE, SOCKS5_NOT_SUPPORTED = 0x00, 0x01, 0x07
+
+
+class TunnelError(Exception):
+    '''The upstream answered but didn't open the tunnel'''
+
+
+@dataclass(slots=True, eq=False)
+class Upstream:
+    proxy: Proxy
+    latency: float                # sec, EWMA of the tunnel setups
+    error_rate: float = 0.0       # EWMA of the failures (1) and successes (0)
+    n_samples: int = 0
+    active: int = 0               # client tunnels open
+    warm: deque = field(default_factory=deque)  # (reader, writer, opened at)
+    opening: int = 0              # warm connections on the way
+    ejected_until: float = 0.0    # monotonic time; 0: in rotation
+    n_ejections: int = 0          # in a row
+
+    def cost(self) -> float:
+        return self.latency * (self.active + 1)
+
+    def ejected(self) -> bool:
+        return self.ejected_until > 0
+
+    def to_dict(self) -> dict:
+        return {"proxy": health.key(self.proxy), "latency": self.latency, "error_rate": self.error_rate,
+                "active": self.active, "warm": len(self.warm), "ejected": self.ejected()}
+
+
+class ForwardProxy:
+
+    def __init__(self, host: str = HOST, port: int = PORT, check_target: tuple[str, int] = CHECK_TARGET) -> None:
+        self.host, self.port = host, port
+        self.check_target = check_target
+        self._upstreams: dict[str, Upstream] = dict()  # health.key(proxy): Upstream
+        self._server: asyncio.Server | None = None
+        self._tasks: list[asyncio.Task] = []
+        self._warming: set[asyncio.Task] = set()
+        self._refill = asyncio.Event()
+
+    async def start(self) -> None:
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        self._tasks = [asyncio.create_task(self._keep_warm()), asyncio.create_task(self._check_health())]
+        logger.info(f"🔀 Forward proxy (HTTP CONNECT, SOCKS5) on {self.host}:{self.port}")
+
+    async def stop(self) -> None:
+        if self._server is not None:
+            self._server.close()
+        for task in (*self._tasks, *self._warming):
+            task.cancel()
+        await asyncio.gather(*self._tasks, *self._warming, return_exceptions=True)
+        for upstream in self._upstreams.values():
+            _close_warm(upstream)
+        if self._server is not None:
+            await self._server.wait_closed()
+
+    def set_upstreams(self, proxies: Iterable[tuple[Proxy, float]]) -> None:
+        '''(proxy, latency of its verification): the known upstreams keep their stats, the missing ones leave'''
+        upstreams = dict()
+        for proxy, latency in proxies:
+            proxy_key = health.key(proxy)
+            upstreams[proxy_key] = self._upstreams.get(proxy_key) or Upstream(proxy, latency)
+        for proxy_key, upstream in self._upstreams.items():
+            if proxy_key not in upstreams:
+                _close_warm(upstream)  # its open tunnels run till their end
+        self._upstreams = upstreams
+        self._refill.set()
+        logger.debug(f"🔀 Forward proxy: {len(upstreams)} upstreams")
+
+    def status(self) -> dict:
+        upstreams = self._upstreams.values()
+        return {"upstreams": len(upstreams), "ejected": sum(upstream.ejected() for upstream in upstreams),
+                "active": sum(upstream.active for upstream in upstreams),
+                "warm": sum(len(upstream.warm) for upstream in upstreams)}
+
+    def upstreams(self) -> list[dict]:
+        return [upstream.to_dict() for upstream in sorted(self._upstreams.values(), key=Upstream.cost)]
+
+    # clients
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            if (first := await reader.readexactly(1)) == b"\x05":
+                await self._socks5_client(reader, writer)
+            else:
+                await self._http_client(first, reader, writer)
+        except (OSError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def _socks5_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        await reader.readexactly((await reader.readexactly(1))[0])  # the methods: "no auth" is the only one offered
+        writer.write(b"\x05\x00")
+        _, cmd, _, atyp = await reader.readexactly(4)
+        match atyp:
+            case 1:
+                host = str(ipaddress.IPv4Address(await reader.readexactly(4)))
+            case 3:
+                host = (await reader.readexactly((await reader.readexactly(1))[0])).decode("idna")
+            case 4:
+                host = str(ipaddress.IPv6Address(await reader.readexactly(16)))
+            case _:
+                raise ValueError(f"SOCKS5 address type {atyp}")
+        port = int.from_bytes(await reader.readexactly(2), "big")
+        if cmd != 1:  # only CONNECT: BIND and UDP ASSOCIATE make no sense through a chain
+            writer.write(_socks5_reply(SOCKS5_NOT_SUPPORTED))
+            return
+
+        if (tunnel := await self._open_tunnel(host, port)) is None:
+            writer.write(_socks5_reply(SOCKS5_FAILURE))
+            return
+        writer.write(_socks5_reply(SOCKS5_OK))
+        await self._relay(reader, writer, *tunnel)
+
+    async def _http_client(self, first: bytes, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        head = first + await reader.readuntil(b"\r\n\r\n")
+        if len(head) > HEAD_LIMIT:
+            raise ValueError("Too long a request head")
+        method, target, _ = head.split(b"\r\n", 1)[0].decode("latin-1").split(" ", 2)
+        if method != "CONNECT":
+            writer.write(b"HTTP/1.1 405 Method Not Allowed\r\nAllow: CONNECT\r\nConnection: close\r\n\r\n")
+            return
+        host, port = target.rsplit(":", 1)
+
+        if (tunnel := await self._open_tunnel(host.strip("[]"), int(port))) is None:
+            writer.write(b"HTTP/1.1 502 Bad Gateway\r\nConnection: close\r\n\r\n")
+            return
+        writer.write(b"HTTP/1.1 200 Connection established\r\n\r\n")
+        await self._relay(reader, writer, *tunnel)
+
+    async def _open_tunnel(self, host: str, port: int) -> tuple[Upstream, asyncio.StreamReader, asyncio.StreamWriter] | None:
+        '''A tunnel to host:port via up to CONNECT_ATTEMPTS upstreams; None if none of them made it'''
+        tried: set[Upstream] = set()
+        for attempt in range(CONNECT_ATTEMPTS):
+            if (upstream := self._pick(tried)) is None:
+                break
+            tried.add(upstream)
+            if attempt:
+                metrics.count("forward", "retried")
+            start, conn = time.monotonic(), None
+            try:
+                if (conn := self._take_warm(upstream)) is not None:
+                    try:
+                        await asyncio.wait_for(_connect(upstream.proxy, *conn, host, port), CONNECT_TIMEOUT)
+                    except (ConnectionError, asyncio.IncompleteReadError):  # stale: the proxy dropped it while idle
+                        _close(conn)
+                        conn = None
+                        metrics.count("forward", "stale")
+                if conn is None:  # cold, or once more after a stale warm one: that isn't the upstream's error
+                    conn = await asyncio.wait_for(_open_upstream(upstream.proxy), CONNECT_TIMEOUT)
+                    await asyncio.wait_for(_connect(upstream.proxy, *conn, host, port), CONNECT_TIMEOUT)
+            except TunnelError:
+                _close(conn)
+                metrics.count("forward", "refused")
+                continue
+            except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError, ValueError):
+                if conn is not None:
+                    _close(conn)
+                self._record(upstream, None)
+                continue
+            self._record(upstream, time.monotonic() - start)
+            metrics.observe("forward_connect_seconds", time.monotonic() - start)
+            return upstream, *conn
+
+        metrics.count("forward", "failed")
+        return None
+
+    async def _relay(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, upstream: Upstream,
+                     up_reader: asyncio.StreamReader, up_writer: asyncio.StreamWriter) -> None:
+        '''Both directions until both sides are done: EOF is passed on, an error closes both'''
+        upstream.active += 1
+        pipes = {asyncio.create_task(_pipe(reader, up_writer)), asyncio.create_task(_pipe(up_reader, writer))}
+        try:
+            await asyncio.wait(pipes, return_when=asyncio.FIRST_EXCEPTION)
+        finally:
+            upstream.active -= 1
+            for pipe in pipes:
+                pipe.cancel()
+            await asyncio.gather(*pipes, return_exceptions=True)
+            up_writer.close()
+
+    # upstreams
+    def _pick(self, tried: set[Upstream]) -> Upstream | None:
+        '''The power of two choices among the upstreams in rotation (the warm ones if any are)'''
+        candidates = [upstream for upstream in self._upstreams.values() if not upstream.ejected() and upstream not in tried]
+        if not candidates:  # all ejected: the one that comes back first beats nothing
+            ejected = [upstream for upstream in self._upstreams.values() if upstream not in tried]
+            return min(ejected, key=lambda upstream: upstream.ejected_until, default=None)
+        candidates = [upstream for upstream in candidates if upstream.warm] or candidates
+        return min(random.sample(candidates, min(2, len(candidates))), key=Upstream.cost)
+
+    def _take_warm(self, upstream: Upstream) -> tuple[asyncio.StreamReader, asyncio.StreamWriter] | None:
+        while upstream.warm:
+            reader, writer, opened_at = upstream.warm.popleft()
+            if not reader.at_eof() and time.monotonic() - opened_at < WARM_MAX_AGE:
+                metrics.count("forward", "warm")
+                self._refill.set()
+                return reader, writer
+            writer.close()
+        metrics.count("forward", "cold")
+        return None
+
+    def _record(self, upstream: Upstream, latency: float | None) -> None:
+        '''An outcome of a tunnel setup: a failure (None) or a slow latency can eject the upstream'''
+        upstream.n_samples += 1
+        upstream.error_rate += EWMA_ALPHA * ((latency is None) - upstream.error_rate)
+        if latency is not None:
+            upstream.latency += EWMA_ALPHA * (latency - upstream.latency)
+        if upstream.ejected() or upstream.n_samples < MIN_SAMPLES:
+            return
+
+        if upstream.error_rate > EJECT_ERROR_RATE:
+            self._eject(upstream, f"error rate {upstream.error_rate:.2f}")
+        elif len(peers := [other.latency for other in self._upstreams.values() if not other.ejected()]) >= MIN_LATENCY_PEERS \
+                and upstream.latency > EJECT_LATENCY_FACTOR * statistics.median(peers):
+            self._eject(upstream, f"latency {upstream.latency:.2f} s")
+
+    def _eject(self, upstream: Upstream, reason: str) -> None:
+        eject_time = min(MAX_EJECT_TIME, EJECT_TIME * 2 ** upstream.n_ejections)
+        upstream.ejected_until = time.monotonic() + eject_time
+        upstream.n_ejections += 1
+        _close_warm(upstream)
+        self._refill.set()
+        metrics.count("forward", "ejected")
+        logger.info(f"⏏️ Upstream {health.key(upstream.proxy)} ejected for {eject_time} s: {reason}")
+
+    def _readmit(self, upstream: Upstream) -> None:
+        upstream.ejected_until = 0.0
+        upstream.error_rate, upstream.n_samples = 0.0, 0  # a clean slate: the old failures ejected it already
+        metrics.count("forward", "readmitted")
+        logger.info(f"🔁 Upstream {health.key(upstream.proxy)} readmitted")
+
+    async def _keep_warm(self) -> None:
+        '''Keep WARM_PER_UPSTREAM fresh connections to each of the WARM_UPSTREAMS cheapest upstreams'''
+        while True:
+            self._refill.clear()
+            in_rotation = sorted((upstream for upstream in self._upstreams.values() if not upstream.ejected()), key=Upstream.cost)
+            warmed = set(in_rotation[:WARM_UPSTREAMS])
+            for upstream in self._upstreams.values():
+                while upstream.warm and (upstream.warm[0][0].at_eof() or time.monotonic() - upstream.warm[0][2] >= WARM_MAX_AGE):
+                    upstream.warm.popleft()[1].close()
+                if upstream not in warmed:
+                    _close_warm(upstream)
+                    continue
+                for _ in range(WARM_PER_UPSTREAM - len(upstream.warm) - upstream.opening):
+                    upstream.opening += 1
+                    task = asyncio.create_task(self._warm_up(upstream))  # short: bounded by CONNECT_TIMEOUT
+                    self._warming.add(task)
+                    task.add_done_callback(self._warming.discard)
+            try:
+                await asyncio.wait_for(self._refill.wait(), WARM_CHECK)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _warm_up(self, upstream: Upstream) -> None:
+        try:
+            reader, writer = await asyncio.wait_for(_open_upstream(upstream.proxy), CONNECT_TIMEOUT)
+        except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError, ValueError):
+            self._record(upstream, None)
+            return
+        finally:
+            upstream.opening -= 1
+        if upstream.ejected() or self._upstreams.get(health.key(upstream.proxy)) is not upstream:
+            writer.close()  # ejected or gone meanwhile
+        else:
+            upstream.warm.append((reader, writer, time.monotonic()))
+
+    async def _check_health(self) -> None:
+        '''Every HEALTH_INTERVAL sec: a tunnel to the check target via every upstream'''
+        slots = asyncio.Semaphore(HEALTH_IN_FLIGHT)
+
+        async def check(upstream: Upstream) -> None:
+            in_rotation = not upstream.ejected()
+            async with slots:
+                start, conn = time.monotonic(), None
+                try:
+                    conn = await asyncio.wait_for(_open_upstream(upstream.proxy), CONNECT_TIMEOUT)
+                    await asyncio.wait_for(_connect(upstream.proxy, *conn, *self.check_target), CONNECT_TIMEOUT)
+                    latency = time.monotonic() - start
+                except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError, ValueError, TunnelError):
+                    latency = None  # the check target is up: a refusal counts too
+                finally:
+                    if conn is not None:
+                        _close(conn)
+            if upstream.ejected() and latency is not None and time.monotonic() >= upstream.ejected_until:
+                self._readmit(upstream)
+            self._record(upstream, latency)
+            if latency is not None and in_rotation and not upstream.ejected():
+                upstream.n_ejections = 0  # a whole interval in rotation: the ejections aren't in a row any more
+
+        while True:
+            await asyncio.sleep(HEALTH_INTERVAL)
+            with metrics.stage("forward:health_check"):
+                await asyncio.gather(*(check(upstream) for upstream in list(self._upstreams.values())))
+            logger.debug(f"🩺 Forward proxy: {self.status()}")
+
+
+async def _open_upstream(proxy: Proxy) -> tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+    '''A connection to the proxy with the target-independent part of the handshake done'''
+    credentials, _, address = proxy.ip_port.rpartition("@")  # a Tor circuit: 'user:pass@host:port'
+    host, port = address.rsplit(":", 1)
+    reader, writer = await asyncio.open_connection(host, int(port))
+    try:
+        if proxy.protocol == "socks5":
+            if credentials:  # username/password (RFC 1929)
+                user, _, password = credentials.partition(":")
+                writer.write(b"\x05\x01\x02")
+                if await reader.readexactly(2) != b"\x05\x02":
+                    raise ValueError("SOCKS5 auth refused")
+                writer.write(b"\x01" + _pascal(user.encode()) + _pascal(password.encode()))
+                if (await reader.readexactly(2))[1] != 0:
+                    raise ValueError("SOCKS5 auth failed")
+            else:
+                writer.write(b"\x05\x01\x00")
+                if await reader.readexactly(2) != b"\x05\x00":
+                    raise ValueError("SOCKS5 wants auth")
+    except BaseException:
+        writer.close()
+        raise
+    return reader, writer
+
+
+async def _connect(proxy: Proxy, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, host: str, port: int) -> None:
+    '''Ask the proxy (see _open_upstream) for a tunnel to host:port; TunnelError if it refuses'''
+    match proxy.protocol:
+        case "socks5":
+            try:
+                address = ipaddress.ip_address(host)
+                addr = (b"\x01" if address.version == 4 else b"\x04") + address.packed
+            except ValueError:  # a name: resolved by the proxy
+                addr = b"\x03" + _pascal(host.encode("idna"))
+            writer.write(b"\x05\x01\x00" + addr + port.to_bytes(2, "big"))
+            _, status, _, atyp = await reader.readexactly(4)
+            if status != 0:
+                raise TunnelError(f"SOCKS5 status {status}")
+            await reader.readexactly({1: 4, 4: 16}.get(atyp) or (await reader.readexactly(1))[0])  # the bound address
+            await reader.readexactly(2)
+        case "socks4":
+            try:
+                ip = ipaddress.IPv4Address(host).packed
+                name = b""
+            except ValueError:  # SOCKS4a: the proxy resolves the name
+                ip, name = b"\x00\x00\x00\x01", host.encode("idna") + b"\x00"
+            writer.write(b"\x04\x01" + port.to_bytes(2, "big") + ip + b"\x00" + name)
+            _, status = await reader.readexactly(2)
+            if status != 0x5A:
+                raise TunnelError(f"SOCKS4 status {status:#x}")
+            await reader.readexactly(6)
+        case _:  # http, https: CONNECT
+            target = f"[{host}]:{port}" if ":" in host else f"{host}:{port}"
+            writer.write(f"CONNECT {target} HTTP/1.1\r\nHost: {target}\r\n\r\n".encode())
+            head = await reader.readuntil(b"\r\n\r\n")
+            if not head.startswith(b"HTTP/"):
+                raise ValueError("Not an HTTP proxy")
+            if len(status_line := head.split(b"\r\n", 1)[0].split(b" ", 2)) < 2:
+                raise ValueError(f"Malformed status line {status_line[0][:64]!r}")
+            if (status := status_line[1]) != b"200":
+                raise TunnelError(f"HTTP status {status.decode('latin-1')}")
+
+
+async def _pipe(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    while chunk := await reader.read(CHUNK_SIZE):
+        writer.write(chunk)
+        await writer.drain()
+    if writer.can_write_eof():
+        writer.write_eof()  # a half-close: the answer may still be coming
+
+
+def _socks5_reply(status: int) -> bytes:
+    return bytes((0x05, status, 0x00, 0x01)) + bytes(6)  # bound to 0.0.0.0:0
+
+
+def _pascal(data: bytes) -> bytes:
+    return bytes((len(data),)) + data
+
+
+def _close(conn: tuple[asyncio.StreamReader, asyncio.StreamWriter]) -> None:
+    conn[1].close()
+
+
+def _close_warm(upstream: Upstream) -> None:
+    while upstream.warm:
+        upstream.warm.popleft()[1].close()
@@ -1,160 +1,187 @@
-import re, sys
+import sys, time
+from functools import cache
 from pathlib import Path
+from typing import TYPE_CHECKING, AsyncIterator, Mapping
 
-import aiohttp, asyncio
-from asyncio import TimeoutError, IncompleteReadError
-from aiohttp import ClientSession, ClientTimeout, ClientError
+import asyncio
+from asyncio import TimeoutError
 
+from ..configs.metrics import metrics
 from ..utils.files import from_json
-# from ..configs.web_sessions import session_pool
+from ..utils.source_cache import SourceCache
+from .parsers import PARSERS, ProxyRecord
+from .snapshot import save_proxies
+from .table import Proxy, ProxyTable
+
+if TYPE_CHECKING:  # heavy: aiohttp is imported by the first fetch, see vpn/get.py
+    from aiohttp import ClientSession
 
 import logging
 logger = logging.getLogger(__name__)
 
 
 # Constants
-TIMEOUT_GET_RAW_PROXY = ClientTimeout(total=2)
+TIMEOUT_GET_RAW_PROXY = 2        # sec: there is a cached copy to fall back to
+TIMEOUT_GET_RAW_PROXY_COLD = 10  # sec: nothing cached, wait the slow source longer
+SOURCE_MAX_AGE = {  # sec: the cached source is used without a request while it's younger
+    "spysme_socks":  30 * 60,
+    "spysme_http":   30 * 60,
+    "proxifly":      5 * 60,   # updated every 5 min
+    "proxyscrape":   5 * 60,
+    "speedx_http":   60 * 60,
+    "speedx_socks4": 60 * 60,
+    "speedx_socks5": 60 * 60,
+}
+DEFAULT_MAX_AGE = 10 * 60
 PROTOCOLS_HTTP = ["https", "http"]  # research more about the different protocols: include to the lecture
-PROTOCOLS_SOCK = ["socks5", "socks4"]
-PROXY_SOURCES = from_json(Path(__file__).parent / 'sources.json')  # look to README to see more sources; used to receice access to VPN servers via the proxies
+SOURCES_PATH = Path(__file__).parent / 'sources.json'  # look to README to see more sources; used to receice access to VPN servers via the proxies
+_DONE = object()  # end of a source stream
 
 
-async def get_proxies() -> list[dict[str, str | bool]]:
-    """
-    Orchestrate fetching & parsing all proxy sources.
-    Uses asyncio.gather(return_exceptions=True) so one failure doesn’t cancel the rest.
-    """
+@cache
+def proxy_sources() -> dict[str, str]:
+    '''{source name: url} of the proxy lists; read on the first call'''
+    return from_json(SOURCES_PATH)
 
-    # TODO: try the use (get) proxies from a file.
 
-    async with aiohttp.ClientSession(raise_for_status=True) as session:
-        coros = [_get_raw_proxies(session, source) for source in PROXY_SOURCES]
-        raw_proxies: list[dict[str, str | bool]] = await asyncio.gather(*coros, return_exceptions=True)
+async def get_proxies(sources: Mapping[str, str] | None = None, source_cache: SourceCache | None = None) -> ProxyTable:
+    """
+    Orchestrate fetching & parsing all proxy sources, return the whole table.
+    Use stream_proxies() to start probing before the slowest source has finished downloading,
+    snapshot.get_proxies_from_local() to reuse the table of a recent run.
+    """
 
-    unique_proxies: dict[str, dict[str, str | bool]] = dict()  # ip_port: meta dict
+    proxy_table = await fetch_proxies(sources, source_cache)
 
-    for prox in raw_proxies:
-        _proxy_preprocessing(unique_proxies, prox['source'], prox['data'])
-    
-    if (n_proxies := len(unique_proxies)) == 0:
+    if (n_proxies := len(proxy_table)) == 0:
         logger.warning("🚫 No proxies found. Check sources and code.")
         sys.exit(1)  # terminate with a non-zero exit code
 
     logger.info(f"✅ Got {n_proxies} proxy node{'s' if n_proxies != 1 else ''}")
+    logger.debug(f"Proxy table columns: {proxy_table.nbytes()} bytes")
+    return proxy_table
+
+
+async def fetch_proxies(sources: Mapping[str, str] | None = None, source_cache: SourceCache | None = None) -> ProxyTable:
+    '''All the sources into one table (deduplicated by ip:port), saved as the snapshot unless it's empty'''
+    proxy_table = ProxyTable()
+    async for _ in stream_proxies(proxy_table, sources, source_cache):
+        pass
 
-    # TODO: _store_to_json(n_proxies)
+    if len(proxy_table):
+        await save_proxies(proxy_table)
+    return proxy_table
 
-    proxies = _try_many_protocols(unique_proxies)
-    return proxies
 
+async def stream_proxies(proxy_table: ProxyTable,
+                         sources: Mapping[str, str] | None = None,
+                         source_cache: SourceCache | None = None) -> AsyncIterator[Proxy]:
+    """
+    Fetch all the sources concurrently, yield new proxies to probe as soon as their lines are downloaded.
+    `proxy_table` is filled along the way; duplicates from other sources are merged and not yielded again.
+    One source failure doesn't stop the rest.
+    sources: {source name: url}, the name selects the parser in PARSERS; proxy_sources() by default.
+    """
+    import aiohttp
+    from ..configs.web_sessions import CachedResolver  # aiohttp
+
+    sources = proxy_sources() if sources is None else sources
+    queue: asyncio.Queue[tuple[str, ProxyRecord] | object] = asyncio.Queue()
+    source_cache = SourceCache() if source_cache is None else source_cache
+
+    async def pump(session: "ClientSession", source: str) -> None:
+        n_records = 0
+        try:
+            with metrics.stage(f"fetch:{source}"):  # download + parse: they overlap
+                async for record in _stream_raw_proxies(session, source_cache, source, sources[source]):
+                    queue.put_nowait((source, record))
+                    n_records += 1
+        finally:
+            metrics.count("proxy_records", source, n_records)
+            queue.put_nowait(_DONE)
+
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(resolver=CachedResolver()), raise_for_status=True) as session:
+        tasks = [asyncio.create_task(pump(session, source)) for source in sources]
+        try:
+            n_running = len(tasks)
+            while n_running:
+                if (item := await queue.get()) is _DONE:
+                    n_running -= 1
+                    continue
 
-async def _get_raw_proxies(session: ClientSession, source: str) -> dict[str, str]:
+                source, record = item
+                n_rows = len(proxy_table)
+                row = proxy_table.add(source=source, **record._asdict())
+                if row == n_rows:  # a new row
+                    for proxy in proxy_table.probes((row,)):
+                        yield proxy
+        finally:
+            for task in tasks:
+                task.cancel()
+            for result in await asyncio.gather(*tasks, return_exceptions=True):
+                if isinstance(result, Exception):
+                    logger.error(f"❌ Proxy source failed: {result!r}")
+
+
+async def _stream_raw_proxies(session: "ClientSession", source_cache: SourceCache, source: str, url: str) -> AsyncIterator[ProxyRecord]:
     """
-    Fetch the raw text from a single source URL
+    Stream a single source URL line by line and yield the parsed proxies.
+    A fresh cached copy is used without a request, a stale one is revalidated (ETag / If-Modified-Since)
+    and is used if the source doesn't answer.
     """
+    from aiohttp import ClientError, ClientTimeout
+
+    if (parse := PARSERS.get(source)) is None:
+        logger.warning(f"Unrecognized {source=}: no parser in 'PARSERS'")
+        return
+
+    cached = source_cache.get(source)
+    if cached and cached.is_fresh(SOURCE_MAX_AGE.get(source, DEFAULT_MAX_AGE)):
+        logger.debug(f"📦 Fresh cache: {source=}, age={cached.age():.0f}s")
+        for record in filter(None, map(parse, cached.body.splitlines())):
+            yield record
+        return
+
+    lines: list[str] = []  # the body to cache
     try:
         logger.debug(f"Getting proxy data from {source=}")
 
-        async with session.get(PROXY_SOURCES[source], timeout=TIMEOUT_GET_RAW_PROXY) as resp:
-            text = await resp.text()
-        
-        logger.debug(f"✅ Got the proxy data {source=}")
-        return {'source': source, 'data': text.strip()}
-    
+        headers = cached.validators() if cached else {}
+        timeout = ClientTimeout(total=TIMEOUT_GET_RAW_PROXY if cached else TIMEOUT_GET_RAW_PROXY_COLD)
+        async with session.get(url, headers=headers, timeout=timeout) as resp:
+            if resp.status == 304:  # Not Modified
+                source_cache.touch(source, cached)
+                logger.debug(f"✅ Not modified, cache is revalidated: {source=}")
+                for record in filter(None, map(parse, cached.body.splitlines())):
+                    yield record
+                return
+
+            parse_time = 0.0
+            async for raw_line in resp.content:  # StreamReader yields lines as they arrive
+                start = time.perf_counter()
+                lines.append(line := raw_line.decode("utf-8", errors="replace").strip())
+                record = parse(line)
+                parse_time += time.perf_counter() - start
+                if record:
+                    yield record
+            metrics.add_time(f"parse:{source}", parse_time)
+
+            resp_headers = resp.headers
+
+        source_cache.put(source, "\n".join(lines).strip(), resp_headers)
+        logger.debug(f"✅ Got the proxy data {source=}: {len(lines)} lines")
+        return
+
     except TimeoutError as e:
         logger.debug(f"⏳ Timeout:\t{source=}")
     except ClientError as e:
         logger.debug(f"⚠️ HTTP error fetching {source=}", exc_info=True)
     except Exception:
-        logger.exception(f"❌ Unexpected error in '_get_raw_proxies' for {source=}")
+        logger.exception(f"❌ Unexpected error in '_stream_raw_proxies' for {source=}")
         raise
-    
-    return {'source': source, 'data': ''}
 
+    if cached:  # the already yielded proxies are deduplicated by the table
+        logger.info(f"📦 Source {source!r} isn't available, using the cached copy: age={cached.age():.0f}s")
+        for record in filter(None, map(parse, cached.body.splitlines())):
+            yield record
 
-def _proxy_preprocessing(proxy_store: dict, source: str, raw_data: str) -> None:
-    '''
-    clean the responce from proxy sources
-    unique_proxies: dict should be empty
-    '''
-    proxy_pattern = re.compile(r"^\d{1,3}(?:\.\d{1,3}){3}:\d+$")  # IP:Port pattern
-
-    try:
-        if source.startswith("spysme"):
-            raw_data: list = raw_data.splitlines()[6:-2]  # takeoff the header and bottom
-
-            for line in raw_data:
-                raw_proxy: list[str] = line.split()
-
-                if not proxy_pattern.match(ip_port := raw_proxy[0]):  # skip non-proxy lines
-                    continue
-
-                meta = _pase_spysme_meta(raw_proxy, source)
-
-                if source.endswith("http"):
-                    meta['protocol'] = 'https' if meta.get('ssl') else 'http'
-                else:  # source.endswith("socks")
-                    meta['protocol'] = 'socks5'
-
-                _store_proxy_info(proxy_store, ip_port, meta)
-
-            
-        elif source == "proxifly":
-            for url in raw_data.splitlines():
-                raw_proxy = url.split('://') 
-
-                _store_proxy_info(
-                    proxy_store,
-                    raw_proxy[1],  # ip_port
-                    {'protocol': raw_proxy[0], 'source': source}  # meta
-                )
-
-        else:
-            logger.warning(f"Unrecognized {source=} in '_proxy_preprocessing'")
-
-    except Exception:
-        logger.exception(f"❌ Error while preprocessing proxies from {source=}")
-
-
-def _pase_spysme_meta(raw_proxy: list[str], source: str) -> dict[str, str | bool]:
-    raw_meta, google_flag = raw_proxy[1].split('-'), raw_proxy[-1]
-    country_code, anonymity_flag = raw_meta[0], raw_meta[1].rstrip('!')
-    
-    return {  # meta of a proxy
-        'country': country_code,                    # str
-        'anonymity': anonymity_flag,                # str
-        'ssl': len(raw_meta) > 2,                   # bool
-        'has_problem': raw_meta[-1].endswith('!'),  # str: look on last char in the last element of raw_meta
-        'google_passed': google_flag == '+',        # str
-        'source': source                            # str
-        }
-
-
-def _store_proxy_info(proxies_store: dict[str, dict[str, str | bool]], ip_port: str, new_meta: dict[str, str | bool | None]) -> None:
-    '''+ escaping proxy duplicates'''
-    if inner_meta := proxies_store.get(ip_port):
-        for key, new_val in new_meta.items():
-            if old_val := inner_meta.get(key):
-                # consider that type(new_val) is type(old_val)
-                if isinstance(new_val, str) and len(new_val) > len(old_val):
-                    inner_meta[key] = new_val   # rewrite the value
-                elif isinstance(new_val, bool) and len(new_val) > len(old_val):
-                    inner_meta[key] = new_val & old_val
-                # elif ...:
-                #     look for data types into parsers
-            else:
-                inner_meta[key] = new_val
-    else:
-        proxies_store[ip_port] = new_meta
-
-
-def _try_many_protocols(proxy_store: dict[str, dict[str, str | bool]]) -> list[dict[str, str | bool]]:
-    proxies = []
-    for ip_port, meta in proxy_store.items():
-        if proto := meta.pop('protocol', None):
-            proxies.append({'protocol': proto, 'ip_port': ip_port, 'meta': meta})
-        else:
-            if meta['source'] == 'spysme_socks':
-                proxies.extend([{'protocol': proto, 'ip_port': ip_port, 'meta': meta} for proto in PROTOCOLS_SOCK])
-
-    return proxies
@@ -0,0 +1,139 @@
+'''Persistent proxy health scoreboard: remembers between runs which proxies worked and how fast'''
+
+import time
+from dataclasses import dataclass, astuple
+from typing import AsyncIterable, AsyncIterator, Iterable
+
+from ..utils.files import write_state, read_state
+from .table import Proxy
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# Constants
+HEALTH_STATE = "proxy_health"  # file name in STATE_DIR
+EWMA_ALPHA = 0.3               # weight of the newest latency sample
+TTL = 3 * 24 * 3600            # forget the proxies that weren't probed for 3 days => skipped proxies get a new chance
+MAX_FAIL_STREAK = 3            # skip the proxies that failed so many times in a row
+UNKNOWN_LATENCY = 10.0         # sec: latency of a never succeeded proxy (== probe timeout)
+N_BEST = 64                    # the historically best proxies probed before the sources are downloaded
+
+
+@dataclass(slots=True)
+class ProxyHealth:
+    latency: float | None = None  # EWMA of the successful probes latency, sec
+    ok: int = 0                   # successful probes
+    fail: int = 0                 # failed probes
+    fail_streak: int = 0          # failed probes in a row
+    last_seen: float = 0.0        # unix time of the last probe
+
+    def record(self, latency: float | None) -> None:
+        '''latency: None => the probe failed'''
+        if latency is None:
+            self.fail += 1
+            self.fail_streak += 1
+        else:
+            self.ok += 1
+            self.fail_streak = 0
+            self.latency = latency if self.latency is None else EWMA_ALPHA * latency + (1 - EWMA_ALPHA) * self.latency
+        self.last_seen = time.time()
+
+    def score(self) -> float:
+        '''Expected time to get a success: latency / success rate. Lower is better'''
+        success_rate = (self.ok + 1) / (self.ok + self.fail + 2)  # Laplace smoothing: a new proxy has 1/2
+        return (self.latency or UNKNOWN_LATENCY) / success_rate
+
+
+class HealthStore:
+    """
+    Proxy health keyed by '<protocol>://<ip:port>'.
+    Persisted to STATE_DIR as {key: [latency, ok, fail, fail_streak, last_seen]}; name None: in memory only.
+    """
+    NEW_SCORE = ProxyHealth().score()  # score of a never probed key
+
+    def __init__(self, name: str | None = HEALTH_STATE) -> None:
+        self._name = name
+        self._records: dict[str, ProxyHealth] = dict()
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+    def load(self) -> "HealthStore":
+        if self._name is None:
+            return self
+        expire_before = time.time() - TTL
+        for key, fields in read_state(self._name).items():
+            try:
+                health = ProxyHealth(*fields)
+            except TypeError:
+                continue  # state of an old format
+            if health.last_seen > expire_before:
+                self._records[key] = health
+
+        logger.debug(f"Loaded health of {len(self._records)} proxies")
+        return self
+
+    def save(self) -> None:
+        if self._name is not None:
+            write_state({key: astuple(health) for key, health in self._records.items()}, self._name)
+
+    def get(self, key: str) -> ProxyHealth | None:
+        return self._records.get(key)
+
+    def record(self, key: str, latency: float | None) -> None:
+        if (health := self._records.get(key)) is None:
+            health = self._records[key] = ProxyHealth()
+        health.record(latency)
+
+    def rekey(self, old_key: str, new_key: str) -> None:
+        '''The proxy speaks another protocol than it was listed with (see detect.py): its history goes along'''
+        if (health := self._records.pop(old_key, None)) is not None:
+            self._records.setdefault(new_key, health)
+
+    def rank(self, proxies: Iterable[Proxy]) -> list[Proxy]:
+        """
+        Order the proxies to probe: historically fastest & most reliable first, the ones that keep failing are skipped.
+        Unknown proxies get NEW_SCORE and keep the source order (sort is stable).
+        """
+        scored, n_skipped = [], 0
+
+        for proxy in proxies:
+            if (health := self._records.get(key(proxy))) is None:
+                scored.append((self.NEW_SCORE, proxy))
+            elif health.fail_streak >= MAX_FAIL_STREAK:
+                n_skipped += 1
+            else:
+                scored.append((health.score(), proxy))
+
+        scored.sort(key=lambda pair: pair[0])
+        logger.debug(f"Ranked {len(scored)} proxies, {n_skipped} skipped as failing")
+
+        return [proxy for _, proxy in scored]
+
+
+    async def rank_stream(self, proxies: AsyncIterable[Proxy], n_best: int = N_BEST) -> AsyncIterator[Proxy]:
+        """
+        Streaming rank(): the whole list isn't known yet, so the `n_best` historically best proxies are yielded first
+        straight from the store (no need to wait for the sources), then the streamed ones except the failing ones.
+        """
+        best = sorted((health.score(), key) for key, health in self._records.items()
+                      if health.ok and health.fail_streak < MAX_FAIL_STREAK)[:n_best]
+
+        seen = set()
+        for _, best_key in best:
+            protocol, ip_port = best_key.split('://', 1)
+            seen.add(best_key)
+            yield Proxy(protocol, ip_port, None)
+
+        async for proxy in proxies:
+            proxy_key = key(proxy)
+            if proxy_key in seen:
+                continue
+            if (health := self._records.get(proxy_key)) and health.fail_streak >= MAX_FAIL_STREAK:
+                continue
+            yield proxy
+
+
+def key(proxy: Proxy) -> str:
+    return f"{proxy.protocol}://{proxy.ip_port}"
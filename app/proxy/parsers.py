@@ -0,0 +1,76 @@
+'''
+Line parsers of the proxy sources: one line of a source -> a normalized ProxyRecord (or None for non-proxy lines).
+The sources are parsed line by line while they are downloading, see get.py:_stream_raw_proxies
+'''
+
+import re
+from functools import partial
+from typing import Callable, NamedTuple
+
+
+class ProxyRecord(NamedTuple):
+    ip_port: str
+    protocol: str | None = None   # None: unknown, see ProxyTable.probes()
+    country: str | None = None
+    anonymity: str | None = None
+    ssl: bool | None = None
+    has_problem: bool | None = None
+    google_passed: bool | None = None
+
+
+PROXY_PATTERN = re.compile(r"^\d{1,3}(?:\.\d{1,3}){3}:\d+$")  # IP:Port pattern
+
+
+def parse_spysme(line: str, socks: bool) -> ProxyRecord | None:
+    '''
+    spys.me line: '<ip:port> <country>-<anonymity>[-S][!] [-|+]', e.g. '1.2.3.4:8080 US-H-S! +'
+    The header and the bottom of the page don't start with IP:Port and are skipped.
+    '''
+    raw_proxy: list[str] = line.split()
+
+    if not raw_proxy or not PROXY_PATTERN.match(ip_port := raw_proxy[0]) or len(raw_proxy) < 2:
+        return None
+
+    raw_meta, google_flag = raw_proxy[1].split('-'), raw_proxy[-1]
+    if len(raw_meta) < 2:
+        return None
+    country_code, anonymity_flag = raw_meta[0], raw_meta[1].rstrip('!')
+    ssl = len(raw_meta) > 2
+
+    return ProxyRecord(
+        ip_port=ip_port,
+        protocol=None if socks else ('https' if ssl else 'http'),  # the SOCKS list mixes SOCKS4 & SOCKS5: see detect.py
+        country=country_code,
+        anonymity=anonymity_flag,
+        ssl=ssl,
+        has_problem=raw_meta[-1].endswith('!'),  # look on last char in the last element of raw_meta
+        google_passed=google_flag == '+',
+    )
+
+
+def parse_url(line: str) -> ProxyRecord | None:
+    '''proxifly, proxyscrape line: '<protocol>://<ip:port>', e.g. 'socks4://1.2.3.4:1080' '''
+    protocol, sep, ip_port = line.strip().partition('://')
+    if not sep or not PROXY_PATTERN.match(ip_port):
+        return None
+    return ProxyRecord(ip_port=ip_port, protocol=protocol.lower())
+
+
+def parse_plain(line: str, protocol: str | None) -> ProxyRecord | None:
+    '''TheSpeedX line: '<ip:port>'; the protocol is known from the list name'''
+    ip_port = line.strip()
+    if not PROXY_PATTERN.match(ip_port):
+        return None
+    return ProxyRecord(ip_port=ip_port, protocol=protocol)
+
+
+# source name in sources.json: line parser
+PARSERS: dict[str, Callable[[str], ProxyRecord | None]] = {
+    "spysme_socks":  partial(parse_spysme, socks=True),
+    "spysme_http":   partial(parse_spysme, socks=False),
+    "proxifly":      parse_url,
+    "proxyscrape":   parse_url,
+    "speedx_http":   partial(parse_plain, protocol="http"),
+    "speedx_socks4": partial(parse_plain, protocol="socks4"),
+    "speedx_socks5": partial(parse_plain, protocol="socks5"),
+}
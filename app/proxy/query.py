@@ -0,0 +1,224 @@
+'''
+Indexed queries over a ProxyTable: pick the proxies to probe before probing them.
+    "elite, ssl, not has_problem, country in {DE, NL}"
+The terms are AND-ed; a term is
+    <word>                      ssl, has_problem, google_passed, detected, elite | anonymous | transparent, http | https | socks4 | socks5
+    <attribute> = <value>       attributes: country, protocol, anonymity (H, A, N or the words above), source
+    <attribute> in {<v>, <v>}   any of the values
+    not <term>
+A bitmap (a Python int: bit i == row i) per value of every attribute, so a query is a few big-int AND / OR / XOR
+over len(table) / 64 machine words: microseconds for the sizes of the free lists.
+'''
+
+import re
+from dataclasses import dataclass
+from typing import AsyncIterable, AsyncIterator, Iterable, Iterator
+
+from .table import Anonymity, Flag, Protocol, Proxy, ProxyTable, pack_country
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# Constants
+FLAGS = {"ssl": Flag.SSL, "has_problem": Flag.HAS_PROBLEM, "google_passed": Flag.GOOGLE_PASSED, "detected": Flag.DETECTED}
+ANONYMITY_WORDS = {"elite": Anonymity.H, "anonymous": Anonymity.A, "transparent": Anonymity.N}
+ATTRIBUTES = ("country", "protocol", "anonymity", "source")
+_TERM = re.compile(r"^(?P<attribute>\w+)\s*(?:=\s*(?P<value>[\w-]+)|in\s*\{(?P<values>[^}]*)\})$", re.IGNORECASE)
+
+
+class QueryError(ValueError):
+    pass
+
+
+@dataclass(frozen=True, slots=True)
+class Term:
+    attribute: str            # one of ATTRIBUTES or "flag"
+    values: frozenset         # codes of the column: pack_country(), Protocol, Anonymity, source name or Flag
+    negate: bool = False
+
+
+@dataclass(frozen=True, slots=True)
+class Query:
+    terms: tuple[Term, ...]
+    text: str = ""
+
+    @classmethod
+    def parse(cls, text: str) -> "Query":
+        terms = tuple(_parse_term(part.strip()) for part in _split(text) if part.strip())
+        return cls(terms, text)
+
+    def matches(self, table: ProxyTable, row: int) -> bool:
+        '''The query on a single row, without an index: for the streamed proxies'''
+        return all(_matches(term, table, row) != term.negate for term in self.terms)
+
+    def protocols(self) -> set[str] | None:
+        '''The protocols the probes may have (None: any): a row of UNKNOWN protocol is probed as SOCKS4 and SOCKS5'''
+        allowed = None
+        for term in self.terms:
+            if term.attribute == "protocol":
+                names = {str(Protocol(p)) for p in (term.values if not term.negate else set(Protocol) - term.values)}
+                allowed = names if allowed is None else allowed & names
+        return allowed
+
+    def __str__(self) -> str:
+        return self.text
+
+
+class ProxyIndex:
+    """
+    Bitmaps of a ProxyTable. The table only grows, but add() may fill in the attributes of a known row (a merge):
+    update() indexes the new rows, rebuild it (ProxyIndex(table)) after the fetch is over to see the merges.
+    """
+
+    def __init__(self, table: ProxyTable) -> None:
+        self.table = table
+        self._n_rows = 0
+        self._bitmaps: dict[str, dict] = {attribute: dict() for attribute in (*ATTRIBUTES, "flag")}
+        self.update()
+
+    def update(self) -> None:
+        start, stop = self._n_rows, len(self.table)
+        if start == stop:
+            return
+
+        table = self.table
+        rows_by = {attribute: dict() for attribute in self._bitmaps}
+        for attribute, column in (("country", table.country), ("protocol", table.protocol),
+                                  ("anonymity", table.anonymity), ("source", table.source)):
+            by_value = rows_by[attribute]
+            for row in range(start, stop):
+                by_value.setdefault(column[row], []).append(row)
+        for flag in Flag:
+            rows_by["flag"][flag] = [row for row in range(start, stop) if table.flags[row] & flag]
+
+        for attribute, by_value in rows_by.items():
+            bitmaps = self._bitmaps[attribute]
+            for value, rows in by_value.items():
+                bitmaps[value] = bitmaps.get(value, 0) | _bitmap(rows, stop)
+
+        self._n_rows = stop
+
+    def select(self, query: Query) -> int:
+        '''Bitmap of the matching rows'''
+        everything = (1 << self._n_rows) - 1
+        result = everything
+        for term in query.terms:
+            bitmaps = self._bitmaps[term.attribute]
+            values = term.values
+            if term.attribute == "source":  # by name: the ids are the table's own
+                values = {self.table.sources().index(name) for name in values if name in self.table.sources()}
+            elif term.attribute == "protocol" and not term.negate:
+                values = values | {Protocol.UNKNOWN} if values & {Protocol.SOCKS4, Protocol.SOCKS5} else values
+            bitmap = 0
+            for value in values:
+                bitmap |= bitmaps.get(value, 0)
+            result &= everything ^ bitmap if term.negate else bitmap
+        return result
+
+    def rows(self, query: Query) -> list[int]:
+        return list(iter_bits(self.select(query)))
+
+    def probes(self, query: Query) -> Iterator[Proxy]:
+        '''The proxies to probe for the query'''
+        protocols = query.protocols()
+        for proxy in self.table.probes(iter_bits(self.select(query))):
+            if protocols is None or proxy.protocol in protocols:
+                yield proxy
+
+
+async def filter_stream(proxies: AsyncIterable[Proxy], table: ProxyTable, query: Query) -> AsyncIterator[Proxy]:
+    '''The streamed proxies (see stream_proxies) that match the query as they arrive'''
+    protocols = query.protocols()
+    async for proxy in proxies:
+        if proxy.row is None or query.matches(table, proxy.row):
+            if protocols is None or proxy.protocol in protocols:
+                yield proxy
+
+
+def iter_bits(bitmap: int) -> Iterator[int]:
+    '''Rows of the set bits, in order'''
+    bits = format(bitmap, "b")[::-1]  # one C pass instead of a shift per row
+    row = bits.find("1")
+    while row != -1:
+        yield row
+        row = bits.find("1", row + 1)
+
+
+def _bitmap(rows: Iterable[int], n_rows: int) -> int:
+    bits = bytearray((n_rows + 7) // 8)
+    for row in rows:
+        bits[row >> 3] |= 1 << (row & 7)
+    return int.from_bytes(bits, "little")
+
+
+def _split(text: str) -> list[str]:
+    '''Split by the commas outside of {...}'''
+    parts, depth, start = [], 0, 0
+    for i, char in enumerate(text):
+        if char == "{":
+            depth += 1
+        elif char == "}":
+            depth -= 1
+        elif char == "," and depth == 0:
+            parts.append(text[start:i])
+            start = i + 1
+    parts.append(text[start:])
+    return parts
+
+
+def _parse_term(text: str) -> Term:
+    negate = False
+    while text.lower().startswith("not "):
+        negate, text = not negate, text[4:].strip()
+
+    word = text.lower()
+    if word in FLAGS:
+        return Term("flag", frozenset({FLAGS[word]}), negate)
+    if word in ANONYMITY_WORDS:
+        return Term("anonymity", frozenset({ANONYMITY_WORDS[word]}), negate)
+    if Protocol.parse(word) != Protocol.UNKNOWN:
+        return Term("protocol", frozenset({Protocol.parse(word)}), negate)
+
+    if (match := _TERM.match(text)) is None:
+        raise QueryError(f"Bad query term: {text!r}")
+    attribute = match["attribute"].lower()
+    raw_values = [match["value"]] if match["value"] else [v.strip() for v in match["values"].split(",") if v.strip()]
+    if attribute not in ATTRIBUTES:
+        raise QueryError(f"Unknown attribute {attribute!r}: one of {', '.join(ATTRIBUTES)}")
+    return Term(attribute, frozenset(_code(attribute, value) for value in raw_values), negate)
+
+
+def _code(attribute: str, value: str) -> int | str:
+    '''The value as it's stored in the column'''
+    match attribute:
+        case "country":
+            if not (code := pack_country(value.upper())):
+                raise QueryError(f"Bad country code: {value!r}")
+            return code
+        case "protocol":
+            if (protocol := Protocol.parse(value)) == Protocol.UNKNOWN:
+                raise QueryError(f"Unknown protocol: {value!r}")
+            return protocol
+        case "anonymity":
+            if (anonymity := ANONYMITY_WORDS.get(value.lower()) or Anonymity.parse(value.upper())) == Anonymity.UNKNOWN:
+                raise QueryError(f"Unknown anonymity: {value!r}")
+            return anonymity
+        case _:  # source
+            return value
+
+
+def _matches(term: Term, table: ProxyTable, row: int) -> bool:
+    match term.attribute:
+        case "flag":
+            return any(table.flags[row] & flag for flag in term.values)
+        case "country":
+            return table.country[row] in term.values
+        case "protocol":
+            protocol = table.protocol[row]
+            return protocol in term.values or (protocol == Protocol.UNKNOWN and not term.negate
+                                               and bool(term.values & {Protocol.SOCKS4, Protocol.SOCKS5}))
+        case "anonymity":
+            return table.anonymity[row] in term.values
+        case _:  # source
+            return table.source_name(row) in term.values
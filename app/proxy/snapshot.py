@@ -0,0 +1,49 @@
+'''
+The proxy table of the last full fetch, saved as a columnar snapshot (see snapshots.ArrowWriter): the columns
+are written as they are, without a dict per row, and restored without parsing the sources again.
+'''
+
+import time
+
+from ..utils import snapshots
+from ..utils.snapshots import ArrowWriter
+from .table import ProxyTable
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# Constants
+PROXIES_SNAPSHOT = "proxies"  # tmp/results/proxies-<time>.arrow
+PROXIES_MAX_AGE = 30 * 60     # sec: the snapshot is used instead of the sources while it's younger
+
+
+async def save_proxies(proxy_table: ProxyTable) -> None:
+    '''Snapshot of the table columns as they are (no row dicts), the sources by name'''
+    import polars as pl
+
+    dtypes = {'I': pl.UInt32, 'H': pl.UInt16, 'B': pl.UInt8}
+    columns = proxy_table.columns()
+    names = proxy_table.sources()
+    frame = pl.DataFrame([pl.Series(name, column, dtype=dtypes[column.typecode])
+                          for name, column in columns.items() if name != "source"]).with_columns(
+        source=pl.Series([names[source_id] for source_id in columns["source"]], dtype=pl.Enum(names)))
+    async with ArrowWriter(PROXIES_SNAPSHOT) as sink:
+        sink.write_frame(frame)
+
+
+def get_proxies_from_local(max_age: float = PROXIES_MAX_AGE) -> ProxyTable | None:
+    '''The table of the last full fetch if its snapshot is younger than `max_age`: no network at all'''
+    if (path := snapshots.latest(PROXIES_SNAPSHOT, ".arrow")) is None:
+        return None
+    if (age := time.time() - path.stat().st_mtime) >= max_age:
+        logger.debug(f"Stale proxy snapshot: age={age:.0f}s")
+        return None
+
+    frame = snapshots.scan_arrow(path).collect()
+    names = frame.schema["source"].categories.to_list()
+    columns = {name: frame.get_column(name).to_list() for name in frame.columns if name != "source"}
+    columns["source"] = frame.get_column("source").to_physical().to_list()
+    proxy_table = ProxyTable.from_columns(columns, names)
+    logger.info(f"📦 Using the local proxy table: {len(proxy_table)} proxies, age={age:.0f}s")
+    return proxy_table
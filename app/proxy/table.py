@@ -0,0 +1,215 @@
+'''
+Compact columnar table of proxies: ~10 bytes of columns per proxy instead of a dict of dicts.
+Every attribute is a column (array.array), a proxy is a row number.
+'''
+
+from array import array
+from enum import IntEnum, IntFlag
+from typing import Iterable, Iterator, Mapping, NamedTuple, Sequence
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class Protocol(IntEnum):
+    UNKNOWN = 0  # e.g. spys.me SOCKS list doesn't tell SOCKS4 from SOCKS5
+    HTTP = 1
+    HTTPS = 2
+    SOCKS4 = 3
+    SOCKS5 = 4
+
+    @classmethod
+    def parse(cls, protocol: str | None) -> "Protocol":
+        return cls.__members__.get(protocol.upper(), cls.UNKNOWN) if protocol else cls.UNKNOWN
+
+    def __str__(self) -> str:
+        return self.name.lower()  # 'socks5': as in the proxy URL scheme
+
+
+class Anonymity(IntEnum):
+    '''spys.me codes'''
+    UNKNOWN = 0
+    N = 1  # no anonymity: transparent
+    A = 2  # anonymous
+    H = 3  # high anonymity: elite
+
+    @classmethod
+    def parse(cls, code: str | None) -> "Anonymity":
+        return cls.__members__.get(code, cls.UNKNOWN) if code else cls.UNKNOWN
+
+
+class Flag(IntFlag):
+    SSL = 1
+    HAS_PROBLEM = 2
+    GOOGLE_PASSED = 4
+    DETECTED = 8  # the protocol column is what the proxy speaks, see detect.py
+
+
+class Proxy(NamedTuple):
+    '''Light view of a row to probe'''
+    protocol: str    # 'http', 'socks5', ...
+    ip_port: str     # '1.2.3.4:8080'
+    row: int | None  # row in the ProxyTable; None: not from the table (e.g. from the health store)
+
+
+PROTOCOLS_SOCK = (Protocol.SOCKS5, Protocol.SOCKS4)  # tried for the proxies with UNKNOWN protocol
+NO_COUNTRY = 0
+COLUMNS = {"ip": 'I', "port": 'H', "protocol": 'B', "source": 'H', "country": 'H', "anonymity": 'B', "flags": 'B'}
+
+
+class ProxyTable:
+    """
+    Columns:
+        ip         uint32   IPv4 address
+        port       uint16
+        protocol   uint8    Protocol
+        source     uint16   id of the source name: see source_name(); a byte would overflow at the 256th source
+        country    uint16   two ASCII letters: 'DE' -> ord('D') << 8 | ord('E'); 0 == unknown
+        anonymity  uint8    Anonymity
+        flags      uint8    Flag bits
+    Duplicates are merged by the packed 48-bit key: ip << 16 | port.
+    """
+
+    def __init__(self) -> None:
+        self.ip = array('I')
+        self.port = array('H')
+        self.protocol = array('B')
+        self.source = array('H')
+        self.country = array('H')
+        self.anonymity = array('B')
+        self.flags = array('B')
+
+        self._index: dict[int, int] = dict()  # packed key: row
+        self._sources: list[str] = []         # source id: name
+        self._source_ids: dict[str, int] = dict()
+
+    @classmethod
+    def from_columns(cls, columns: Mapping[str, Sequence[int]], sources: Sequence[str]) -> "ProxyTable":
+        '''Restore a table saved by columns() (e.g. from a snapshot): no parsing, the index is rebuilt from ip & port'''
+        table = cls()
+        for name, typecode in COLUMNS.items():
+            setattr(table, name, array(typecode, columns[name]))
+        table._index = {ip << 16 | port: row for row, (ip, port) in enumerate(zip(table.ip, table.port))}
+        table._sources = list(sources)
+        table._source_ids = {source: source_id for source_id, source in enumerate(table._sources)}
+        return table
+
+    def columns(self) -> dict[str, array]:
+        '''{column name: column}, see COLUMNS; the source ids are the indexes of sources()'''
+        return {name: getattr(self, name) for name in COLUMNS}
+
+    def sources(self) -> list[str]:
+        return list(self._sources)
+
+    def __len__(self) -> int:
+        return len(self.ip)
+
+    def nbytes(self) -> int:
+        '''Memory of the columns (the dedup index is not counted)'''
+        return sum(col.itemsize * len(col) for col in (self.ip, self.port, self.protocol, self.source,
+                                                       self.country, self.anonymity, self.flags))
+
+    def add(self,
+            ip_port: str,
+            source: str,
+            protocol: str | None = None,
+            country: str | None = None,
+            anonymity: str | None = None,
+            ssl: bool | None = None,
+            has_problem: bool | None = None,
+            google_passed: bool | None = None) -> int | None:
+        """
+        Add a proxy or merge it into the existing row (escaping duplicates). Return the row, None for a bad ip_port.
+        Merge: unknown values are filled in, 'https' beats 'http', the flags are taken from the latest record having them.
+        """
+        if (key := pack(ip_port)) is None:
+            return None
+
+        proto = Protocol.parse(protocol)
+        country_code = pack_country(country)
+        anon = Anonymity.parse(anonymity)
+        flags, mask = 0, 0
+        for flag, value in ((Flag.SSL, ssl), (Flag.HAS_PROBLEM, has_problem), (Flag.GOOGLE_PASSED, google_passed)):
+            if value is not None:
+                mask |= flag
+                flags |= flag if value else 0
+
+        if (row := self._index.get(key)) is None:
+            row = self._index[key] = len(self.ip)
+            self.ip.append(key >> 16)
+            self.port.append(key & 0xFFFF)
+            self.protocol.append(proto)
+            self.source.append(self._source_id(source))
+            self.country.append(country_code)
+            self.anonymity.append(anon)
+            self.flags.append(flags)
+            return row
+
+        old_proto = self.protocol[row]
+        if old_proto == Protocol.UNKNOWN or (old_proto == Protocol.HTTP and proto == Protocol.HTTPS):
+            self.protocol[row] = proto
+        if self.country[row] == NO_COUNTRY:
+            self.country[row] = country_code
+        if self.anonymity[row] == Anonymity.UNKNOWN:
+            self.anonymity[row] = anon
+        self.flags[row] = self.flags[row] & ~mask | flags
+        return row
+
+    def ip_port(self, row: int) -> str:
+        return unpack(self.ip[row] << 16 | self.port[row])
+
+    def source_name(self, row: int) -> str:
+        return self._sources[self.source[row]]
+
+    def country_code(self, row: int) -> str | None:
+        return unpack_country(self.country[row])
+
+    def has(self, row: int, flag: Flag) -> bool:
+        return bool(self.flags[row] & flag)
+
+    def count(self, flag: Flag) -> int:
+        return sum(1 for flags in self.flags if flags & flag)
+
+    def probes(self, rows: Iterable[int] | None = None) -> Iterator[Proxy]:
+        '''Proxies to probe; a proxy with UNKNOWN protocol is tried as each of PROTOCOLS_SOCK'''
+        for row in range(len(self)) if rows is None else rows:
+            ip_port = self.ip_port(row)
+            if proto := self.protocol[row]:
+                yield Proxy(str(Protocol(proto)), ip_port, row)
+            else:
+                for proto in PROTOCOLS_SOCK:
+                    yield Proxy(str(proto), ip_port, row)
+
+    def _source_id(self, source: str) -> int:
+        if (source_id := self._source_ids.get(source)) is None:
+            source_id = self._source_ids[source] = len(self._sources)
+            self._sources.append(source)
+        return source_id
+
+
+def pack(ip_port: str) -> int | None:
+    '''"1.2.3.4:8080" -> 48-bit int: ip << 16 | port; None if it isn't an IPv4:port'''
+    try:
+        ip, port = ip_port.strip().rsplit(':', 1)
+        a, b, c, d = map(int, ip.split('.'))
+        port = int(port)
+    except ValueError:
+        return None
+
+    if not (0 <= a <= 255 and 0 <= b <= 255 and 0 <= c <= 255 and 0 <= d <= 255 and 0 < port <= 0xFFFF):
+        return None
+    return (a << 40) | (b << 32) | (c << 24) | (d << 16) | port
+
+
+def unpack(key: int) -> str:
+    return f"{key >> 40 & 0xFF}.{key >> 32 & 0xFF}.{key >> 24 & 0xFF}.{key >> 16 & 0xFF}:{key & 0xFFFF}"
+
+
+def pack_country(code: str | None) -> int:
+    if not code or len(code) != 2 or not code.isascii():
+        return NO_COUNTRY
+    return ord(code[0]) << 8 | ord(code[1])
+
+
+def unpack_country(code: int) -> str | None:
+    return chr(code >> 8) + chr(code & 0xFF) if code else None
@@ -0,0 +1,90 @@
+'''
+Tor as a proxy source: when the public lists are down, a local Tor client still gets out.
+Tor isolates the streams by SOCKS credentials (IsolateSOCKSAuth is on by default): every distinct
+username:password gets its own circuit, so N credentials are N circuits built in parallel.
+A circuit is a Proxy('socks5', 'user:pass@host:port'): it's fetched through like any SOCKS5 proxy (see SessionPool).
+Its health isn't persisted (health_state=None): the credentials are random, a saved record would never match again.
+'''
+
+import asyncio, secrets, time
+from typing import NamedTuple
+from urllib.parse import urlsplit
+
+from ..configs.metrics import metrics
+from .table import Proxy
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# Constants
+TOR_HOST, TOR_PORT = "127.0.0.1", 9050
+N_CIRCUITS = 8                # circuits measured at once
+N_FASTEST = 3                 # ... the fetch is raced across the fastest ones
+MEASURE_TIMEOUT = 30          # sec: building a circuit takes a few seconds, a slow one isn't worth it
+CIRCUIT_TTL = 9 * 60          # sec: Tor stops using a circuit for new streams 10 min after its first use (MaxCircuitDirtiness)
+
+
+class Circuit(NamedTuple):
+    proxy: Proxy
+    latency: float      # sec: SOCKS handshake + CONNECT to the target through the circuit
+    built_at: float     # monotonic
+
+
+class TorCircuits:
+    """
+    Isolated circuits of a local Tor SOCKS port, measured in parallel. The fast ones stay warm: the next
+    fastest() (e.g. the next refresh of the daemon) reuses them while Tor does, and opens new ones only to
+    replace the dead and the expired ones.
+    """
+
+    def __init__(self, host: str = TOR_HOST, port: int = TOR_PORT, n_circuits: int = N_CIRCUITS) -> None:
+        self.host = host
+        self.port = port
+        self.n_circuits = n_circuits
+        self._warm: dict[Proxy, Circuit] = dict()
+
+    def new_circuit(self) -> Proxy:
+        '''Fresh credentials => a circuit of its own'''
+        return Proxy("socks5", f"{secrets.token_hex(4)}:{secrets.token_hex(4)}@{self.host}:{self.port}", None)
+
+    async def fastest(self, url: str, n: int = N_FASTEST) -> list[Proxy]:
+        '''The `n` fastest circuits to `url`'s host: the warm ones and the new ones measured together'''
+        expire_before = time.monotonic() - CIRCUIT_TTL
+        self._warm = {proxy: circuit for proxy, circuit in self._warm.items() if circuit.built_at > expire_before}
+
+        proxies = list(self._warm)
+        proxies += [self.new_circuit() for _ in range(self.n_circuits - len(proxies))]
+        host, port = _target(url)
+
+        with metrics.stage("tor_circuits"):
+            latencies = await asyncio.gather(*(self.measure(proxy, host, port) for proxy in proxies))
+
+        now = time.monotonic()
+        alive = sorted((latency, proxy) for latency, proxy in zip(latencies, proxies) if latency is not None)
+        self._warm = {proxy: Circuit(proxy, latency, self._warm[proxy].built_at if proxy in self._warm else now)
+                      for latency, proxy in alive[:max(n, self.n_circuits // 2)]}  # the slow half is let go
+        logger.info(f"🧅 Tor: {len(alive)}/{len(proxies)} circuits up, the fastest: "
+                    + ", ".join(f"{latency * 1000:.0f} ms" for latency, _ in alive[:n]))
+        return [proxy for _, proxy in alive[:n]]
+
+    async def measure(self, proxy: Proxy, host: str, port: int, timeout: float = MEASURE_TIMEOUT) -> float | None:
+        '''Latency of opening a stream to host:port through the circuit (builds it if needed), None if it fails'''
+        from python_socks import ProxyError
+        from python_socks.async_.asyncio import Proxy as SocksProxy
+
+        start = time.monotonic()
+        try:
+            sock = await SocksProxy.from_url(f"{proxy.protocol}://{proxy.ip_port}", rdns=True).connect(host, port, timeout)
+        except (ProxyError, OSError, asyncio.TimeoutError) as e:
+            metrics.count("tor_circuits", "fail")
+            logger.debug(f"🧅 Circuit failed: {e!r}")
+            return None
+        sock.close()
+        metrics.count("tor_circuits", "ok")
+        return time.monotonic() - start
+
+
+def _target(url: str) -> tuple[str, int]:
+    parts = urlsplit(url)
+    return parts.hostname, parts.port or (443 if parts.scheme == "https" else 80)
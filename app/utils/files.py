@@ -1,4 +1,4 @@
-import sys
+import asyncio, csv, shutil, sys
 import json
 from pathlib import Path
 from datetime import datetime
@@ -7,19 +7,35 @@ import logging
 logger = logging.getLogger(__name__)
 
 
-def to_json(data: list[dict[str, str | bool]], file_name: str) -> None:
-    """Serialize *data* (list of dicts) to a UTF-8 JSON file."""
-    
-    path = _dated_path(file_name)
+# Constants
+STATE_DIR = Path(__file__).parents[2] / "tmp" / "state"  # …/vpn/tmp/state: state kept between runs
+CACHE_DIR = Path(__file__).parents[2] / "tmp" / "cache"  # …/vpn/tmp/cache: downloaded data, could be deleted any time
+RESULTS_DIR = Path(__file__).parents[2] / "tmp" / "results"  # …/vpn/tmp/results: dated exports and snapshots
+MAX_KEEP = 10                                                # files kept per kind of export
+DATE_GLOB = "[0-9]" * 8                                      # YYYYMMDD of the exports: "proxies" isn't "working_proxies"
+_BOOLS = {"True": True, "False": False}                      # CSV cells read back as bools, see from_csv
+
+
+def to_json(data: list[dict[str, str | bool]], file_name: str) -> Path:
+    """Atomically serialize *data* (list of dicts) to RESULTS_DIR/YYYYMMDD_<file_name>.json, compact UTF-8."""
+
+    path = _dated_path(file_name, ".json")
     try:
-        with path.open("w", encoding="utf-8") as file:
-            json.dump(data, file, ensure_ascii=False, indent=2)
-        logger.debug(f"📝 Wrote {len(data)} records → {path.relative_to(Path.cwd())}")
-        
+        write_atomic(path, json.dumps(data, ensure_ascii=False, separators=(",", ":")))
+        logger.debug(f"📝 Wrote {len(data)} records → {path}")
+
     except Exception:
         logger.exception(f"❌ Could not write JSON to {path}")
         raise
 
+    del_old_files(RESULTS_DIR, f"{DATE_GLOB}_{path.name.split('_', 1)[1]}")
+    return path
+
+
+async def to_json_async(data: list[dict[str, str | bool]], file_name: str) -> Path:
+    """to_json() in a thread: the event loop isn't blocked by the serialization and the write."""
+    return await asyncio.to_thread(to_json, data, file_name)
+
 
 def from_json(full_path: str | Path) -> dict | list[dict]:
     """
@@ -56,41 +72,95 @@ def from_json(full_path: str | Path) -> dict | list[dict]:
     sys.exit(1)
     
 
-def to_csv(data: list[dict[str, str | bool]], full_path: str) -> None:
-    """Serialize *data* (list of dicts) to a UTF-8 CSV file."""
+def write_atomic(path: Path, text: str) -> None:
+    """Write to a temp file and rename it over *path*: readers see the old or the new file, never a half-written one."""
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(path.name + ".tmp")
+    tmp_path.write_text(text, encoding="utf-8")
+    tmp_path.replace(path)  # atomic rename
+
+
+def write_state(data: dict, name: str) -> None:
+    """Atomically write *data* to STATE_DIR/<name>.json: a crash in the middle never leaves a broken file."""
+
+    path = STATE_DIR / f"{name}.json"
+    try:
+        write_atomic(path, json.dumps(data, ensure_ascii=False))
+        logger.debug(f"📝 Wrote state {name!r}: {len(data)} keys")
+
+    except OSError:
+        logger.exception(f"❌ Could not write state to {path}")
+
+
+def read_state(name: str) -> dict:
+    """Load STATE_DIR/<name>.json; the state is optional: return {} if it's missing or broken."""
+
+    path = STATE_DIR / f"{name}.json"
+    try:
+        data = json.loads(path.read_text(encoding="utf-8"))
+    except FileNotFoundError:
+        return dict()
+    except (OSError, ValueError):
+        logger.warning(f"⚠️ Broken state {path}: starting from scratch", exc_info=True)
+        return dict()
+
+    return data if isinstance(data, dict) else dict()
+
+
+def to_csv(data: list[dict[str, str | bool]], full_path: str | Path) -> None:
+    """Atomically serialize *data* (list of dicts) to a UTF-8 CSV file; the columns are the keys of all the dicts."""
 
     path = Path(full_path)
-    ...
+    columns = list(dict.fromkeys(key for row in data for key in row))
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(path.name + ".tmp")
+    try:
+        with tmp_path.open("w", encoding="utf-8", newline="") as file:
+            writer = csv.DictWriter(file, fieldnames=columns)
+            writer.writeheader()
+            writer.writerows(data)
+        tmp_path.replace(path)  # atomic rename
+        logger.debug(f"📝 Wrote {len(data)} records → {path}")
+
+    except Exception:
+        logger.exception(f"❌ Could not write CSV to {path}")
+        tmp_path.unlink(missing_ok=True)
+        raise
 
 
-def from_csv(full_path: str) -> list[dict[str, str | bool]]:
+def from_csv(full_path: str | Path) -> list[dict[str, str | bool]]:
+    """Load a CSV written by to_csv(): 'True' / 'False' are read back as bools, the rest stays str."""
+
     path = Path(full_path)
-    ...
+    with path.open(encoding="utf-8", newline="") as file:
+        return [{key: _BOOLS.get(value, value) for key, value in row.items()} for row in csv.DictReader(file)]
 
 
-def _dated_path(file_name: str) -> Path:
+def _dated_path(file_name: str, suffix: str) -> Path:
     """
-    Build     source/YYYYMMDD_<file_name>.json
+    Build     RESULTS_DIR/YYYYMMDD_<file_name><suffix>
     """
     date = datetime.now().strftime("%Y%m%d")
-    if not file_name.endswith(".json"):
-        file_name += ".json"
-    
-    return Path.cwd() / "source" / f"{date}_{file_name}"
+    if not file_name.endswith(suffix):
+        file_name += suffix
 
+    return RESULTS_DIR / f"{date}_{file_name}"
 
-def _del_old_files(max_keep: int = 10) -> None:
+
+def del_old_files(directory: Path, pattern: str, max_keep: int = MAX_KEEP) -> None:
     """
-    Keep only the newest *max_keep* JSON files in SOURCE_DIR.
+    Keep only the newest *max_keep* files (or snapshot directories) matching *pattern* in *directory*.
     """
-    files = sorted(
-        SOURCE_DIR.glob("*.json"),
-        key=lambda p: p.stat().st_mtime,
-        reverse=True,       # newest first
-    )
-    for old in files[max_keep:]:
+    try:
+        paths = sorted(directory.glob(pattern), key=lambda p: p.stat().st_mtime, reverse=True)  # newest first
+    except OSError as exc:  # deleted in the meantime
+        logger.warning("Could not list %s: %s", directory, exc)
+        return
+
+    for old in paths[max_keep:]:
         try:
-            old.unlink()
+            shutil.rmtree(old) if old.is_dir() else old.unlink()
             logger.debug("🗑️  Deleted old file %s", old.name)
         except OSError as exc:
             logger.warning("Could not delete %s: %s", old, exc)
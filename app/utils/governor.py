@@ -0,0 +1,83 @@
+'''
+Adaptive concurrency of the probes (AIMD, as TCP congestion control): the limit of probes in flight grows
+additively while the probes behave, and is cut multiplicatively on congestion signs. The ceiling is the FD budget
+of the real rlimit, so a low hard limit means fewer probes at once instead of EMFILE.
+'''
+
+import math
+
+from ..configs.file_descriptors import fd_budget, open_fds
+from ..configs.metrics import metrics
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# Constants
+MAX_IN_FLIGHT = 256           # probes in flight at the start (~ opened sockets)
+MIN_LIMIT = 8                 # probes in flight, never less
+MAX_LIMIT = 4096              # ... never more: ephemeral ports, conntrack and the event loop itself
+FDS_PER_PROBE = 1             # one socket per probe: the connectors don't keep the connections alive
+INCREASE_STEP = 16            # additive increase per window without congestion
+DECREASE_FACTOR = 0.7         # multiplicative decrease on a rising timeout rate
+LOCAL_DECREASE_FACTOR = 0.5   # ... on local errors (EMFILE, ENOBUFS, ...) or FD pressure
+MIN_WINDOW = 16               # outcomes per decision: the window is a quarter of the limit, at least MIN_WINDOW
+TIMEOUT_MARGIN = 0.15         # the window's timeout rate above the baseline by more => congestion
+BASELINE_ALPHA = 0.2          # EWMA weight of a calm window in the baseline timeout rate
+FD_PRESSURE = 0.9             # opened FDs / (budget + opened at start) above it => cut
+
+
+class Governor:
+    """
+    The limit of probes in flight for race(); record() the outcome of each finished probe.
+    Outcomes: "ok", "timeout", "local_error" (see is_local_error), anything else is a failure of the proxy.
+
+    Most of the free proxies are dead, so a high timeout rate is normal: congestion is a timeout rate rising
+    above its baseline (the EWMA of the calm windows), not a high one.
+    """
+
+    def __init__(self, initial: int = MAX_IN_FLIGHT, max_limit: int = MAX_LIMIT, min_limit: int = MIN_LIMIT,
+                 fds_per_probe: int = FDS_PER_PROBE) -> None:
+        self._fds_at_start = open_fds() or 0
+        self._fd_capacity = fd_budget(max_limit * fds_per_probe)
+        self.ceiling = max(1, min(max_limit, self._fd_capacity // fds_per_probe))
+        self.min_limit = min(min_limit, self.ceiling)
+        self.limit = max(self.min_limit, min(initial, self.ceiling))
+
+        self._window: dict[str, int] = {"ok": 0, "timeout": 0, "local_error": 0, "fail": 0}
+        self._baseline: float | None = None  # timeout rate of the calm windows
+        metrics.peak("concurrency_limit", self.limit)
+        logger.debug(f"Governor: limit={self.limit}, ceiling={self.ceiling}, fd_capacity={self._fd_capacity}")
+
+    def record(self, outcome: str) -> None:
+        self._window[outcome if outcome in self._window else "fail"] += 1
+        if sum(self._window.values()) >= max(MIN_WINDOW, self.limit // 4):
+            self._adjust()
+
+    def _adjust(self) -> None:
+        n = sum(self._window.values())
+        timeout_rate = self._window["timeout"] / n
+
+        if self._window["local_error"] or self._fd_pressure():
+            self._set(self.limit * LOCAL_DECREASE_FACTOR, "local pressure")
+        elif self._baseline is not None and timeout_rate > self._baseline + TIMEOUT_MARGIN:
+            self._set(self.limit * DECREASE_FACTOR, f"timeouts {timeout_rate:.0%} > baseline {self._baseline:.0%}")
+        else:
+            self._baseline = timeout_rate if self._baseline is None else \
+                BASELINE_ALPHA * timeout_rate + (1 - BASELINE_ALPHA) * self._baseline
+            self._set(self.limit + INCREASE_STEP, None)
+
+        self._window = dict.fromkeys(self._window, 0)
+
+    def _set(self, limit: float, reason: str | None) -> None:
+        new_limit = max(self.min_limit, min(self.ceiling, math.floor(limit)))
+        if reason is not None:
+            metrics.count("concurrency_cuts", reason.split()[0])
+            logger.debug(f"📉 Concurrency {self.limit} → {new_limit}: {reason}")
+        self.limit = new_limit
+        metrics.peak("concurrency_limit", new_limit)
+
+    def _fd_pressure(self) -> bool:
+        if (n_open := open_fds()) is None:
+            return False
+        return n_open > FD_PRESSURE * (self._fd_capacity + self._fds_at_start)
@@ -0,0 +1,181 @@
+'''Bounded-concurrency probe scheduler: run probes over many items, stop as soon as enough of them succeed'''
+
+import asyncio, math
+from collections import deque
+from itertools import islice
+from typing import AsyncIterable, AsyncIterator, Awaitable, Callable, Iterable, TypeVar
+
+from ..configs.metrics import metrics
+from .governor import Governor, MAX_IN_FLIGHT
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# Constants
+WAVE_DELAY = 0.5  # sec between staggered waves
+
+
+T, R = TypeVar("T"), TypeVar("R")
+
+
+async def race(probe: Callable[[T], Awaitable[R | None]],
+               items: Iterable[T] | AsyncIterable[T],
+               goal: int = 1,
+               max_in_flight: int = MAX_IN_FLIGHT,
+               wave_size: int | None = None,
+               wave_delay: float = WAVE_DELAY,
+               governor: Governor | None = None) -> list[R]:
+    """
+    Run `probe(item)` for each item with at most `max_in_flight` probes at once.
+    Return the first `goal` truthy results (fewer if the items run out).
+    `items` could be async (e.g. a source still downloading): probes start as soon as the first items arrive.
+
+    Staggered waves (wave_size is set): the first `wave_size` items are launched alone, every `wave_delay` sec
+    the next wave twice bigger than the previous one is allowed. Put the most promising items first: if they
+    succeed within one RTT, the rest is never started. A wave is launched earlier if nothing is in flight.
+
+    governor: the limit of probes in flight changes on the fly (see Governor), capped by `max_in_flight`.
+    The probes report their outcomes to the governor themselves: only they know a timeout from a refusal.
+
+    ### THE ASYNCIO THEORY ###
+    A pending Task keeps its sockets, connectors and buffers alive until it is done: EventLoop holds a strong
+    ref to it in self._ready, so dropping our refs doesn't free anything. That's why every pending probe is
+    cancelled (and awaited) as soon as the goal is met, and why new probes are created lazily: a Task per item
+    created upfront would open all the sockets at once.
+    """
+    loop = asyncio.get_running_loop()
+    feed = _Feed(items)
+    results: list[R] = []
+    pending: set[asyncio.Task] = set()
+
+    allowed = wave_size or math.inf   # items allowed to launch by the current wave
+    next_wave_size = 2 * allowed
+    next_wave_at = loop.time() + wave_delay
+    n_launched = 0
+
+    def in_flight_limit() -> int:
+        return min(max_in_flight, governor.limit) if governor is not None else max_in_flight
+
+    def launch() -> None:
+        nonlocal n_launched
+        for item in feed.take(int(max(0, min(in_flight_limit() - len(pending), allowed - n_launched)))):
+            pending.add(asyncio.create_task(probe(item)))
+            n_launched += 1
+        metrics.in_flight(len(pending))
+
+    try:
+        while True:
+            wave_launched = n_launched >= allowed
+            if wave_launched and (not pending or loop.time() >= next_wave_at):  # open the next wave
+                allowed += next_wave_size
+                next_wave_size *= 2
+                next_wave_at = loop.time() + wave_delay
+                wave_launched = False
+
+            launch()  # fill the free slots
+            if not pending and feed.exhausted:
+                break
+            wave_launched = n_launched >= allowed
+
+            wakers: set[asyncio.Future] = set(pending)
+            if len(pending) < in_flight_limit() and not wave_launched and (arrival := feed.arrival()):
+                wakers.add(arrival)  # wake up to launch the new items
+            timeout = max(0, next_wave_at - loop.time()) if wave_launched and not feed.exhausted else None
+
+            done, _ = await asyncio.wait(wakers, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+
+            for task in done & pending:
+                pending.discard(task)
+                try:
+                    result = task.result()
+                except asyncio.CancelledError:
+                    raise
+                except Exception:  # a bug or an unexpected error of one probe doesn't end the race
+                    logger.exception("💥 Probe crashed")
+                    metrics.count("probe_outcomes", "crashed")
+                    continue
+                if result:
+                    results.append(result)
+
+            if len(results) >= goal:
+                break
+
+    finally:
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)  # wait for the sockets to be closed
+        await feed.close()
+
+        if pending:
+            logger.debug(f"🛑 Cancelled {len(pending)} pending probes")
+
+    return results[:goal]
+
+
+async def aiterate(items: Iterable[T] | AsyncIterable[T]) -> AsyncIterator[T]:
+    '''A sync or async iterable as an async one: for the stages that take both'''
+    if isinstance(items, AsyncIterable):
+        async for item in items:
+            yield item
+    else:
+        for item in items:
+            yield item
+
+
+class _Feed:
+    """
+    Items of a sync or async iterable taken without blocking.
+    Async items are pulled by a background task into a buffer; arrival() is the future to wait for more of them.
+    """
+
+    def __init__(self, items: Iterable[T] | AsyncIterable[T]) -> None:
+        self.exhausted = False
+        self._arrival: asyncio.Future | None = None
+
+        if isinstance(items, AsyncIterable):
+            self._iter = None
+            self._buffer: deque[T] = deque()
+            self._pump_done = False
+            self._pump = asyncio.create_task(self._pump_items(items))
+        else:
+            self._iter = iter(items)
+            self._pump = None
+
+    def take(self, n: int) -> list[T]:
+        if self._iter is not None:
+            taken = list(islice(self._iter, n))
+            self.exhausted = self.exhausted or len(taken) < n
+            return taken
+
+        taken = [self._buffer.popleft() for _ in range(min(n, len(self._buffer)))]
+        self.exhausted = self._pump_done and not self._buffer
+        return taken
+
+    def arrival(self) -> asyncio.Future | None:
+        """Future done when new items arrive; None if there is nothing to wait for"""
+        if self._pump is None or self._buffer or self._pump_done:
+            return None
+        if self._arrival is None or self._arrival.done():
+            self._arrival = asyncio.get_running_loop().create_future()
+        return self._arrival
+
+    async def close(self) -> None:
+        if self._pump is not None:
+            self._pump.cancel()
+            await asyncio.gather(self._pump, return_exceptions=True)
+
+    async def _pump_items(self, items: AsyncIterable[T]) -> None:
+        try:
+            async for item in items:
+                self._buffer.append(item)
+                self._wake()
+        except Exception:
+            logger.exception("❌ The items of the race failed")
+        finally:
+            self._pump_done = True
+            self._wake()
+
+    def _wake(self) -> None:
+        if self._arrival is not None and not self._arrival.done():
+            self._arrival.set_result(None)
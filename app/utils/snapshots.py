@@ -0,0 +1,206 @@
+'''
+Streaming snapshots of the results: the records are written out while they are produced, not at the end of a run.
+  - JsonlWriter:  one JSON object per line, <stem>-<time>.jsonl
+  - ArrowWriter:  columnar, a directory of uncompressed Arrow IPC parts (one per batch), <stem>-<time>.arrow/
+The producers only append to a batch (no I/O in the event loop); full batches are written by a background task
+in a thread. A snapshot is written under a .tmp name and renamed when closed: the readers never see a half of it.
+The last `max_keep` snapshots of a stem are kept.
+'''
+
+import asyncio, json, shutil
+from abc import ABC, abstractmethod
+from datetime import datetime
+from pathlib import Path
+from typing import TYPE_CHECKING, AsyncIterator, Iterator, Sequence
+
+from . import files
+
+if TYPE_CHECKING:
+    import polars as pl
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# Constants
+BATCH_SIZE = 1000      # records per write (and per Arrow part)
+MAX_KEEP = 10          # snapshots kept per stem
+TMP_SUFFIX = ".tmp"
+TIME_GLOB = "[0-9]" * 8 + "-" + "[0-9]" * 6 + "-" + "[0-9]" * 6  # the time in a name: "probes" isn't "probes-http"
+_DONE = None           # end of the queue
+
+
+class _SnapshotWriter(ABC):
+    """
+    Usage:
+        async with JsonlWriter("probes") as sink:
+            sink.write({"proxy": ..., "latency": ...})   # sync: only appends to the batch
+    """
+    suffix = ""
+
+    def __init__(self, stem: str, directory: Path | None = None, batch_size: int = BATCH_SIZE,
+                 max_keep: int = MAX_KEEP) -> None:
+        self.stem = stem
+        self.directory = files.RESULTS_DIR if directory is None else directory
+        self.path = self.directory / f"{stem}-{datetime.now():%Y%m%d-%H%M%S-%f}{self.suffix}"
+        self.batch_size = batch_size
+        self.max_keep = max_keep
+        self.n_records = 0
+        self._tmp_path = self.path.with_name(self.path.name + TMP_SUFFIX)
+        self._batch: list[dict] = []
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._drainer: asyncio.Task | None = None
+
+    async def __aenter__(self):
+        self._drainer = asyncio.create_task(self._drain())
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.close()
+
+    def write(self, record: dict) -> None:
+        self._batch.append(record)
+        self.n_records += 1
+        if len(self._batch) >= self.batch_size:
+            self._queue.put_nowait(self._batch)
+            self._batch = []
+
+    async def close(self) -> None:
+        '''Write the rest and publish the snapshot; the records written before an error are kept as well'''
+        if self._drainer is None:
+            return
+        if self._batch:
+            self._queue.put_nowait(self._batch)
+            self._batch = []
+        self._queue.put_nowait(_DONE)
+
+        drainer, self._drainer = self._drainer, None
+        try:
+            await asyncio.shield(drainer)  # cancelled or not, the thread finishes the writes it got
+        except Exception:  # a snapshot is never worth the run
+            logger.exception(f"❌ Could not write the snapshot {self.path}")
+            await asyncio.to_thread(_remove, self._tmp_path)
+            return
+        await asyncio.to_thread(self._publish)
+
+    async def _drain(self) -> None:
+        await asyncio.to_thread(self._open)
+        try:
+            while (batch := await self._queue.get()) is not _DONE:
+                await asyncio.to_thread(self._write_batch, batch)
+        finally:
+            await asyncio.to_thread(self._close_file)
+
+    def _publish(self) -> None:
+        self._tmp_path.replace(self.path)  # atomic rename
+        logger.debug(f"📝 Wrote {self.n_records} records → {self.path}")
+        files.del_old_files(self.directory, f"{self.stem}-{TIME_GLOB}{self.suffix}", self.max_keep)
+
+    # run in a thread
+    @abstractmethod
+    def _open(self) -> None:
+        ...
+
+    @abstractmethod
+    def _write_batch(self, batch: list[dict]) -> None:
+        ...
+
+    def _close_file(self) -> None:
+        pass
+
+
+class JsonlWriter(_SnapshotWriter):
+    suffix = ".jsonl"
+    _file = None
+
+    def _open(self) -> None:
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._file = self._tmp_path.open("w", encoding="utf-8")
+
+    def _write_batch(self, batch: list[dict]) -> None:
+        self._file.write("".join(json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n"
+                                 for record in batch))
+
+    def _close_file(self) -> None:
+        if self._file is not None:
+            self._file.close()
+
+
+class ArrowWriter(_SnapshotWriter):
+    """
+    schema: {column: polars type} of the records; by default it's inferred from the first batch.
+    write_frame() adds a ready DataFrame as a part, e.g. the columns of a table without a dict per row.
+    """
+    suffix = ".arrow"
+
+    def __init__(self, stem: str, directory: Path | None = None, batch_size: int = BATCH_SIZE,
+                 max_keep: int = MAX_KEEP, schema: dict | None = None) -> None:
+        super().__init__(stem, directory, batch_size, max_keep)
+        self.schema = schema
+        self._n_parts = 0
+
+    def write_frame(self, frame: "pl.DataFrame") -> None:
+        self.n_records += len(frame)
+        self._queue.put_nowait(frame)
+
+    def _open(self) -> None:
+        self._tmp_path.mkdir(parents=True, exist_ok=True)
+
+    def _write_batch(self, batch: "list[dict] | pl.DataFrame") -> None:
+        import polars as pl
+
+        frame = batch if isinstance(batch, pl.DataFrame) else pl.DataFrame(batch, schema=self.schema, orient="row")
+        frame.write_ipc(self._tmp_path / f"part-{self._n_parts:05d}.arrow", compression="uncompressed")
+        self._n_parts += 1
+
+
+def latest(stem: str, suffix: str, directory: Path | None = None) -> Path | None:
+    '''The newest published snapshot of `stem` (the names sort by time), None if there is none'''
+    directory = files.RESULTS_DIR if directory is None else directory
+    return max(directory.glob(f"{stem}-*{suffix}"), default=None)
+
+
+def iter_jsonl(path: Path) -> Iterator[dict]:
+    '''Records of a JSONL snapshot one by one; a broken line is skipped'''
+    with path.open(encoding="utf-8") as file:
+        for line in file:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                logger.warning(f"⚠️ Broken line in {path}: {line[:64]!r}")
+
+
+def iter_arrow(path: Path, columns: Sequence[str] | None = None) -> Iterator["pl.DataFrame"]:
+    '''Parts of an Arrow snapshot one by one: only the asked columns are read'''
+    import polars as pl
+
+    for part in sorted(path.glob("part-*.arrow")):
+        yield pl.read_ipc(part, columns=columns)
+
+
+def scan_arrow(path: Path) -> "pl.LazyFrame":
+    '''All the parts of an Arrow snapshot as one lazy frame: the queries read only what they need'''
+    import polars as pl
+
+    return pl.scan_ipc(sorted(path.glob("part-*.arrow")))
+
+
+async def stream_records(path: Path, batch_size: int = BATCH_SIZE) -> AsyncIterator[list[dict]]:
+    '''Batches of the records of a snapshot (JSONL or Arrow), read in a thread: the event loop isn't blocked'''
+    if path.suffix == ".arrow":
+        records = (row for frame in iter_arrow(path) for row in frame.iter_rows(named=True))
+    else:
+        records = iter_jsonl(path)
+
+    def next_batch() -> list[dict]:
+        return [record for _, record in zip(range(batch_size), records)]
+
+    while batch := await asyncio.to_thread(next_batch):
+        yield batch
+
+
+def _remove(path: Path) -> None:
+    if path.is_dir():
+        shutil.rmtree(path, ignore_errors=True)
+    else:
+        path.unlink(missing_ok=True)
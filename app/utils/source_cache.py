@@ -0,0 +1,87 @@
+'''Local cache of downloaded sources with the HTTP validators (ETag / Last-Modified) to revalidate them'''
+
+import json, time
+from dataclasses import dataclass, asdict
+from pathlib import Path
+from typing import Mapping
+
+from .files import CACHE_DIR, write_atomic
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+@dataclass(slots=True)
+class CachedSource:
+    body: str
+    etag: str | None = None
+    last_modified: str | None = None
+    fetched_at: float = 0.0  # unix time when the source confirmed the body (200 or 304)
+
+    def age(self) -> float:
+        return time.time() - self.fetched_at
+
+    def is_fresh(self, max_age: float) -> bool:
+        return self.age() < max_age
+
+    def validators(self) -> dict[str, str]:
+        '''Headers of a conditional request: the source answers "304 Not Modified" if the body is still valid'''
+        headers = dict()
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+
+class SourceCache:
+    """
+    Files per source in `cache_dir`:
+        <name>.txt        -- body
+        <name>.meta.json  -- validators and fetch time
+    """
+
+    def __init__(self, cache_dir: Path = CACHE_DIR / "sources") -> None:
+        self._dir = cache_dir
+
+    def get(self, name: str) -> CachedSource | None:
+        try:
+            meta = json.loads(self._meta_path(name).read_text(encoding="utf-8"))
+            body = self._body_path(name).read_text(encoding="utf-8")
+            return CachedSource(body=body, **meta)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, TypeError):
+            logger.warning(f"⚠️ Broken cache of {name=}: ignored", exc_info=True)
+            return None
+
+    def put(self, name: str, body: str, headers: Mapping[str, str]) -> CachedSource:
+        entry = CachedSource(body=body,
+                             etag=headers.get("ETag"),
+                             last_modified=headers.get("Last-Modified"),
+                             fetched_at=time.time())
+        try:
+            write_atomic(self._body_path(name), body)
+            self._write_meta(name, entry)
+        except OSError:
+            logger.exception(f"❌ Could not cache {name=}")
+        return entry
+
+    def touch(self, name: str, entry: CachedSource) -> None:
+        '''The source answered 304: the cached body is fresh again'''
+        entry.fetched_at = time.time()
+        try:
+            self._write_meta(name, entry)
+        except OSError:
+            logger.exception(f"❌ Could not update the cache of {name=}")
+
+    def _write_meta(self, name: str, entry: CachedSource) -> None:
+        meta = asdict(entry)
+        del meta["body"]
+        write_atomic(self._meta_path(name), json.dumps(meta))
+
+    def _body_path(self, name: str) -> Path:
+        return self._dir / f"{name}.txt"
+
+    def _meta_path(self, name: str) -> Path:
+        return self._dir / f"{name}.meta.json"
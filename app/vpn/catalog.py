@@ -0,0 +1,164 @@
+'''
+Columnar catalog of vpngate servers stored as Arrow IPC (uncompressed => memory-mapped on open).
+Metadata columns are queried without touching the heavy OpenVPN config blobs, a config is decoded per selected server.
+The endpoint of each config is decoded once, when the catalog is made, into columns of its own: the reachability
+probes (see prefilter) read them instead of decoding every config on every run.
+'''
+
+import base64, time
+from pathlib import Path
+from typing import Sequence
+
+import polars as pl
+
+from ..utils.files import CACHE_DIR
+from .connect import Endpoint, parse_remotes
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# Constants
+CATALOG_PATH = CACHE_DIR / "vpngate.arrow"
+CATALOG_MAX_AGE = 60 * 60      # sec: vpngate updates the list every hour
+CONFIG_COLUMN = "OpenVPN_ConfigData_Base64"
+SCHEMA = {  # column: type; values that don't fit the type (e.g. '-') become null
+    "HostName": pl.String,
+    "IP": pl.String,
+    "Score": pl.Int64,
+    "Ping": pl.Int32,
+    "Speed": pl.Int64,           # bit/s
+    "CountryLong": pl.String,
+    "CountryShort": pl.String,
+    "NumVpnSessions": pl.Int32,
+    "Uptime": pl.Int64,          # ms
+    "TotalUsers": pl.Int64,
+    "TotalTraffic": pl.Int64,
+    "LogType": pl.String,
+    "Operator": pl.String,
+    "Message": pl.String,
+    CONFIG_COLUMN: pl.String,
+}
+META_COLUMNS = [col for col in SCHEMA if col != CONFIG_COLUMN]
+ENDPOINT_SCHEMA = {  # the first `remote` of the config, see parse_remotes
+    "RemoteHost": pl.String,
+    "RemotePort": pl.Int32,
+    "RemoteProto": pl.String,
+}
+
+
+class Catalog:
+    """
+    Lazy view of the servers: nothing is read from the file before a query,
+    a query reads only the columns (and rows) it needs.
+    """
+
+    def __init__(self, frame: pl.LazyFrame, fetched_at: float) -> None:
+        self._frame = frame
+        self.fetched_at = fetched_at  # unix time of the download
+
+    @classmethod
+    def from_rows(cls, rows: Sequence[dict[str, str]]) -> "Catalog":
+        """
+        rows: parsed vpngate CSV, see VpngateParser.
+        The only eager decode of the catalog: every config once, and only its `remote` lines (and the `port`/`proto`
+        defaults) are parsed, into the endpoint columns. The catalog is saved right after: deferring it would only
+        move the cost into save().
+        """
+        endpoints = [_first_endpoint(row.get("HostName"), row.get(CONFIG_COLUMN)) for row in rows]
+        frame = pl.DataFrame(
+            {**{col: [row.get(col) for row in rows] for col in SCHEMA},
+             **{col: [endpoint[i] if endpoint else None for endpoint in endpoints] for i, col in enumerate(ENDPOINT_SCHEMA)}},
+            schema={**{col: pl.String for col in SCHEMA}, **ENDPOINT_SCHEMA},
+        ).with_columns(pl.col(col).cast(dtype, strict=False) for col, dtype in SCHEMA.items() if dtype != pl.String)
+
+        return cls(frame.lazy(), time.time())
+
+    @classmethod
+    def open(cls, path: Path = CATALOG_PATH) -> "Catalog | None":
+        '''Near-instant: the file is only memory-mapped, nothing is parsed'''
+        try:
+            fetched_at = path.stat().st_mtime
+            frame = pl.scan_ipc(path)
+        except (OSError, pl.exceptions.PolarsError):
+            logger.debug(f"No catalog at {path}", exc_info=True)
+            return None
+
+        logger.debug(f"📦 Opened the catalog {path}: age={time.time() - fetched_at:.0f}s")
+        return cls(frame, fetched_at)
+
+    def save(self, path: Path = CATALOG_PATH) -> None:
+        '''Atomically write uncompressed Arrow IPC: could be memory-mapped on open'''
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(path.name + ".tmp")
+        try:
+            self._frame.collect().write_ipc(tmp_path, compression="uncompressed")
+            tmp_path.replace(path)  # atomic rename
+            logger.debug(f"📝 Saved the catalog → {path}")
+        except (OSError, pl.exceptions.PolarsError):
+            logger.exception(f"❌ Could not save the catalog to {path}")
+
+    def age(self) -> float:
+        return time.time() - self.fetched_at
+
+    def is_fresh(self, max_age: float = CATALOG_MAX_AGE) -> bool:
+        return self.age() < max_age
+
+    def __len__(self) -> int:
+        return self._frame.select(pl.len()).collect().item()
+
+    def servers(self, *filters: pl.Expr, columns: Sequence[str] = META_COLUMNS) -> pl.DataFrame:
+        """
+        Metadata of the servers matching the filters; the config column isn't read unless asked.
+        Example: catalog.servers(pl.col("CountryShort") == "JP", pl.col("Score") > 100_000)
+        """
+        frame = self._frame.filter(*filters) if filters else self._frame
+        return frame.select(columns).collect()
+
+    def config(self, host_name: str) -> str | None:
+        '''Decode the .ovpn config of a single server'''
+        blobs = (self._frame
+                 .filter(pl.col("HostName") == host_name)
+                 .select(CONFIG_COLUMN)
+                 .head(1)
+                 .collect()
+                 .get_column(CONFIG_COLUMN))
+
+        if blobs.is_empty() or blobs[0] is None:
+            return None
+        return _decode(host_name, blobs[0])
+
+    def configs(self, *filters: pl.Expr) -> dict[str, str]:
+        '''Decoded .ovpn configs of the servers matching the filters: {HostName: config}; the broken ones are skipped'''
+        frame = self.servers(*filters, columns=["HostName", CONFIG_COLUMN])
+        return {
+            host_name: config
+            for host_name, blob in frame.iter_rows()
+            if blob and (config := _decode(host_name, blob)) is not None
+        }
+
+    def endpoints(self, *filters: pl.Expr) -> dict[str, Endpoint]:
+        '''The endpoints to probe of the servers matching the filters: {HostName: Endpoint}; no config is decoded'''
+        if not set(ENDPOINT_SCHEMA) <= set(self._frame.collect_schema().names()):  # saved before the endpoint columns
+            return {host_name: remotes[0] for host_name, config in self.configs(*filters).items()
+                    if (remotes := parse_remotes(config))}
+
+        frame = self.servers(*filters, columns=["HostName", *ENDPOINT_SCHEMA])
+        return {host_name: Endpoint(host, port, proto)
+                for host_name, host, port, proto in frame.iter_rows()
+                if host is not None and port is not None}
+
+
+def _decode(host_name: str | None, blob: str) -> str | None:
+    '''A config cell as .ovpn text, None (and a warning) if it isn't base64'''
+    try:
+        return base64.b64decode(blob).decode("utf-8", errors="replace")
+    except ValueError:  # binascii.Error
+        logger.warning(f"⚠️ Undecodable config of {host_name}: skipped")
+        return None
+
+
+def _first_endpoint(host_name: str | None, blob: str | None) -> Endpoint | None:
+    if not blob or (config := _decode(host_name, blob)) is None or not (remotes := parse_remotes(config)):
+        return None
+    return remotes[0]
@@ -1,26 +1,183 @@
-# def try_connect_ovpn_config(ovpn_text, timeout=60):
-#     with NamedTemporaryFile("w", suffix=".ovpn", delete=False) as f:
-#         f.write(ovpn_text)
-#         ovpn_path = f.name
-
-#     try:
-#         proc = subprocess.Popen(
-#             ["sudo", "openvpn", "--config", ovpn_path],
-#             stdout=subprocess.PIPE,
-#             stderr=subprocess.STDOUT,
-#             text=True
-#         )
-
-#         t_start = time.time()
-#         while time.time() - t_start < timeout:
-#             line = proc.stdout.readline()
-#             if "Initialization Sequence Completed" in line:
-#                 print("[+] Connected successfully!")
-#                 proc.terminate()
-#                 return True
-#             if "TLS Error" in line or "Connection refused" in line:
-#                 break
-#         proc.terminate()
-#         return False
-#     finally:
-#         os.remove(ovpn_path)
\ No newline at end of file
+'''
+Connecting to the VPN servers.
+Starting `openvpn` is expensive (a process per config, up to a minute), so the servers are prefiltered first:
+thousands of cheap async probes (TCP connect / UDP OpenVPN hard reset) rank them by RTT, and only the top few
+reach try_connect_ovpn_config().
+'''
+
+import asyncio, os, secrets, struct
+from asyncio import TimeoutError
+from tempfile import NamedTemporaryFile
+from typing import Mapping, NamedTuple
+
+from ..configs.file_descriptors import is_local_error
+from ..configs.metrics import metrics
+from ..utils.governor import Governor
+from ..utils.scheduler import race
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# Constants
+PROBE_TIMEOUT = 3.0          # sec per reachability probe
+PREFILTER_IN_FLIGHT = 1000   # probes at once at most: one socket each; the Governor keeps it within the FD budget
+SHORTLIST = 5                # the best servers passed to openvpn
+DEFAULT_PORT, DEFAULT_PROTO = 1194, "udp"
+P_CONTROL_HARD_RESET_CLIENT_V2 = 7  # OpenVPN opcodes: the first packet of a session and the answer to it
+P_CONTROL_HARD_RESET_SERVER_V2 = 8
+
+
+class Endpoint(NamedTuple):
+    host: str
+    port: int
+    proto: str  # 'udp' | 'tcp'
+
+
+def parse_remotes(ovpn_text: str) -> list[Endpoint]:
+    '''Endpoints of a config: `remote <host> [port] [proto]`, defaults from the `port` and `proto` lines'''
+    default_port, default_proto = DEFAULT_PORT, DEFAULT_PROTO
+    remotes: list[list[str]] = []
+
+    for line in ovpn_text.splitlines():
+        words = line.split('#', 1)[0].split()
+        if not words:
+            continue
+        if words[0] == "proto" and len(words) > 1:
+            default_proto = words[1]
+        elif words[0] == "port" and len(words) > 1 and words[1].isdigit():
+            default_port = int(words[1])
+        elif words[0] == "remote" and len(words) > 1:
+            remotes.append(words[1:])
+
+    endpoints = []
+    for remote in remotes:
+        port = int(remote[1]) if len(remote) > 1 and remote[1].isdigit() else default_port
+        proto = remote[2] if len(remote) > 2 else default_proto
+        endpoints.append(Endpoint(remote[0], port, "tcp" if proto.startswith("tcp") else "udp"))
+    return endpoints
+
+
+async def probe_endpoint(endpoint: Endpoint, timeout: float = PROBE_TIMEOUT) -> float | None:
+    '''RTT in sec, None if the server didn't answer'''
+    return (await _probe_outcome(endpoint, timeout))[1]
+
+
+async def prefilter(endpoints: Mapping[str, Endpoint],
+                    top: int = SHORTLIST,
+                    timeout: float = PROBE_TIMEOUT,
+                    max_in_flight: int = PREFILTER_IN_FLIGHT) -> list[tuple[float, str]]:
+    """
+    endpoints: {server name: the first endpoint of its config}, e.g. Catalog.endpoints()
+    Probe every endpoint, return the `top` reachable servers: [(rtt, server name), ...] by RTT.
+    """
+    governor = Governor(initial=max_in_flight, max_limit=max_in_flight)
+
+    async def probe(item: tuple[str, Endpoint]) -> tuple[float, str] | None:
+        name, endpoint = item
+        outcome, rtt = await _probe_outcome(endpoint, timeout)
+        governor.record(outcome)
+        return (rtt, name) if rtt is not None else None
+
+    with metrics.stage("prefilter"):
+        reachable = await race(probe, endpoints.items(), goal=len(endpoints), max_in_flight=max_in_flight, governor=governor)
+    reachable.sort()
+
+    logger.info(f"📡 {len(reachable)}/{len(endpoints)} VPN servers are reachable")
+    return reachable[:top]
+
+
+async def try_connect_ovpn_config(ovpn_text: str, timeout: float = 60) -> bool:
+    '''The expensive check: start openvpn with the config and wait for the tunnel'''
+    with NamedTemporaryFile("w", suffix=".ovpn", delete=False) as f:
+        f.write(ovpn_text)
+        ovpn_path = f.name
+
+    async def wait_connected(proc: asyncio.subprocess.Process) -> bool:
+        async for raw_line in proc.stdout:
+            line = raw_line.decode(errors="replace")
+            if "Initialization Sequence Completed" in line:
+                return True
+            if "TLS Error" in line or "Connection refused" in line:
+                return False
+        return False
+
+    proc = None
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            "sudo", "openvpn", "--config", ovpn_path,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT,
+        )
+        connected = await asyncio.wait_for(wait_connected(proc), timeout)
+        if connected:
+            logger.info("[+] Connected successfully!")
+        return connected
+    except TimeoutError:
+        return False
+    finally:
+        if proc is not None and proc.returncode is None:
+            proc.terminate()
+            await proc.wait()
+        os.remove(ovpn_path)
+
+
+async def _probe_outcome(endpoint: Endpoint, timeout: float) -> tuple[str, float | None]:
+    '''(outcome for the Governor, RTT in sec or None)'''
+    try:
+        if endpoint.proto == "tcp":
+            return "ok", await _probe_tcp(endpoint, timeout)
+        return "ok", await _probe_udp(endpoint, timeout)
+    except TimeoutError:
+        return "timeout", None
+    except OSError as e:
+        return ("local_error" if is_local_error(e) else "refused"), None
+
+
+async def _probe_tcp(endpoint: Endpoint, timeout: float) -> float:
+    '''TCP handshake time: the server listens on the port'''
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    _, writer = await asyncio.wait_for(asyncio.open_connection(endpoint.host, endpoint.port), timeout)
+    rtt = loop.time() - start
+
+    writer.close()
+    return rtt
+
+
+async def _probe_udp(endpoint: Endpoint, timeout: float) -> float:
+    '''
+    Send P_CONTROL_HARD_RESET_CLIENT_V2 and wait for P_CONTROL_HARD_RESET_SERVER_V2:
+    UDP has no handshake, only an OpenVPN answer proves the server is alive.
+    Servers with tls-auth / tls-crypt drop the packet: they look unreachable.
+    '''
+    loop = asyncio.get_running_loop()
+    reply = loop.create_future()
+    transport, _ = await loop.create_datagram_endpoint(lambda: _HardResetProtocol(reply),
+                                                       remote_addr=(endpoint.host, endpoint.port))
+    try:
+        start = loop.time()
+        transport.sendto(_hard_reset_packet())
+        await asyncio.wait_for(reply, timeout)
+        return loop.time() - start
+    finally:
+        transport.close()
+
+
+def _hard_reset_packet() -> bytes:
+    # opcode << 3 | key_id, session id, ack array length, packet id
+    return struct.pack("!B8sBI", P_CONTROL_HARD_RESET_CLIENT_V2 << 3, secrets.token_bytes(8), 0, 0)
+
+
+class _HardResetProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self, reply: asyncio.Future) -> None:
+        self._reply = reply
+
+    def datagram_received(self, data: bytes, addr: tuple) -> None:
+        if data and data[0] >> 3 == P_CONTROL_HARD_RESET_SERVER_V2 and not self._reply.done():
+            self._reply.set_result(None)
+
+    def error_received(self, exc: Exception) -> None:  # e.g. ICMP port unreachable
+        if not self._reply.done():
+            self._reply.set_exception(exc)
@@ -1,195 +1,263 @@
-import sys
+import sys, time
+from functools import cache
 from pathlib import Path
+from typing import TYPE_CHECKING, AsyncIterable, Callable, Iterable, Mapping, NamedTuple
 
-import aiohttp, asyncio
 from asyncio import TimeoutError, IncompleteReadError
-from aiohttp import TCPConnector, ClientProxyConnectionError, ClientTimeout, ServerDisconnectedError, ClientOSError, ClientResponseError
-from python_socks import ProxyError
-from aiohttp_socks import ProxyConnector
-
-import polars as pl
 
+from ..configs.dns import dns
+from ..configs.logs import OutcomeLog
+from ..configs.metrics import metrics
+from ..configs.file_descriptors import is_local_error
+from ..proxy import health
+from ..proxy.detect import detect_protocols
+from ..proxy.health import HealthStore, HEALTH_STATE
+from ..proxy.table import Proxy, ProxyTable
 from ..utils.files import from_json
+from ..utils.governor import Governor
+from ..utils.scheduler import race
+from .mirrors import MirrorPicker, merge_servers
+from .parse import VpngateParser
+
+if TYPE_CHECKING:  # heavy: aiohttp, aiohttp_socks and polars are imported by the stages that use them
+    from aiohttp import ClientResponse
+    from ..configs.web_sessions import SessionPool
+    from ..proxy.query import Query
+    from ..utils.snapshots import JsonlWriter
+    from .catalog import Catalog
 
 import logging
 logger = logging.getLogger(__name__)
 
 
 # Constants
-TIMEOUT_GET_RAW_VPN = ClientTimeout(total=10)
-VPN_SOURCES = from_json(Path(__file__).parent / 'sources.json')  # look to README to see more sources
-
-
-async def get_vpns_from_web(proxies: list[dict[str, str | bool]]) -> str | None:
+TIMEOUT_GET_RAW_VPN = 10     # sec
+HEAD_BYTES = 512              # enough to reject the junk (captive portals, HTML error pages) by the first bytes
+CHUNK_SIZE = 64 * 1024        # the body is fed to the parser chunk by chunk
+REQUEST_HEADERS = {"Accept-Encoding": "gzip"}  # ~4x less bytes via slow proxies; aiohttp decompresses on the fly
+WAVE_SIZE = 32                # the best ranked proxies are probed alone first, see race()
+SOURCES_PATH = Path(__file__).parent / 'sources.json'  # look to README to see more sources
+ORIGIN_OUTCOMES = frozenset({"bad_http", "invalid_payload"})  # the failures of the mirror, not of the proxy
+
+
+@cache
+def vpn_sources() -> dict[str, str]:
+    '''{source name: url} of the vpngate API and its mirrors; read on the first call'''
+    return from_json(SOURCES_PATH)
+
+
+class Verified(NamedTuple):
+    """A proxy that got a good VPN list: the probe latency and the list"""
+    proxy: Proxy
+    latency: float
+    servers: list[dict[str, str]]
+
+
+async def get_vpns_from_web(proxies: Iterable[Proxy] | AsyncIterable[Proxy],
+                            goal: int = 1,
+                            max_in_flight: int | None = None,
+                            sources: Mapping[str, str] | None = None,
+                            health_state: str | None = HEALTH_STATE,
+                            sink: "JsonlWriter | None" = None,
+                            table: ProxyTable | None = None,
+                            n_shards: int | None = None) -> list[dict[str, str]]:
     """
-    Try async via each proxy, return the first successful response body.
+    Try async via the proxies with the adaptive number of probes at once (see Governor, capped by `max_in_flight`
+    if it's set), each probe asks a VPN source (the vpngate API or a mirror) picked by MirrorPicker. Return the servers
+    of the first `goal` successful responses merged into one deduplicated list. Pending probes are cancelled as soon
+    as the goal is met.
+    `proxies` could be a stream (see stream_proxies): probing starts before all the sources are downloaded.
+    sources: {source name: url} of the vpngate API and its mirrors, vpn_sources() by default.
+    health_state: the HealthStore of the proxies, None for the Tor circuits (not persisted, see tor.py).
+    sink: a snapshot writer that gets a record per finished probe while the probing goes on.
+    table: the ProxyTable of the proxies: their protocols are detected before the fetch (see detect.py).
+    n_shards: probe in so many worker processes, an event loop each (see shards.py); None: in this process.
     """
 
-    logger.debug(f"Starting VPN fetch by all proxies")
-
-    source = 'vpngate'  # TODO: should be optimised for many sources
-    tasks = [
-        asyncio.create_task(_get_raw_vpns(proxy_meta['protocol'], proxy_meta['ip_port']))  # , sources=source))
-        for proxy_meta in proxies
-        # here could be filters for country, security and others (not all proxies supports)
-    ]
-    
-    for task in asyncio.as_completed(tasks):  # could be changed 'async for task ...' if using CPython3.13+
-        result = await task
-        if result:
-            logger.info("✅ Got the first successful response")
-            ### THE ASYNCIO THEORY ###
-            # don't need to cancel leftover tasks: each has a timeout and RC will delete:
-            #   - p.s.: if sockets, connectors, buffers, etc are needed to be free then you should cancel all tasks before the get_vpns return anything
-            #   - coroutine’s frame, locals, and instruction pointer in this coroutine CPyhton object
-            #   - Task(...) is a wrapper around a (self._coro) coroutine to which the coroutine returns a value/error
-            #   - EventLoop has dqueue in self._ready
-            #   - create_task(Task(...)) steps:
-            #       1. handle = events.Handle(Task(...)._step, (), self, context)
-            #       2. in EventLoop: self._ready.append(handle) → strong link to Task(...) in the dqueue
-
-            #   - tasks has a strong refs to each Task(...); EventLoop has strong refs to each Task(...) before it has been done and weak refs after 
-            #   
-            #   - get_vpns func returns → RC deletes tasks and:
-            #       - if Task(...) status is done:
-            #           RC deletes Task(...) → coroutine object
-            #       - else:
-            #           Task(...) is alive before it's statuce is done
-            return result
-
-            # df = _vpn_preprocessing(result, source)
-            
-            # TODO: Plugin into CSV / JSON
-        
-    logger.warning("❌ No working proxy found.")
-    sys.exit(1)  # terminate with a non-zero exit code
+    if n_shards:
+        from .shards import probe_sharded
 
+        results = await probe_sharded(proxies, goal, n_shards, max_in_flight, sources, health_state, sink, table)
+    else:
+        results = await probe_proxies(proxies, goal, max_in_flight, sources, health_state, sink, table)
+    if results:
+        servers = merge_servers(result.servers for result in results)
+        logger.info(f"✅ Got {len(results)} successful response{'s' if len(results) != 1 else ''}: {len(servers)} servers")
+        return servers
 
-# async _get_vpns_from_local(...) -> str | None:
-#     ...
+    logger.warning("❌ No working proxy found.")
+    sys.exit(1)  # terminate with a non-zero exit code
 
 
-# async def get_vpns_from_web(proxies: list[dict[str, str | bool]]) -> str | None:
-#     ...
-#     async while
+async def probe_proxies(proxies: Iterable[Proxy] | AsyncIterable[Proxy],
+                        goal: int = 1,
+                        max_in_flight: int | None = None,
+                        sources: Mapping[str, str] | None = None,
+                        health_state: str | None = HEALTH_STATE,
+                        sink: "JsonlWriter | None" = None,
+                        table: ProxyTable | None = None,
+                        on_verified: Callable[[Verified], None] | None = None,
+                        query: "Query | None" = None) -> list[Verified]:
+    """
+    The probing of get_vpns_from_web(): the first `goal` proxies that got a good VPN list, [] if none.
+    health_state None: nothing is loaded or saved (the Tor circuits, or a shard worker: its coordinator ranks and
+    records, see shards.py).
+    on_verified: called with each success as soon as it comes.
+    query: the one the proxies are filtered by (see query.py). The historically best proxies aren't put ahead of
+    a stream then: they aren't in the table yet to be matched, the matching ones come with the stream anyway.
+    """
+    from ..configs.web_sessions import SessionPool  # aiohttp
 
+    sources = vpn_sources() if sources is None else sources
 
-async def _get_raw_vpns(protocol: str, ip_port: str) -> str | None: #, sources: tuple | str) -> str | None:
+    proxy_health = HealthStore(health_state).load() if health_state is not None else HealthStore()
+    if isinstance(proxies, AsyncIterable):
+        proxies = proxy_health.rank_stream(proxies, n_best=0 if query is not None else health.N_BEST)
+    else:
+        proxies = proxy_health.rank(proxies)  # the historically best first, the failing ones are skipped
+    if table is not None:
+        proxies = detect_protocols(proxies, table, health=proxy_health)  # one cheap round-trip per proxy instead of a fetch per guess
+
+    governor = Governor()
+    max_in_flight = max_in_flight or governor.ceiling
+    logger.debug(f"Starting VPN fetch: {goal=}, {max_in_flight=}")
+
+    mirrors = MirrorPicker(sources)
+    outcomes = OutcomeLog(logger, metric="probe_outcomes", on_outcome=governor.record)
+    async with SessionPool() as pool:
+
+        async def probe(proxy: Proxy) -> Verified | None:
+            source = mirrors.pick()
+            start = time.monotonic()
+            servers, outcome = await _get_raw_vpns(pool, proxy.protocol, proxy.ip_port, source, sources[source], outcomes)
+            # cancelled probes (losers of the race) raise CancelledError and aren't recorded
+            elapsed = time.monotonic() - start
+            metrics.observe("probe_seconds", elapsed)
+            if servers:
+                metrics.first_success()
+            latency = elapsed if servers else None
+            proxy_health.record(health.key(proxy), latency)
+            if servers or outcome in ORIGIN_OUTCOMES:  # ~90% of the free proxies fail: that says nothing of the mirror
+                mirrors.record(source, latency)
+            if sink is not None:
+                sink.write({"proxy": health.key(proxy), "source": source, "latency": elapsed,
+                            "servers": len(servers) if servers else 0, "outcome": outcome, "at": time.time()})
+            if not servers:
+                return None
+            verified = Verified(proxy, elapsed, servers)
+            if on_verified is not None:
+                on_verified(verified)
+            return verified
+
+        try:
+            with metrics.stage("probe_fanout"):
+                return await race(
+                    probe,
+                    proxies,
+                    # filters for country, security and others are applied before, see query.py
+                    goal=goal,
+                    max_in_flight=max_in_flight,
+                    wave_size=WAVE_SIZE,
+                    governor=governor,
+                )
+        finally:
+            outcomes.summary()
+            if health_state is not None:
+                proxy_health.save()
+                mirrors.save()
+
+
+def get_vpns_from_local(max_age: float | None = None) -> "Catalog | None":
+    """The catalog saved by a previous run if it's younger than `max_age` (CATALOG_MAX_AGE): no network at all"""
+    from .catalog import Catalog, CATALOG_MAX_AGE  # polars
+
+    max_age = CATALOG_MAX_AGE if max_age is None else max_age
+    if (catalog := Catalog.open()) is not None and catalog.is_fresh(max_age):
+        logger.info(f"📦 Using the local catalog: age={catalog.age():.0f}s")
+        return catalog
+    return None
+
+
+async def _get_raw_vpns(pool: "SessionPool", protocol: str, ip_port: str, source: str, url: str,
+                        outcomes: OutcomeLog) -> tuple[list[dict[str, str]] | None, str]:
+    '''(the servers or None, the outcome): the outcome tells the failures of the origin, see ORIGIN_OUTCOMES'''
+    # imported on the first probe, then only the names are looked up
+    from aiohttp import (ClientError, ClientOSError, ClientPayloadError, ClientProxyConnectionError, ClientResponseError,
+                         ClientTimeout, ServerDisconnectedError)
+    from aiohttp_socks import ProxyConnectionError, ProxyError as SocksProxyError, ProxyTimeoutError
+    from python_socks import ProxyError
 
     proxy = f'{protocol}://{ip_port}'
-    connector, proxy_arg = _create_proxy_connector(protocol, proxy)
-    
+    # an HTTP proxy or the SOCKS4 client would resolve the name per probe; a SOCKS5 proxy resolves it (rdns)
+    pinned_url, host, server_hostname = dns.pin(url) if protocol != "socks5" else (url, {}, None)
+
     try:
-        # TODO: 'sources' and 'url' should be optimised for many sources
-        url = list(VPN_SOURCES.values())[0]
-        async with aiohttp.ClientSession(connector=connector, raise_for_status=True) as session:
-            async with session.get(url, proxy=proxy_arg, timeout=TIMEOUT_GET_RAW_VPN) as resp:
-                body = await resp.text()
-                if is_good_resp(source := 'vpngate', body):
-                    logger.debug(f"✅ GOT openvpn data: {url=} via {proxy=}")
-                    return body
-
-            # TODO: make the code for many VPN sources:
-            # raw_data = dict()
-            # for source, url in VPN_SOURCES.items():
-            #     async with session.get(url, proxy=proxy_arg, timeout=TIMEOUT_GET_RAW_VPN) as resp:
-            #         body = await resp.text()
-
-            #         if is_good_resp(source, body):
-            #             logger.debug(f"✅ GOT openvpn data: {url=} via {proxy=}")
-            #             raw_data[source] = body
-            #         else:
-            #             logger.debug(f"⚠️ Invalid HTML payload via {proxy=}. HTML {len(body)=}")
-    except TimeoutError:
-        logger.debug(f"⏳ Timeout:\t{proxy=}")
+        async with pool.session(protocol, proxy) as (session, proxy_arg):
+            async with session.get(pinned_url, proxy=proxy_arg, headers=REQUEST_HEADERS | host, server_hostname=server_hostname,
+                                   timeout=ClientTimeout(total=TIMEOUT_GET_RAW_VPN)) as resp:
+                servers, outcome = await _read_vpns(resp, source, proxy, outcomes)
+                if servers is not None:
+                    outcomes.record(outcome, "✅ GOT openvpn data: url=%r via proxy=%r", url, proxy)
+                return servers, outcome
+
+    except (TimeoutError, ProxyTimeoutError):
+        outcome = "timeout"
+        outcomes.record(outcome, "⏳ Timeout:\tproxy=%r", proxy)
     except IncompleteReadError:
-        logger.debug(f"❌ SOCKS handshake failed: {proxy=}")
-    except (ClientProxyConnectionError, ProxyError) as e:
-        logger.debug(f"🚫 Proxy connection error:\t{proxy=}")
-    except ServerDisconnectedError as e:
-        logger.debug(f"🔌 Disconnected:\t{proxy=}")
+        outcome = "socks_handshake"
+        outcomes.record(outcome, "❌ SOCKS handshake failed: proxy=%r", proxy)
+    except (ClientProxyConnectionError, ProxyError, SocksProxyError, ProxyConnectionError) as e:  # aiohttp_socks has own errors
+        outcome = "local_error" if is_local_error(e) else "proxy_error"
+        outcomes.record(outcome, "🚫 Proxy connection error:\tproxy=%r", proxy)
+    except ServerDisconnectedError:
+        outcome = "disconnected"
+        outcomes.record(outcome, "🔌 Disconnected:\tproxy=%r", proxy)
     except ClientOSError as e:
-        logger.debug(f"❗ OS error:\t{proxy=}")
+        outcome = "local_error" if is_local_error(e) else "os_error"
+        outcomes.record(outcome, "❗ OS error:\tproxy=%r", proxy)
     except ClientResponseError as e:
-        logger.debug(f"⚠️  Bad HTTP: {e.status=}\t{proxy=}")
+        outcome = "bad_http"
+        outcomes.record(outcome, "⚠️  Bad HTTP: e.status=%s\tproxy=%r", e.status, proxy)
+    except ClientPayloadError:  # a short body, a broken chunked encoding or gzip stream
+        outcome = "truncated"
+        outcomes.record(outcome, "✂️ Truncated payload via proxy=%r", proxy)
+    except ClientError as e:
+        outcome = "proxy_error"
+        outcomes.record(outcome, "🚫 Client error %r:\tproxy=%r", e, proxy)
     except Exception:
-        logger.exception(f"❌ Unexpected error in '_get_raw_vpns' for {proxy=}")
+        logger.exception("❌ Unexpected error in '_get_raw_vpns' for proxy=%r", proxy)
         raise
+    return None, outcome
 
 
-def _create_proxy_connector(protocol: str, proxy: str) -> tuple[ProxyConnector | TCPConnector, str]:
-    """Return an aiohttp/aiohttp_socks connector and proxy argument based on the proxy protocol."""
-
-    if "socks5" == protocol:
-        connector = ProxyConnector.from_url(proxy, rdns=True)
-        proxy_arg = None       # handled by the connector itself
-    elif "socks" in protocol:  # socks5h, socks4, ...:
-        connector = ProxyConnector.from_url(proxy)
-        proxy_arg = None
-    elif "http" in protocol:  # http, https
-        connector = TCPConnector()             # normal TCP; aiohttp does the CONNECT
-        proxy_arg = proxy     # pass to session.get
-    else:
-        raise ValueError(f"Unknown proxy protocol: {protocol!r}")
-    
-    return connector, proxy_arg
+async def _read_vpns(resp: "ClientResponse", source: str, proxy: str,
+                     outcomes: OutcomeLog) -> tuple[list[dict[str, str]] | None, str]:
+    """
+    Stream the body: reject it by the first HEAD_BYTES, then parse the rows while they are downloading.
+    Return (None, the outcome) for junk or truncated bodies.
+    """
+    head = b""
+    while len(head) < HEAD_BYTES and (chunk := await resp.content.read(HEAD_BYTES - len(head))):
+        head += chunk
 
+    if not is_good_resp(source, head.decode("utf-8", errors="replace")):
+        outcomes.record("invalid_payload", "⚠️ Invalid payload via proxy=%r: %r", proxy, head[:64])
+        return None, "invalid_payload"  # leaving 'async with session.get' drops the connection: the rest isn't downloaded
 
-def is_good_resp(source: str, data: str) -> bool:
+    parser = VpngateParser()
+    parser.feed(head)
+    async for chunk in resp.content.iter_chunked(CHUNK_SIZE):
+        parser.feed(chunk)
 
-    if source == "vpngate":
-        if data.lstrip().startswith("*vpn_servers"):  # got the expected *vpn_servers CSV header
-            return True
-        return False
-    
-    elif ...:
-        
-        ...
+    if not parser.close():
+        outcomes.record("truncated", "✂️ Truncated payload via proxy=%r: %d rows", proxy, len(parser.rows))
+        return None, "truncated"
 
+    return parser.rows, "ok"
 
-# def _vpn_preprocessing(proxies_store: dict, source: str, raw_data: str) -> None:
-def _vpn_preprocessing(source: str, raw_data: str) -> list[dict[str, str | bool]]:
-    '''clean the responce from proxy sources'''
-    vpn_meta: list[dict[str, str | bool]] = []
 
-    try:
-        if source == "vpngate":
-            # delete the last * and # in a hedder
-            raw_data = raw_data.rstrip().rstrip('*') \
-                            .replace("#", '', count=1)
-            
-            return pl.read_csv(raw_data.encode(),  # feed Polars a bytes buffer
-                               skip_rows=1,        # drop the first row: '*vpn_servers'
-                               has_header=True
-            )
-        
-    except Exception:
-        ...
-
-
-# def try_connect_ovpn_config(ovpn_text, timeout=60):
-#     with NamedTemporaryFile("w", suffix=".ovpn", delete=False) as f:
-#         f.write(ovpn_text)
-#         ovpn_path = f.name
-
-#     try:
-#         proc = subprocess.Popen(
-#             ["sudo", "openvpn", "--config", ovpn_path],
-#             stdout=subprocess.PIPE,
-#             stderr=subprocess.STDOUT,
-#             text=True
-#         )
-
-#         t_start = time.time()
-#         while time.time() - t_start < timeout:
-#             line = proc.stdout.readline()
-#             if "Initialization Sequence Completed" in line:
-#                 print("[+] Connected successfully!")
-#                 proc.terminate()
-#                 return True
-#             if "TLS Error" in line or "Connection refused" in line:
-#                 break
-#         proc.terminate()
-#         return False
-#     finally:
-#         os.remove(ovpn_path)
\ No newline at end of file
+def is_good_resp(source: str, data: str) -> bool:
+    """data: the whole body or its head. Only the vpngate API and its mirrors have a known format."""
+    if source.startswith("vpngate"):
+        return data.lstrip().startswith("*vpn_servers")  # the expected *vpn_servers CSV header
+    return False
@@ -0,0 +1,58 @@
+'''
+Racing the vpngate API and its mirrors: each probe goes to a mirror picked by the mirror's past performance,
+so the probes in flight race all the mirrors at once and the slow or blocked ones are demoted.
+'''
+
+import random
+from typing import Iterable
+
+from ..proxy.health import HealthStore, MAX_FAIL_STREAK
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# Constants
+MIRROR_HEALTH = "mirror_health"  # file name in STATE_DIR
+DEMOTED_WEIGHT = 0.05            # a mirror that keeps failing is still probed sometimes: to notice it's back
+
+
+class MirrorPicker:
+    """
+    Weighted random choice of a source: weight = 1 / expected time to get a success (see ProxyHealth.score).
+    Only the successes and the failures of the origin itself are recorded (see ORIGIN_OUTCOMES in get.py): most
+    free proxies fail whatever the mirror, charging them to it would demote every mirror alike.
+    """
+
+    def __init__(self, sources: Iterable[str], name: str = MIRROR_HEALTH) -> None:
+        self._sources = list(sources)
+        self._health = HealthStore(name).load()
+
+    def weights(self) -> list[float]:
+        weights = []
+        for source in self._sources:
+            if (health := self._health.get(source)) is None:
+                weights.append(1 / HealthStore.NEW_SCORE)
+            else:
+                weight = 1 / health.score()
+                weights.append(weight * DEMOTED_WEIGHT if health.fail_streak >= MAX_FAIL_STREAK else weight)
+        return weights
+
+    def pick(self) -> str:
+        return random.choices(self._sources, weights=self.weights())[0]
+
+    def record(self, source: str, latency: float | None) -> None:
+        self._health.record(source, latency)
+
+    def save(self) -> None:
+        logger.debug("Mirror weights: " + ", ".join(f"{s}={w:.3f}" for s, w in zip(self._sources, self.weights())))
+        self._health.save()
+
+
+def merge_servers(results: Iterable[list[dict[str, str]]]) -> list[dict[str, str]]:
+    '''Merge the server lists of different sources into one, deduplicated by HostName (the first seen wins)'''
+    servers: dict[str, dict[str, str]] = dict()
+    for rows in results:
+        for row in rows:
+            servers.setdefault(row.get("HostName") or row.get("IP"), row)
+    return list(servers.values())
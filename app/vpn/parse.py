@@ -0,0 +1,57 @@
+'''Incremental parser of the vpngate CSV: rows are parsed while the body is still downloading'''
+
+import csv
+
+
+# Constants
+HEADER_MARK = "*vpn_servers"  # the first line of the body
+END_MARK = "*"                # the last line of the body: no END_MARK => truncated download
+
+
+class VpngateParser:
+    """
+    Feed the raw chunks as they arrive, collect the servers in `rows`: [{column: value}, ...].
+    Body layout:
+        *vpn_servers
+        #HostName,IP,Score,Ping,...,OpenVPN_ConfigData_Base64
+        <row>
+        ...
+        *
+    """
+
+    def __init__(self) -> None:
+        self.rows: list[dict[str, str]] = []
+        self.complete = False            # got the END_MARK line
+        self.n_broken = 0                # rows of a wrong length: skipped
+        self._header: list[str] | None = None
+        self._tail = b""                 # not finished line of the last chunk
+
+    def feed(self, chunk: bytes) -> None:
+        lines = (self._tail + chunk).split(b"\n")
+        self._tail = lines.pop()
+        for line in lines:
+            self._feed_line(line)
+
+    def close(self) -> bool:
+        '''Flush the last line; return True if the whole body was received'''
+        if self._tail:
+            self._feed_line(self._tail)
+            self._tail = b""
+        return self.complete
+
+    def _feed_line(self, raw_line: bytes) -> None:
+        line = raw_line.decode("utf-8", errors="replace").strip()
+
+        if not line or line == HEADER_MARK:
+            return
+        if line == END_MARK:
+            self.complete = True
+            return
+
+        values = next(csv.reader([line]))
+        if self._header is None:
+            self._header = [col.lstrip("#") for col in values]  # '#HostName' -> 'HostName'
+        elif len(values) == len(self._header):                 # skip broken rows
+            self.rows.append(dict(zip(self._header, values)))
+        else:
+            self.n_broken += 1
@@ -0,0 +1,186 @@
+'''
+Server selection: the best vpngate servers per country and metric, kept up to date incrementally.
+Every (metric, country) has a heap of its servers with lazy invalidation: a changed server is pushed again and its
+old entry is skipped when it reaches the top. A new catalog is diffed against the applied one by HostName, so only
+the added, removed and changed servers touch the heaps; the top-k lists are cached until a change reaches them.
+best() is O(k) on a cached list, O(k log n) after a change.
+'''
+
+import heapq, math
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Iterable, Mapping
+
+if TYPE_CHECKING:
+    from .catalog import Catalog
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# Constants
+RANKED_COLUMNS = ["HostName", "CountryShort", "Score", "Ping", "Speed", "NumVpnSessions"]
+METRICS = ("blend", "score", "speed", "ping", "sessions")
+ANY_COUNTRY = "*"
+UNKNOWN_PING = 300          # ms: the advertised ping of a server that has none
+ADVERTISED_PENALTY = 50     # ms: vpngate's ping is measured from Japan, a local RTT is trusted more
+SESSIONS_SCALE = 50         # sessions that double the blended cost (a loaded server is slow)
+REFERENCE_SPEED = 10 ** 7   # bit/s that keep the blended cost as it is
+TOP_K = 20                  # best() is cached for up to k servers
+
+
+@dataclass(frozen=True, slots=True)
+class Diff:
+    added: list[str]
+    removed: list[str]
+    changed: list[str]
+
+    def __len__(self) -> int:
+        return len(self.added) + len(self.removed) + len(self.changed)
+
+
+def blended_cost(row: Mapping, rtt: float | None) -> float:
+    """
+    Expected latency (ms) inflated by the load and deflated by the bandwidth: lower is better.
+    The measured RTT is used if there is one, the advertised Ping (+ ADVERTISED_PENALTY) otherwise.
+    """
+    latency = rtt * 1000 if rtt is not None else (row.get("Ping") or UNKNOWN_PING) + ADVERTISED_PENALTY
+    load = 1 + (row.get("NumVpnSessions") or 0) / SESSIONS_SCALE
+    bandwidth = math.log10(max(row.get("Speed") or 0, 10)) / math.log10(REFERENCE_SPEED)
+    return latency * load / bandwidth
+
+
+def _sort_key(metric: str, row: Mapping, rtt: float | None) -> float:
+    '''Lower is better; a missing value is the worst'''
+    match metric:
+        case "blend":
+            return blended_cost(row, rtt)
+        case "score":
+            return -(row.get("Score") or 0)
+        case "speed":
+            return -(row.get("Speed") or 0)
+        case "ping":
+            return rtt * 1000 if rtt is not None else row.get("Ping") or math.inf
+        case "sessions":
+            sessions = row.get("NumVpnSessions")
+            return sessions if sessions is not None else math.inf
+    raise ValueError(f"Unknown metric {metric!r}: one of {', '.join(METRICS)}")
+
+
+@dataclass(slots=True)
+class _TopK:
+    '''Heap of (key, host) with lazy invalidation; `keys` has the valid key of every member'''
+    heap: list[tuple[float, str]] = field(default_factory=list)
+    keys: dict[str, float] = field(default_factory=dict)
+    top: list[str] | None = None    # cached best() of up to TOP_K members
+
+    def put(self, host: str, key: float) -> None:
+        if self.keys.get(host) == key:
+            return
+        self.keys[host] = key
+        heapq.heappush(self.heap, (key, host))
+        if self.top is not None and (len(self.top) < TOP_K or host in self.top or key <= self.keys[self.top[-1]]):
+            self.top = None
+
+    def remove(self, host: str) -> None:
+        if self.keys.pop(host, None) is not None and self.top is not None and host in self.top:
+            self.top = None
+
+    def best(self, k: int) -> list[str]:
+        if self.top is not None and (k <= len(self.top) or len(self.top) == len(self.keys)):
+            return self.top[:k]
+
+        best, valid = [], []
+        while self.heap and len(best) < max(k, TOP_K):
+            key, host = heapq.heappop(self.heap)
+            if self.keys.get(host) == key and host not in best:  # else: an old entry of a changed or removed server
+                best.append(host)
+                valid.append((key, host))
+        for entry in valid:
+            heapq.heappush(self.heap, entry)
+
+        if len(self.heap) > 2 * len(self.keys) + TOP_K:  # too many dead entries: compact
+            self.heap = [(key, host) for host, key in self.keys.items()]
+            heapq.heapify(self.heap)
+
+        self.top = best
+        return best[:k]
+
+
+class ServerRanking:
+    """
+    apply() each new catalog, measured() the local RTTs (see prefilter), best() to choose.
+    Metrics: blend (see blended_cost), score, speed (higher first), ping (the measured RTT if known), sessions (fewer first).
+    """
+
+    def __init__(self) -> None:
+        self._rows: dict[str, dict] = dict()         # HostName: ranked columns
+        self._rtts: dict[str, float] = dict()        # HostName: measured RTT, sec; inf: didn't answer
+        self._heaps: dict[tuple[str, str], _TopK] = dict()
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def apply(self, catalog: "Catalog") -> Diff:
+        '''Diff the catalog against the applied one, update the heaps of the changed servers only'''
+        return self.apply_rows(catalog.servers(columns=RANKED_COLUMNS).iter_rows(named=True))
+
+    def apply_rows(self, rows: Iterable[Mapping]) -> Diff:
+        new_rows = {row["HostName"]: dict(row) for row in rows if row.get("HostName")}
+        added = [host for host in new_rows if host not in self._rows]
+        removed = [host for host in self._rows if host not in new_rows]
+        changed = [host for host, row in new_rows.items() if host in self._rows and self._rows[host] != row]
+
+        for host in removed:
+            self._drop(host)
+            self._rtts.pop(host, None)
+        for host in (*added, *changed):
+            if host in changed and self._rows[host].get("CountryShort") != new_rows[host].get("CountryShort"):
+                self._drop(host)
+            self._rows[host] = new_rows[host]
+            self._push(host)
+
+        diff = Diff(added, removed, changed)
+        logger.debug(f"🏆 Ranking: +{len(added)} -{len(removed)} ~{len(changed)} of {len(self._rows)} servers")
+        return diff
+
+    def measured(self, host: str, rtt: float | None) -> None:
+        '''rtt: sec of a reachability probe, None if the server didn't answer (it goes last by blend and ping)'''
+        if host in self._rows:
+            self._rtts[host] = math.inf if rtt is None else rtt
+            self._push(host, metrics=("blend", "ping"))  # the others don't depend on the RTT
+
+    def best(self, n: int = 1, country: str | None = None, metric: str = "blend") -> list[str]:
+        if metric not in METRICS:
+            raise ValueError(f"Unknown metric {metric!r}: one of {', '.join(METRICS)}")
+        top = self._heaps.get((metric, country.upper() if country else ANY_COUNTRY))
+        return top.best(n) if top is not None else []
+
+    def row(self, host: str) -> dict | None:
+        """
+        The ranked columns of a server, its measured RTT (None if not measured or unreachable) and blended cost.
+        reachable: None if the server wasn't measured (e.g. no `remote` in its config): unknown, not a yes.
+        """
+        if (row := self._rows.get(host)) is None:
+            return None
+        rtt = self._rtts.get(host)
+        reachable = None if rtt is None else math.isfinite(rtt)
+        return {**row, "rtt": rtt if reachable else None, "reachable": reachable,
+                "cost": blended_cost(row, rtt) if reachable is not False else None}
+
+    def _push(self, host: str, metrics: Iterable[str] = METRICS) -> None:
+        row, rtt = self._rows[host], self._rtts.get(host)
+        for metric in metrics:
+            key = _sort_key(metric, row, rtt)
+            for country in _countries(row):
+                self._heaps.setdefault((metric, country), _TopK()).put(host, key)
+
+    def _drop(self, host: str) -> None:
+        for metric in METRICS:
+            for country in _countries(self._rows[host]):
+                if (top := self._heaps.get((metric, country))) is not None:
+                    top.remove(host)
+        del self._rows[host]
+
+
+def _countries(row: Mapping) -> tuple[str, ...]:
+    return (ANY_COUNTRY, row["CountryShort"]) if row.get("CountryShort") else (ANY_COUNTRY,)
@@ -0,0 +1,279 @@
+'''
+Segmented download of the vpngate catalog: a free proxy gives a few hundred KB/s at best, so the multi-megabyte CSV
+is fetched as byte ranges through several proxies at once.
+  1. confirm: the proxies race for the first segment (Range: bytes=0-...); the winner's answer tells the total size
+     and the validator (a strong ETag or Last-Modified) of the body, the runners-up that made it too are confirmed;
+  2. download: the other segments go to the confirmed proxies, and to new candidates while fewer than `n_proxies`
+     work; a candidate that brings its segment is confirmed. A segment late by HEDGE_FACTOR x the typical segment time
+     is hedged onto an idle proxy (the first copy wins), a failed one goes to another proxy;
+  3. reassemble & validate: every part has the same total and validator (If-Range: a changed body comes back whole
+     instead of a part of another one) and the exact length, then the parser must get the whole CSV, no broken row.
+An origin that ignores Range answers 200 with the whole body: the confirm race is then a race of whole downloads.
+'''
+
+import asyncio, re, statistics, time
+from collections import Counter, deque
+from itertools import chain
+from typing import TYPE_CHECKING, Iterable, Iterator, Mapping, NamedTuple
+
+from ..configs.dns import dns
+from ..configs.metrics import metrics
+from ..proxy import health
+from ..proxy.health import HealthStore, HEALTH_STATE
+from ..proxy.table import Proxy
+from ..utils.scheduler import race
+from .get import HEAD_BYTES, TIMEOUT_GET_RAW_VPN, is_good_resp, vpn_sources
+from .mirrors import MirrorPicker
+from .parse import VpngateParser
+
+if TYPE_CHECKING:
+    from ..configs.web_sessions import SessionPool
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# Constants
+SEGMENT_BYTES = 256 * 1024        # per range request: a few sec via a slow proxy, so the hedging reacts in seconds
+N_PROXIES = 4                     # proxies the download is split across
+HEDGE_FACTOR = 2.0                # a segment slower than so many typical segments is hedged
+HEDGE_MIN = 1.0                   # sec: ... but never earlier
+MAX_ATTEMPTS = 4                  # failed attempts of a segment before the download is given up
+SEGMENT_TIMEOUT = TIMEOUT_GET_RAW_VPN
+_CONTENT_RANGE = re.compile(r"bytes (\d+)-(\d+)/(\d+)")
+
+
+class Part(NamedTuple):
+    proxy: Proxy
+    start: int
+    body: bytes
+    total: int | None          # size of the whole body; None: `body` is the whole body (a 200 answer)
+    validator: str | None      # strong ETag or Last-Modified of the body
+    elapsed: float
+
+
+async def get_vpns_segmented(proxies: Iterable[Proxy],
+                             n_proxies: int = N_PROXIES,
+                             sources: Mapping[str, str] | None = None,
+                             health_state: str | None = HEALTH_STATE) -> list[dict[str, str]] | None:
+    """
+    The servers of one vpngate answer downloaded through up to `n_proxies` proxies at once, None if no proxy worked.
+    proxies: the candidates; the HealthStore ranks them, the historically best are confirmed first.
+    """
+    from ..configs.web_sessions import SessionPool  # aiohttp
+
+    sources = vpn_sources() if sources is None else sources
+    proxy_health = HealthStore(health_state).load()
+    candidates = iter(proxy_health.rank(proxies))
+    mirrors = MirrorPicker(sources)
+    source = mirrors.pick()  # every part of one body comes from one origin
+    url = sources[source]
+    start, rows = time.monotonic(), None
+    runners_up: list[Part] = []      # confirmed in the same race
+    spare: deque[Proxy] = deque()    # the race took them but cancelled: they are tried first later
+
+    async with SessionPool() as pool:
+
+        async def confirm(proxy: Proxy) -> Part | None:
+            try:
+                part = await fetch_range(pool, proxy, url, 0, SEGMENT_BYTES - 1)
+            except asyncio.CancelledError:
+                spare.append(proxy)
+                raise
+            if part is not None and part.start == 0 and is_good_resp(source, _head(part.body)) \
+                    and (part.total is not None or _parse(part.body, source) is not None):
+                proxy_health.record(health.key(proxy), part.elapsed)
+                runners_up.append(part)
+                return part
+            proxy_health.record(health.key(proxy), None)
+            return None
+
+        try:
+            with metrics.stage("segmented_download"):
+                if confirmed := await race(confirm, candidates, goal=1, wave_size=n_proxies):
+                    first = confirmed[0]
+                    if first.total is None:  # the origin ignores Range: the race was a race of whole downloads
+                        metrics.count("segments", "whole")
+                        rows = _parse(first.body, source)
+                    else:
+                        others = [part.proxy for part in runners_up if part is not first and _same_body(part, first)]
+                        spare.extendleft(reversed(others[n_proxies - 1:]))
+                        download = _Download(pool, url, source, proxy_health, first, others[:n_proxies - 1],
+                                             chain(spare, candidates), n_proxies)
+                        if (body := await download.run()) is not None:
+                            rows = _parse(body, source)
+        finally:
+            proxy_health.save()
+            if rows is not None:  # a failure is the proxies' as a rule, see MirrorPicker
+                mirrors.record(source, time.monotonic() - start)
+            mirrors.save()
+
+    if rows is None:
+        logger.warning("❌ Segmented download failed")
+    else:
+        logger.info(f"✅ Segmented download: {len(rows)} servers in {time.monotonic() - start:.1f} s")
+    return rows
+
+
+async def fetch_range(pool: "SessionPool", proxy: Proxy, url: str, first: int, last: int,
+                      validator: str | None = None) -> Part | None:
+    '''Bytes first..last of `url` via the proxy; a 200 answer is the whole body; None on any failure'''
+    from aiohttp import ClientError, ClientTimeout
+    from aiohttp_socks import ProxyConnectionError, ProxyError as SocksProxyError, ProxyTimeoutError
+    from python_socks import ProxyError
+
+    headers = {"Range": f"bytes={first}-{last}", "Accept-Encoding": "identity"}  # a range of a gzip body is no use
+    if validator:
+        headers["If-Range"] = validator
+    url, host, server_hostname = dns.pin(url) if proxy.protocol != "socks5" else (url, {}, None)  # see _get_raw_vpns
+    start = time.monotonic()
+    try:
+        async with pool.session(proxy.protocol, f"{proxy.protocol}://{proxy.ip_port}") as (session, proxy_arg):
+            async with session.get(url, proxy=proxy_arg, headers=headers | host, server_hostname=server_hostname,
+                                   timeout=ClientTimeout(total=SEGMENT_TIMEOUT)) as resp:
+                body = await resp.read()
+                etag = resp.headers.get("ETag")
+                validator = etag if etag and not etag.startswith("W/") else resp.headers.get("Last-Modified")
+                if resp.status != 206:
+                    return Part(proxy, 0, body, None, validator, time.monotonic() - start)
+                if (match := _CONTENT_RANGE.fullmatch(resp.headers.get("Content-Range", ""))) is None:
+                    return None
+                return Part(proxy, int(match[1]), body, int(match[3]), validator, time.monotonic() - start)
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError, ClientError, OSError,
+            ProxyError, SocksProxyError, ProxyConnectionError, ProxyTimeoutError):
+        return None
+
+
+class _Download:
+    '''Step 2 of the module doc: the segments after the first one'''
+
+    def __init__(self, pool: "SessionPool", url: str, source: str, proxy_health: HealthStore, first: Part,
+                 confirmed: list[Proxy], candidates: Iterator[Proxy], n_proxies: int) -> None:
+        self.pool, self.url, self.source, self.proxy_health = pool, url, source, proxy_health
+        self.candidates, self.n_proxies = candidates, n_proxies
+        self.total, self.validator = first.total, first.validator
+        self.parts: dict[int, bytes] = {0: first.body}
+        self.todo: deque[int] = deque(range(len(first.body), first.total, SEGMENT_BYTES))
+        self.n_segments = len(self.todo) + 1
+        self.idle: deque[Proxy] = deque([first.proxy, *confirmed])   # confirmed proxies without a segment
+        self.n_confirmed = len(self.idle)
+        self.in_flight: dict[asyncio.Task, tuple[int, Proxy, float, bool]] = dict()  # (start, proxy, launched, confirmed)
+        self.durations = [first.elapsed]
+        self.failures: Counter[int] = Counter()
+        self.whole: bytes | None = None                  # the body changed under us, and came whole
+
+    async def run(self) -> bytes | None:
+        '''The whole body, None if the segments ran out of proxies or attempts'''
+        try:
+            while len(self.parts) < self.n_segments and self.whole is None:
+                self._launch()
+                if not self.in_flight:
+                    return None
+                done, _ = await asyncio.wait(self.in_flight, timeout=self._until_late(), return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if not self._finished(task):
+                        return None
+        finally:
+            for task in self.in_flight:
+                task.cancel()
+            await asyncio.gather(*self.in_flight, return_exceptions=True)
+
+        if self.whole is not None:
+            return self.whole
+        logger.debug(f"Segments: {self.n_segments} via {self.n_confirmed} proxies, {sum(self.failures.values())} failed")
+        return b"".join(self.parts[start] for start in sorted(self.parts))
+
+    def _launch(self) -> None:
+        while self.todo and self.idle:
+            self._start(self.todo.popleft(), self.idle.popleft(), confirmed=True)
+        while self.todo and self.n_confirmed + self._n_candidates() < self.n_proxies \
+                and (proxy := next(self.candidates, None)) is not None:
+            self._start(self.todo.popleft(), proxy, confirmed=False)
+        while self.idle and (late := self._late()) is not None:
+            metrics.count("segments", "hedged")
+            self._start(late, self.idle.popleft(), confirmed=True)
+
+    def _start(self, start: int, proxy: Proxy, confirmed: bool) -> None:
+        last = min(start + SEGMENT_BYTES, self.total) - 1
+        task = asyncio.create_task(fetch_range(self.pool, proxy, self.url, start, last, self.validator))
+        self.in_flight[task] = (start, proxy, time.monotonic(), confirmed)
+
+    def _finished(self, task: asyncio.Task) -> bool:
+        '''False: the download is given up'''
+        start, proxy, _, confirmed = self.in_flight.pop(task)
+        if task.cancelled():  # a copy of a won segment: the proxy is fine
+            if confirmed:
+                self.idle.append(proxy)
+            return True
+
+        part: Part | None = task.result()
+        if part is not None and part.total is None and _parse(part.body, self.source) is not None:
+            self.whole = part.body
+            return True
+        if part is not None and self._fits(part, start):
+            self.proxy_health.record(health.key(proxy), part.elapsed)
+            metrics.count("segments", "ok")
+            self.n_confirmed += not confirmed
+            self.idle.append(proxy)
+            if start not in self.parts:
+                self.parts[start] = part.body
+                self.durations.append(part.elapsed)
+                for other, (other_start, *_) in self.in_flight.items():
+                    if other_start == start:
+                        other.cancel()
+            return True
+
+        self.proxy_health.record(health.key(proxy), None)
+        metrics.count("segments", "fail")
+        self.n_confirmed -= confirmed  # the proxy is dropped
+        self.failures[start] += 1
+        if self.failures[start] >= MAX_ATTEMPTS:
+            logger.debug(f"Segment {start} failed {MAX_ATTEMPTS} times")
+            return False
+        if start not in self.parts and all(other_start != start for other_start, *_ in self.in_flight.values()):
+            self.todo.appendleft(start)
+        return True
+
+    def _fits(self, part: Part, start: int) -> bool:
+        return (part.start == start and part.total == self.total and part.validator == self.validator
+                and len(part.body) == min(SEGMENT_BYTES, self.total - start))
+
+    def _n_candidates(self) -> int:
+        return sum(1 for *_, confirmed in self.in_flight.values() if not confirmed)
+
+    def _hedge_delay(self) -> float:
+        return max(HEDGE_MIN, HEDGE_FACTOR * statistics.median(self.durations))
+
+    def _single_copies(self) -> dict[int, float]:
+        '''{start: launched} of the segments in flight with a single copy'''
+        copies = Counter(start for start, *_ in self.in_flight.values())
+        return {start: launched for start, _, launched, _ in self.in_flight.values() if copies[start] == 1}
+
+    def _late(self) -> int | None:
+        '''The segment late the most, if any is'''
+        deadline = time.monotonic() - self._hedge_delay()
+        late = [(launched, start) for start, launched in self._single_copies().items() if launched < deadline]
+        return min(late)[1] if late else None
+
+    def _until_late(self) -> float | None:
+        '''Sec until the next segment is late: a hedge needs an idle proxy, without one there's nothing to wait for'''
+        if not self.idle or not (launched := self._single_copies()):
+            return None
+        return max(0.0, min(launched.values()) + self._hedge_delay() - time.monotonic())
+
+
+def _same_body(part: Part, first: Part) -> bool:
+    return part.total == first.total and part.validator == first.validator and part.body == first.body
+
+
+def _parse(body: bytes, source: str) -> list[dict[str, str]] | None:
+    '''Rows of a whole, valid body; None for a truncated or broken one'''
+    if not is_good_resp(source, _head(body)):
+        return None
+    parser = VpngateParser()
+    parser.feed(body)
+    return parser.rows if parser.close() and not parser.n_broken else None
+
+
+def _head(body: bytes) -> str:
+    return body[:HEAD_BYTES].decode("utf-8", errors="replace")
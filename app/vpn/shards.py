@@ -0,0 +1,277 @@
+'''
+Sharded probing: the proxies are dealt round-robin to worker processes, each probes its shard on its own event loop
+with its own SessionPool and Governor (see probe_proxies), so the TLS handshakes and aiohttp's per-request work use
+every core instead of one. The coordinator (this process) keeps what is shared:
+  - the order: the HealthStore ranks the proxies (the best ones go first to every shard), detect.py runs here too;
+  - the outcomes: the workers only report them, the HealthStore and MirrorPicker are saved here, once;
+  - the DNS answers: the source hosts are resolved here and handed to the workers, which never write any state;
+  - the goal: the successes come back as they happen, the first `goal` of them stop every shard.
+IPC: a socketpair per worker with length-prefixed pickles on asyncio streams, so neither side ever blocks on it:
+  coordinator → worker    ("proxies", [Proxy, ...]), ("end", None), ("stop", None)
+  worker → coordinator    ("probe", sink record), ("verified", Verified), ("log", LogRecord), ("done", metrics.to_dict())
+A worker is spawned, not forked: it gets its paths and settings explicitly (see _Settings), nothing is inherited.
+'''
+
+import asyncio, multiprocessing, os, pickle, socket, time
+from logging.handlers import QueueHandler
+from pathlib import Path
+from typing import TYPE_CHECKING, AsyncIterable, Iterable, Mapping, NamedTuple
+
+from ..configs.dns import dns
+from ..configs.logs import setup_worker_logging
+from ..configs.metrics import metrics
+from ..proxy import health
+from ..utils import files
+from ..proxy.detect import detect_protocols
+from ..proxy.health import HealthStore, HEALTH_STATE
+from ..proxy.table import Proxy, ProxyTable
+from ..utils.scheduler import aiterate
+from .get import ORIGIN_OUTCOMES, Verified, probe_proxies, vpn_sources
+from .mirrors import MirrorPicker
+
+if TYPE_CHECKING:
+    from ..proxy.query import Query
+    from ..utils.snapshots import JsonlWriter
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# Constants
+FEED_BATCH = 256         # proxies per message of a listed (not streamed) input
+STOP_TIMEOUT = 5         # sec for a stopped worker to close its probes before it's terminated
+_HEADER_BYTES = 4        # message length, big-endian
+
+
+class _Settings(NamedTuple):
+    '''What a shard worker needs of the coordinator: a spawned process starts from the defaults'''
+    goal: int
+    max_in_flight: int | None
+    sources: dict[str, str]
+    state_dir: Path          # files.STATE_DIR, e.g. the temporary one of the bench
+    results_dir: Path
+    log_level: int
+    dns: dict[str, tuple]    # the coordinator's answers, see DnsCache.snapshot
+
+
+async def probe_sharded(proxies: Iterable[Proxy] | AsyncIterable[Proxy],
+                        goal: int = 1,
+                        n_shards: int | None = None,
+                        max_in_flight: int | None = None,
+                        sources: Mapping[str, str] | None = None,
+                        health_state: str | None = HEALTH_STATE,
+                        sink: "JsonlWriter | None" = None,
+                        table: ProxyTable | None = None,
+                        query: "Query | None" = None) -> list[Verified]:
+    """
+    probe_proxies() across `n_shards` worker processes (os.cpu_count() by default): the same arguments and result.
+    max_in_flight is the cap of all the shards together; each shard has a Governor of its own.
+    """
+    n_shards = n_shards or os.cpu_count() or 1
+    sources = vpn_sources() if sources is None else dict(sources)
+
+    proxy_health = HealthStore(health_state).load()
+    if isinstance(proxies, AsyncIterable):
+        proxies = proxy_health.rank_stream(proxies, n_best=0 if query is not None else health.N_BEST)
+    else:
+        proxies = proxy_health.rank(proxies)
+    if table is not None:
+        proxies = detect_protocols(proxies, table, health=proxy_health)
+    mirrors = MirrorPicker(sources)
+    await dns.prefetch(sources.values())  # once for all the workers: they get the addresses pinned
+
+    context = multiprocessing.get_context("spawn")  # a fork would copy the running event loop and its sockets
+    shard_in_flight = max(1, max_in_flight // n_shards) if max_in_flight else None
+    settings = _Settings(goal, shard_in_flight, sources, files.STATE_DIR, files.RESULTS_DIR,
+                         logging.getLogger().getEffectiveLevel(), dns.snapshot())
+    workers, channels = [], []
+    for shard in range(n_shards):
+        ours, theirs = socket.socketpair()
+        worker = context.Process(target=_worker, args=(theirs, settings),
+                                 name=f"probe-shard-{shard}", daemon=True)
+        worker.start()
+        theirs.close()
+        workers.append(worker)
+        channels.append(await asyncio.open_connection(sock=ours))
+    logger.info(f"🧩 Probing in {n_shards} shard processes")
+
+    results: list[Verified] = []
+    enough = asyncio.Event()
+
+    async def listen(reader: asyncio.StreamReader) -> None:
+        try:
+            while True:
+                kind, payload = await _receive(reader)
+                match kind:
+                    case "probe":
+                        latency = payload["latency"] if payload["servers"] else None
+                        proxy_health.record(payload["proxy"], latency)
+                        if payload["servers"] or payload["outcome"] in ORIGIN_OUTCOMES:
+                            mirrors.record(payload["source"], latency)
+                        metrics.observe("probe_seconds", payload["latency"])
+                        if sink is not None:
+                            sink.write(payload)
+                    case "verified":
+                        metrics.first_success()
+                        results.append(payload)
+                        if len(results) >= goal:
+                            enough.set()
+                    case "log":
+                        logging.getLogger(payload.name).handle(payload)
+                    case "done":
+                        metrics.merge(payload)
+                        return
+        except (asyncio.IncompleteReadError, OSError):
+            logger.warning("⚠️ A probe shard is gone")
+
+    async def feed() -> None:
+        streamed, batches = isinstance(proxies, AsyncIterable), [[] for _ in range(n_shards)]
+        alive = list(range(n_shards))
+        n_fed = 0
+
+        async def deal(shard: int, kind: str, batch: list[Proxy] | None) -> None:
+            try:
+                await _send(channels[shard][1], kind, batch)
+            except OSError:  # the worker died: the rest goes to the others
+                alive.remove(shard)
+
+        async for proxy in aiterate(proxies):
+            if not alive:
+                return
+            shard = alive[n_fed % len(alive)]
+            n_fed += 1
+            batches[shard].append(proxy)
+            if streamed or len(batches[shard]) >= FEED_BATCH:  # a stream is fed as it comes
+                batch, batches[shard] = batches[shard], []
+                await deal(shard, "proxies", batch)
+        for shard in list(alive):
+            if batches[shard]:
+                await deal(shard, "proxies", batches[shard])
+            await deal(shard, "end", None)
+
+    listeners = asyncio.gather(*(listen(reader) for reader, _ in channels))
+    feeder = asyncio.create_task(feed())
+    goal_met = asyncio.create_task(enough.wait())
+    try:
+        with metrics.stage("probe_fanout"):
+            await asyncio.wait({listeners, goal_met}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in (feeder, goal_met):
+            task.cancel()
+        await asyncio.gather(feeder, goal_met, return_exceptions=True)
+        for _, writer in channels:
+            try:
+                await _send(writer, "stop", None)
+            except OSError:
+                pass  # the worker is done
+        try:
+            await asyncio.wait_for(listeners, STOP_TIMEOUT)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            pass
+        for _, writer in channels:
+            writer.close()
+        await asyncio.to_thread(_join, workers)
+        proxy_health.save()
+        mirrors.save()
+
+    return results[:goal]
+
+
+def _worker(sock: socket.socket, settings: _Settings) -> None:
+    '''Entry point of a shard process'''
+    files.STATE_DIR, files.RESULTS_DIR = settings.state_dir, settings.results_dir
+    dns.restore(settings.dns)
+    asyncio.run(_shard(sock, settings))
+
+
+async def _shard(sock: socket.socket, settings: _Settings) -> None:
+    reader, writer = await asyncio.open_connection(sock=sock)
+    setup_worker_logging(QueueHandler(_LogChannel(writer)), settings.log_level)
+    inbox: asyncio.Queue = asyncio.Queue()
+
+    async def shard_proxies():
+        while (batch := await inbox.get()) is not None:
+            for proxy in batch:
+                yield proxy
+
+    probing = asyncio.create_task(probe_proxies(
+        shard_proxies(), settings.goal, settings.max_in_flight, settings.sources,
+        health_state=None,  # the coordinator ranks and records
+        sink=_Channel(writer),
+        on_verified=lambda verified: _post(writer, "verified", verified)))
+
+    async def listen() -> None:
+        try:
+            while True:
+                kind, payload = await _receive(reader)
+                if kind == "proxies":
+                    inbox.put_nowait(payload)
+                elif kind == "end":
+                    inbox.put_nowait(None)
+                else:  # stop
+                    break
+        except (asyncio.IncompleteReadError, OSError):
+            pass  # the coordinator is gone
+        probing.cancel()
+
+    listener = asyncio.create_task(listen())
+    try:
+        await probing
+    except asyncio.CancelledError:
+        pass
+    metrics.sample_fds()
+    _post(writer, "done", metrics.to_dict())
+
+    # the channel is closed by the coordinator's stop only: a socket closed while the coordinator still
+    # feeds it would break its pipe, and the messages not read yet (e.g. "done") would be lost
+    await listener
+    writer.close()
+    await writer.wait_closed()  # the buffer is written out before the process exits
+
+
+class _Channel:
+    '''The sink of a shard's probe_proxies(): the records go to the coordinator'''
+
+    def __init__(self, writer: asyncio.StreamWriter) -> None:
+        self._writer = writer
+
+    def write(self, record: dict) -> None:
+        _post(self._writer, "probe", record)
+
+
+class _LogChannel:
+    '''The "queue" of the worker's QueueHandler: the records go to the coordinator, which logs them'''
+
+    def __init__(self, writer: asyncio.StreamWriter) -> None:
+        self._writer = writer
+
+    def put_nowait(self, record) -> None:
+        if not self._writer.is_closing():  # a write to a lost connection logs a warning: a loop
+            _post(self._writer, "log", record)
+
+
+def _post(writer: asyncio.StreamWriter, kind: str, payload) -> None:
+    '''Sync send: only buffered, the event loop writes it out'''
+    data = pickle.dumps((kind, payload), protocol=pickle.HIGHEST_PROTOCOL)
+    writer.write(len(data).to_bytes(_HEADER_BYTES, "big") + data)
+
+
+async def _send(writer: asyncio.StreamWriter, kind: str, payload) -> None:
+    _post(writer, kind, payload)
+    await writer.drain()
+
+
+async def _receive(reader: asyncio.StreamReader) -> tuple[str, object]:
+    size = int.from_bytes(await reader.readexactly(_HEADER_BYTES), "big")
+    return pickle.loads(await reader.readexactly(size))
+
+
+def _join(workers: list) -> None:
+    deadline = time.monotonic() + STOP_TIMEOUT
+    for worker in workers:
+        worker.join(max(0, deadline - time.monotonic()))
+        if worker.is_alive():
+            logger.warning(f"⚠️ {worker.name} doesn't stop: terminated")
+            worker.terminate()
+            worker.join()
+
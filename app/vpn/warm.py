@@ -0,0 +1,120 @@
+'''
+Warm start: the last pipeline state is restored from the disk and only its expired parts are fetched again.
+  - the vpngate catalog      tmp/cache/vpngate.arrow          fresh: CATALOG_MAX_AGE, usable: USABLE_CATALOG_AGE
+  - the proxy table          tmp/results/proxies-<time>.arrow fresh: PROXIES_MAX_AGE
+  - the probe outcomes       tmp/state/proxy_health.json      per proxy: health.TTL (the HealthStore drops the old ones)
+A stale but usable catalog is served right away while revalidate() refreshes it in the background.
+'''
+
+import asyncio, time
+from dataclasses import dataclass
+from typing import TYPE_CHECKING
+
+from ..proxy.health import HealthStore
+from .get import probe_proxies
+from .mirrors import merge_servers
+
+if TYPE_CHECKING:
+    from ..proxy.query import Query
+    from ..proxy.table import ProxyTable
+    from ..utils.snapshots import JsonlWriter
+    from .catalog import Catalog
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# Constants
+USABLE_CATALOG_AGE = 24 * 60 * 60  # sec: older servers are mostly gone, the catalog isn't served even while revalidating
+
+
+@dataclass(slots=True)
+class WarmState:
+    catalog: "Catalog | None"          # None: missing or older than USABLE_CATALOG_AGE
+    catalog_fresh: bool
+    proxies: "ProxyTable | None"       # None: missing or stale => fetched by revalidate()
+    n_outcomes: int                    # proxies with known health
+
+
+def restore(catalog_max_age: float | None = None, proxies_max_age: float | None = None) -> WarmState:
+    '''Load every component the last runs left, each checked for staleness on its own; no network'''
+    from ..proxy.snapshot import get_proxies_from_local, PROXIES_MAX_AGE
+    from .catalog import Catalog, CATALOG_MAX_AGE
+
+    start = time.monotonic()
+    catalog = Catalog.open()
+    if catalog is not None and catalog.age() >= USABLE_CATALOG_AGE:
+        catalog = None
+    catalog_fresh = catalog is not None and catalog.is_fresh(CATALOG_MAX_AGE if catalog_max_age is None else catalog_max_age)
+    proxies = get_proxies_from_local(PROXIES_MAX_AGE if proxies_max_age is None else proxies_max_age)
+    n_outcomes = len(HealthStore().load())
+
+    state = WarmState(catalog, catalog_fresh, proxies, n_outcomes)
+    logger.info(f"♨️ Warm start in {(time.monotonic() - start) * 1000:.0f} ms: "
+                f"catalog={'fresh' if catalog_fresh else 'stale' if catalog is not None else 'none'}, "
+                f"proxies={len(proxies) if proxies is not None else 'stale'}, outcomes={n_outcomes}")
+    return state
+
+
+async def revalidate(state: WarmState, use_tor: bool = False, sink: "JsonlWriter | None" = None,
+                     stream: bool = False, query: "Query | None" = None,
+                     segments: int | None = None, n_shards: int | None = None) -> "Catalog | None":
+    """
+    Fetch what is expired: the proxy table (unless its snapshot is fresh), then the catalog via the proxies,
+    the historically best ones first. The new catalog is saved and put into `state`; None if no proxy worked.
+    stream: probe the proxies while the sources are downloading (nobody waits in the background, someone does
+    in a cold start), the table is saved as the snapshot only when it's fetched whole.
+    query: only the matching proxies are probed (see query.py); it doesn't apply to the Tor circuits.
+    The protocols detected along the way (see detect.py) are saved with the snapshot for the next run.
+    segments: one ranged download via so many proxies instead of probing them (see segments.py); no streaming then.
+    n_shards: probe the public proxies in so many worker processes (see shards.py); the few Tor circuits aren't sharded.
+    """
+    from .catalog import Catalog
+
+    if use_tor:
+        from ..proxy.tor import TorCircuits
+        from .get import vpn_sources
+
+        results = await probe_proxies(await TorCircuits().fastest(vpn_sources()["vpngate"]), health_state=None, sink=sink)
+        servers = merge_servers(result.servers for result in results) if results else None
+    else:
+        from ..proxy.get import fetch_proxies, stream_proxies
+        from ..proxy.query import ProxyIndex, filter_stream
+        from ..proxy.snapshot import save_proxies
+        from ..proxy.table import Flag, ProxyTable
+
+        if state.proxies is None and stream and not segments:
+            proxy_table = ProxyTable()
+            proxies = stream_proxies(proxy_table)
+            if query is not None:
+                proxies = filter_stream(proxies, proxy_table, query)
+        else:
+            if state.proxies is None:
+                state.proxies = await fetch_proxies()  # saved as the snapshot of the next warm start
+            proxies = ProxyIndex(state.proxies).probes(query) if query is not None else state.proxies.probes()
+        if segments:
+            from .segments import get_vpns_segmented
+
+            servers = await get_vpns_segmented(proxies, segments)
+        else:
+            table = state.proxies if state.proxies is not None else proxy_table
+            n_detected = table.count(Flag.DETECTED)
+            if n_shards:
+                from .shards import probe_sharded
+
+                results = await probe_sharded(proxies, n_shards=n_shards, sink=sink, table=table, query=query)
+            else:
+                results = await probe_proxies(proxies, sink=sink, table=table, query=query)
+            if table is state.proxies and table.count(Flag.DETECTED) > n_detected:
+                await save_proxies(table)
+            servers = merge_servers(result.servers for result in results) if results else None
+
+    if not servers:
+        logger.warning("❌ Revalidation: no working proxy, the catalog is kept as it is")
+        return None
+
+    catalog = Catalog.from_rows(servers)
+    await asyncio.to_thread(catalog.save)
+    state.catalog, state.catalog_fresh = catalog, True
+    logger.info(f"🔄 Revalidated the catalog: {len(catalog)} servers")
+    return catalog
@@ -1,37 +1,101 @@
-import asyncio
+import argparse, asyncio, sys
+from typing import TYPE_CHECKING
 
-# from .app.configs.web_sessions import session_pool
-from .app.proxy.get import get_proxies
-from .app.vpn.get import get_vpns_from_web#, get_vpns_from_local
-from .app.configs.file_descriptors import set_fd_limit
+from .app.configs.dns import dns
+from .app.proxy.query import Query
+from .app.vpn.connect import SHORTLIST, prefilter
+from .app.vpn.ranking import ServerRanking
+from .app.vpn.warm import WarmState, restore, revalidate
+from .app.configs.logs import setup_logging
+from .app.configs.metrics import metrics
+from .app.utils.snapshots import JsonlWriter
+
+if TYPE_CHECKING:
+    from .app.vpn.catalog import Catalog
 
 import logging
 logger = logging.getLogger(__name__)
 
 
-async def main(use_tor: bool = False) -> None:
-    # try:
-    # await session_pool.open()
-    # print(f'{session_pool._sessions=}')
+async def main(use_tor: bool = False, warm: bool = True, query: str | None = None, segments: int | None = None,
+               n_shards: int | None = None) -> None:
+    """
+    query: probe only the matching proxies, e.g. "elite, ssl, not has_problem, country in {DE, NL}" (see query.py)
+    segments: download the catalog in byte ranges via so many proxies at once (see segments.py)
+    n_shards: probe the proxies in so many worker processes (see shards.py); None: in this process
+    """
+    metrics.reset()
+    try:
+        await _main(use_tor, warm, Query.parse(query) if query else None, segments, n_shards)
+    finally:
+        metrics.dump()  # tmp/metrics/run.json and run.prom, also for the failed runs
+        dns.save()      # the answers looked up along the way, for the next run
+
+
+async def _main(use_tor: bool, warm: bool, query: Query | None, segments: int | None, n_shards: int | None) -> None:
+    # The state of the previous runs: each part is reused while it's fresh
+    state = restore()
+    revalidation = None
+    prefetching = asyncio.create_task(_prefetch_hosts()) if not state.catalog_fresh else None
 
-    if use_tor:
-        ...
+    if state.catalog_fresh:
+        catalog = state.catalog  # no network at all
+    elif state.catalog is not None and warm:
+        # Stale but usable: the servers are shown right away, the catalog is refreshed in the background
+        catalog = state.catalog
+        revalidation = asyncio.create_task(_revalidate(state, use_tor, stream=False, query=query, segments=segments,
+                                                       n_shards=n_shards))
     else:
-        # Fetch all raw proxies
-        proxies_meta = await get_proxies()
+        # Cold start: probing starts on the first proxies while the sources are downloading
+        if (catalog := await _revalidate(state, use_tor, stream=True, query=query, segments=segments,
+                                         n_shards=n_shards)) is None:
+            logger.warning("❌ No working proxy found.")
+            sys.exit(1)  # terminate with a non-zero exit code
+
+    print(catalog.servers(columns=["CountryShort", "HostName", "IP", "Score", "Ping", "Speed"]))
+
+    # Cheap reachability probes: only the shortlist is worth `openvpn --config`,
+    # ranked by the advertised metrics blended with the measured RTT
+    ranking = ServerRanking()
+    ranking.apply(catalog)
+    endpoints = catalog.endpoints()  # no config is decoded: the shortlist's are, by openvpn
+    rtts = {host_name: rtt for rtt, host_name in await prefilter(endpoints, top=len(endpoints))}
+    for host_name in endpoints:
+        ranking.measured(host_name, rtts.get(host_name))
+    for host_name in ranking.best(SHORTLIST):
+        if (row := ranking.row(host_name))["reachable"] is not False:  # None: not measured
+            rtt = f'{row["rtt"] * 1000:.0f} ms' if row["rtt"] is not None else "- ms"
+            print(f'{rtt}\t{row["cost"]:.0f}\t{host_name}')
+
+    if revalidation is not None:
+        await revalidation  # the next run starts from the fresh catalog
+    if prefetching is not None:
+        await prefetching
+
+
+async def _prefetch_hosts() -> None:
+    # the source and mirror hosts are resolved while the proxies are fetched: the probes find them cached
+    from .app.proxy.get import proxy_sources
+    from .app.vpn.get import vpn_sources
+
+    await dns.prefetch([*proxy_sources().values(), *vpn_sources().values()])
+
 
-        # Tweak your FD (file descriptors) limit to allow many proxy connections
-        set_fd_limit(n_proxies = len(proxies_meta))
-        
-        res = await get_vpns_from_web(proxies_meta)
+async def _revalidate(state: WarmState, use_tor: bool, stream: bool, query: Query | None,
+                      segments: int | None, n_shards: int | None) -> "Catalog | None":
+    # A local Tor client (use_tor) instead of the public proxies: the fetch is raced across the fastest circuits
+    async with JsonlWriter("probes") as sink:  # tmp/results/probes-<time>.jsonl
+        return await revalidate(state, use_tor, sink, stream, query, segments, n_shards)
 
-        print(res)
-        print(f'{len(res)=}\t{type(res)=}')
 
-    # finally:
-    #     await session_pool.close()  # close sockets
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog="run")
+    parser.add_argument("--shards", type=int, default=None, help="probe in so many worker processes (default: in one)")
+    return parser.parse_args(argv)
 
 
 if __name__ == "__main__":
-    # Pass True here if you want to route over TOR
-    asyncio.run(main(use_tor=False))
+    args = parse_args()
+    setup_logging()
+    # Pass True here if you want to route over TOR (a Tor client listening on 127.0.0.1:9050)
+    asyncio.run(main(use_tor=False, n_shards=args.shards))
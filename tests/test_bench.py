@@ -0,0 +1,27 @@
+'''Smoke runs of the offline benchmark: the whole pipeline against the stand-ins, every mode meets its goal'''
+
+import asyncio
+
+import pytest
+
+from ..app.bench.__main__ import bench, parse_args
+
+SIZE, GOAL, SERVERS = 60, 5, 10
+
+
+@pytest.mark.parametrize("mode", [
+    [],
+    ["--proxy-garbage", "0.3"],
+    ["--proxy-truncated", "0.5"],  # bodies shorter than their Content-Length: an outcome, not a crash
+    ["--shards", "2"],
+    ["--segments", "3"],
+], ids=["normal", "garbage", "truncated", "shards", "segments"])
+def test_bench_meets_goal(mode: list[str]):
+    args = parse_args(["--sizes", str(SIZE), "--goal", str(GOAL), "--servers", str(SERVERS), *mode])
+    [report] = asyncio.run(bench(args))
+
+    assert report["servers"] == SERVERS
+    if "--segments" not in mode:
+        assert report["outcomes"].get("ok", 0) >= GOAL
+    if "--proxy-truncated" in mode:
+        assert report["outcomes"].get("truncated", 0) > 0
@@ -0,0 +1,110 @@
+'''prefilter() and its probes against local TCP and UDP listeners'''
+
+import asyncio, socket, struct, time
+
+import pytest
+
+from ..app.vpn.connect import Endpoint, P_CONTROL_HARD_RESET_SERVER_V2, _probe_udp, prefilter
+
+HOST = "127.0.0.1"
+
+
+class _OpenVpnServer(asyncio.DatagramProtocol):
+    '''Answers the client hard reset after `delay` sec; silent: drops it like a tls-auth server'''
+
+    def __init__(self, delay: float = 0.0, silent: bool = False) -> None:
+        self._delay = delay
+        self._silent = silent
+
+    def connection_made(self, transport) -> None:
+        self._transport = transport
+
+    def datagram_received(self, data: bytes, addr: tuple) -> None:
+        if not self._silent:
+            answer = struct.pack("!B8sBI", P_CONTROL_HARD_RESET_SERVER_V2 << 3, data[1:9], 0, 0)
+            asyncio.get_running_loop().call_later(self._delay, self._transport.sendto, answer, addr)
+
+
+async def _udp_server(delay: float = 0.0, silent: bool = False) -> tuple[asyncio.DatagramTransport, Endpoint]:
+    transport, _ = await asyncio.get_running_loop().create_datagram_endpoint(
+        lambda: _OpenVpnServer(delay, silent), local_addr=(HOST, 0))
+    return transport, Endpoint(HOST, transport.get_extra_info("sockname")[1], "udp")
+
+
+def _free_port(kind: int) -> int:
+    '''A port nobody listens on: connections are refused, datagrams bounce (ICMP port unreachable)'''
+    with socket.socket(socket.AF_INET, kind) as sock:
+        sock.bind((HOST, 0))
+        return sock.getsockname()[1]
+
+
+def test_probe_udp_answer():
+    async def main():
+        transport, endpoint = await _udp_server(delay=0.1)
+        try:
+            return await _probe_udp(endpoint, timeout=2)
+        finally:
+            transport.close()
+
+    assert 0.1 <= asyncio.run(main()) < 1
+
+
+def test_probe_udp_silent_times_out():
+    async def main():
+        transport, endpoint = await _udp_server(silent=True)
+        try:
+            await _probe_udp(endpoint, timeout=0.2)
+        finally:
+            transport.close()
+
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(main())
+
+
+def test_probe_udp_closed_port():
+    with pytest.raises(OSError):
+        asyncio.run(_probe_udp(Endpoint(HOST, _free_port(socket.SOCK_DGRAM), "udp"), timeout=2))
+
+
+def test_prefilter_ranks_by_rtt_and_drops_unreachable():
+    async def main():
+        tcp = await asyncio.start_server(lambda reader, writer: writer.close(), HOST, 0)
+        fast, fast_endpoint = await _udp_server(delay=0.05)
+        slow, slow_endpoint = await _udp_server(delay=0.3)
+        silent, silent_endpoint = await _udp_server(silent=True)
+        endpoints = {
+            "slow_udp": slow_endpoint,
+            "silent_udp": silent_endpoint,
+            "tcp": Endpoint(HOST, tcp.sockets[0].getsockname()[1], "tcp"),
+            "closed_tcp": Endpoint(HOST, _free_port(socket.SOCK_STREAM), "tcp"),
+            "closed_udp": Endpoint(HOST, _free_port(socket.SOCK_DGRAM), "udp"),
+            "fast_udp": fast_endpoint,
+        }
+        start = time.monotonic()
+        try:
+            return await prefilter(endpoints, top=len(endpoints), timeout=1), time.monotonic() - start
+        finally:
+            for transport in (fast, slow, silent):
+                transport.close()
+            tcp.close()
+            await tcp.wait_closed()
+
+    reachable, elapsed = asyncio.run(main())
+
+    assert [name for _, name in reachable] == ["tcp", "fast_udp", "slow_udp"]
+    rtts = [rtt for rtt, _ in reachable]
+    assert rtts == sorted(rtts)
+    assert rtts[1] >= 0.05 and rtts[2] >= 0.3
+    assert elapsed < 2  # the silent server costs one timeout, in parallel with the others
+
+
+def test_prefilter_top():
+    async def main():
+        servers = [await _udp_server(delay=0.05 * i) for i in range(4)]
+        try:
+            return await prefilter({f"s{i}": endpoint for i, (_, endpoint) in enumerate(servers)}, top=2, timeout=1)
+        finally:
+            for transport, _ in servers:
+                transport.close()
+
+    assert [name for _, name in asyncio.run(main())] == ["s0", "s1"]
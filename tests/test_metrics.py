@@ -0,0 +1,17 @@
+'''Metrics.merge: the report of a shard worker into the coordinator's'''
+
+from ..app.configs.metrics import Metrics
+
+
+def test_merge_adds_counters_and_keeps_the_highest_peaks():
+    coordinator, worker = Metrics(), Metrics()
+    coordinator.count("probe", "ok", 2)
+    coordinator.peak("in_flight", 40)
+    worker.count("probe", "ok", 3)
+    worker.peak("in_flight", 30)
+    worker.peak("open_fds", 12)
+
+    coordinator.merge(worker.to_dict())
+
+    assert coordinator.counters["probe"]["ok"] == 5
+    assert coordinator.peaks == {"in_flight": 40, "open_fds": 12}  # a maximum, not a total
@@ -0,0 +1,43 @@
+'''ServerRanking rows: measured, unreachable and not measured servers'''
+
+import math
+
+from ..app.vpn.ranking import ServerRanking, blended_cost
+
+ROWS = [
+    {"HostName": "measured", "CountryShort": "JP", "Score": 100, "Ping": 20, "Speed": 10**7, "NumVpnSessions": 5},
+    {"HostName": "silent", "CountryShort": "JP", "Score": 90, "Ping": 10, "Speed": 10**7, "NumVpnSessions": 5},
+    {"HostName": "unmeasured", "CountryShort": "KR", "Score": 80, "Ping": 30, "Speed": 10**7, "NumVpnSessions": 5},
+]
+
+
+def _ranking() -> ServerRanking:
+    ranking = ServerRanking()
+    ranking.apply_rows(ROWS)
+    ranking.measured("measured", 0.05)
+    ranking.measured("silent", None)
+    return ranking
+
+
+def test_row_measured():
+    row = _ranking().row("measured")
+
+    assert row["reachable"] is True and row["rtt"] == 0.05
+    assert math.isclose(row["cost"], blended_cost(ROWS[0], 0.05))
+
+
+def test_row_unreachable():
+    row = _ranking().row("silent")
+
+    assert row["reachable"] is False and row["rtt"] is None and row["cost"] is None
+
+
+def test_row_unmeasured_is_unknown():
+    row = _ranking().row("unmeasured")
+
+    assert row["reachable"] is None and row["rtt"] is None  # unknown, not reachable
+    assert math.isclose(row["cost"], blended_cost(ROWS[2], None))  # ranked by its advertised ping
+
+
+def test_row_unknown_host():
+    assert _ranking().row("nowhere") is None
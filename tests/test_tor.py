@@ -0,0 +1,89 @@
+'''TorCircuits against the fake SOCKS5 port of the bench standing for Tor'''
+
+import asyncio, secrets
+
+from ..app.bench.fakes import HOST, Behavior, FakeProxies
+from ..app.proxy.health import HealthStore, key
+from ..app.proxy.table import Proxy
+from ..app.proxy.tor import CIRCUIT_TTL, TorCircuits
+from ..app.utils import files
+
+URL = "http://vpngate.example/api/iphone/"
+
+
+class _TwoExits(TorCircuits):
+    '''Every other new circuit goes through a slow "exit": another fake SOCKS5 port with a latency'''
+
+    def __init__(self, fast_port: int, slow_port: int, n_circuits: int) -> None:
+        super().__init__(HOST, fast_port, n_circuits)
+        self.slow_port = slow_port
+        self._n_new = 0
+
+    def new_circuit(self) -> Proxy:
+        self._n_new += 1
+        port = self.slow_port if self._n_new % 2 else self.port
+        return Proxy("socks5", f"{secrets.token_hex(4)}:{secrets.token_hex(4)}@{HOST}:{port}", None)
+
+
+async def _with_tor(test) -> None:
+    upstream = await asyncio.start_server(lambda reader, writer: writer.close(), HOST, 0)
+    fast = FakeProxies(Behavior(), upstream.sockets[0].getsockname())
+    slow = FakeProxies(Behavior(latency=0.2), upstream.sockets[0].getsockname())
+    await fast.start()
+    await slow.start()
+    try:
+        await test(fast.port, slow.port)
+    finally:
+        await fast.stop()
+        await slow.stop()
+        upstream.close()
+        await upstream.wait_closed()
+
+
+def test_distinct_credentials_distinct_circuits():
+    circuits = TorCircuits(HOST, 9050)
+    proxies = [circuits.new_circuit() for _ in range(100)]
+
+    assert len(set(proxies)) == 100
+    assert all(proxy.protocol == "socks5" and proxy.ip_port.endswith(f"@{HOST}:9050") for proxy in proxies)
+
+
+def test_fastest_are_the_lowest_latencies():
+    async def test(fast_port: int, slow_port: int) -> None:
+        circuits = _TwoExits(fast_port, slow_port, n_circuits=6)
+        fastest = await circuits.fastest(URL, n=3)
+
+        assert len(set(fastest)) == 3
+        assert all(proxy.ip_port.endswith(f":{fast_port}") for proxy in fastest)  # the slow exit loses
+        latencies = sorted(circuit.latency for circuit in circuits._warm.values())
+        assert [circuits._warm[proxy].latency for proxy in fastest] == latencies[:3]
+
+    asyncio.run(_with_tor(test))
+
+
+def test_warm_circuits_reused_then_expired():
+    async def test(fast_port: int, slow_port: int) -> None:
+        circuits = TorCircuits(HOST, fast_port, n_circuits=4)
+        first = await circuits.fastest(URL, n=2)
+        warm = dict(circuits._warm)
+        assert set(first) <= set(warm) and len(warm) == 2  # the slow half is let go
+
+        second = await circuits.fastest(URL, n=4)  # the warm ones and 2 new
+        assert set(warm) <= set(second)
+        assert all(circuits._warm[proxy].built_at == circuit.built_at for proxy, circuit in warm.items())
+
+        circuits._warm = {proxy: circuit._replace(built_at=circuit.built_at - CIRCUIT_TTL - 1)
+                          for proxy, circuit in circuits._warm.items()}
+        third = await circuits.fastest(URL, n=4)
+        assert not set(third) & set(second)  # all new: Tor doesn't use the expired circuits for new streams
+
+    asyncio.run(_with_tor(test))
+
+
+def test_circuit_health_not_persisted(tmp_path, monkeypatch):
+    monkeypatch.setattr(files, "STATE_DIR", tmp_path)
+    proxy_health = HealthStore(None).load()  # the health_state of the circuits, see tor.py
+    proxy_health.record(key(TorCircuits(HOST, 9050).new_circuit()), 0.1)
+    proxy_health.save()
+
+    assert len(proxy_health) == 1 and not list(tmp_path.iterdir())